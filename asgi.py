@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+import metrics
+import replication
+import sharding
+import write_pipeline
+
+# ASGI serving mode. The event loop owns the sockets, so a slow or idle client costs a
+# coroutine rather than an OS thread; only the route handlers, which block on SQLite,
+# run on a bounded thread pool sized to the connection pool. Routes and payloads are
+# exactly those of crud_db.app. A route that would block waiting, a long-poll or event
+# stream of /changes, instead hands its body over as an async iterator (environ key
+# protocol_registry.defer), which waits here on the loop and borrows a pool thread only
+# to read, so open waits never starve ordinary requests of threads.
+#
+# A request takes one of `workers` slots on the loop before it is dispatched and keeps
+# it until its response is sent, since a streamed body keeps its pooled connection
+# between chunks. No more requests are in flight than the pool has connections, so a
+# thread never blocks in pool.acquire while the streams holding them wait for a thread.
+# A request left waiting POOL_TIMEOUT for a slot gets a 503.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+#   python asgi.py --port 5000
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class AsgiAdapter:
+    def __init__(self, wsgi_app, workers=None):
+        self.wsgi_app = wsgi_app
+        self.workers = workers or db_pool.get_pool().size
+        self._executor = None
+        self._slots = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='db-worker')
+        return self._executor
+
+    @property
+    def slots(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._slots
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._slots = None
+        write_pipeline.disable()
+        replication.disable()
+        sharding.disable()
+        db_pool.close_all()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Set by main(), so every server process starts its own writer
+                if os.environ.get('PROTOCOL_REGISTRY_WRITE_PIPELINE'):
+                    write_pipeline.enable()
+                if os.environ.get('PROTOCOL_REGISTRY_METRICS'):
+                    metrics.enable()
+                if os.environ.get('PROTOCOL_REGISTRY_REPLICAS'):
+                    replication.enable(int(os.environ['PROTOCOL_REGISTRY_REPLICAS']))
+                if os.environ.get('PROTOCOL_REGISTRY_SHARDED'):
+                    sharding.enable()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_SIZE:
+                return False
+            if not message.get('more_body'):
+                return bytes(body)
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        if body is False:
+            await self._send_empty(send, 413)
+            return
+        slots = self.slots
+        try:
+            await asyncio.wait_for(slots.acquire(), db_pool.POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._send_empty(send, 503)
+            return
+        held = [True]
+
+        def release():
+            if held[0]:
+                held[0] = False
+                slots.release()
+        try:
+            await self._respond(scope, body, receive, send, slots, release)
+        finally:
+            release()
+
+    @staticmethod
+    async def _send_empty(send, status):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _respond(self, scope, body, receive, send, slots, release):
+        loop = asyncio.get_running_loop()
+        # Flask keeps its request context in context variables, and a streamed response is
+        # pulled chunk by chunk from whichever worker is free, so every step of one request
+        # runs inside the same (never concurrently entered) context copy.
+        context = contextvars.copy_context()
+        running = set()
+
+        def call(fn, *args):
+            # Shielded, so a request cancelled mid-step lets that step finish before
+            # closing the response enters the context again
+            future = loop.run_in_executor(self.executor, context.run, fn, *args)
+            running.add(future)
+            future.add_done_callback(running.discard)
+            return asyncio.shield(future)
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return self._unsupported_write
+
+        deferred = []
+        environ = self._environ(scope, body)
+        environ['protocol_registry.defer'] = deferred.append
+        iterable = await call(self.wsgi_app, environ, start_response)
+        if deferred:
+            # The route handed its connection back; each read takes a slot of its own
+            release()
+
+            async def read(fn, *args):
+                async with slots:
+                    return await call(fn, *args)
+            chunks = deferred[0](read)
+        else:
+            chunks = self._pull(iterable, call)
+
+        async def stream():
+            # Pull the first chunk before starting the response: start_response may be deferred
+            chunk = await anext(chunks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk.encode() if isinstance(chunk, str) else chunk, 'more_body': True})
+                chunk = await anext(chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+
+        try:
+            if deferred:
+                await self._until_disconnect(stream(), receive)
+            else:
+                await stream()
+        finally:
+            await chunks.aclose()
+            if running:
+                await asyncio.wait(running)
+            if hasattr(iterable, 'close'):
+                await call(iterable.close)
+
+    @staticmethod
+    async def _until_disconnect(coroutine, receive):
+        # A deferred body may wait as long as the client stays (an event stream never
+        # ends), and servers drop what is sent after a disconnect, so stop it then
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        task = asyncio.ensure_future(coroutine)
+        watcher = asyncio.ensure_future(disconnected())
+        try:
+            await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            task.cancel()
+            watcher.cancel()
+            await asyncio.wait([task, watcher])
+        if not task.cancelled():
+            task.result()
+
+    @staticmethod
+    async def _pull(iterable, call):
+        chunks = iter(iterable)
+        while True:
+            chunk = await call(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    @staticmethod
+    def _unsupported_write(data):
+        raise RuntimeError("write() callables are not supported by the ASGI adapter")
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+
+def _create_application():
+    from crud_db import app
+    return AsgiAdapter(app)
+
+
+application = _create_application()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the protocol registry API over ASGI")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1, help="server processes")
+    parser.add_argument('--write-pipeline', action='store_true', help="funnel writes through one group-committing writer")
+    parser.add_argument('--metrics', action='store_true', help="start with request profiling and /metrics collection on")
+    parser.add_argument('--replicas', type=int, default=0, help="serve GET requests from this many refreshed read replicas")
+    parser.add_argument('--replica-interval', type=float, default=replication.REFRESH_INTERVAL,
+                        help="seconds between replica refreshes while the primary changes")
+    parser.add_argument('--sharded', action='store_true', help="store each workflow in its own database file")
+    args = parser.parse_args(argv)
+    if args.write_pipeline:
+        os.environ['PROTOCOL_REGISTRY_WRITE_PIPELINE'] = '1'
+    if args.metrics:
+        os.environ['PROTOCOL_REGISTRY_METRICS'] = '1'
+    if args.sharded and args.replicas:
+        parser.error("--sharded cannot be combined with --replicas")
+    if args.sharded:
+        os.environ['PROTOCOL_REGISTRY_SHARDED'] = '1'
+    if args.replicas:
+        # One refresher here, in the supervising process; the workers only route reads
+        replication.start_refresher(args.replicas, interval=args.replica_interval)
+        os.environ['PROTOCOL_REGISTRY_REPLICAS'] = str(args.replicas)
+
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The ASGI entry point needs an ASGI server: pip install uvicorn "
+                 "(or run `uvicorn asgi:application` / `hypercorn asgi:application` directly)")
+    uvicorn.run('asgi:application', host=args.host, port=args.port, workers=args.workers, lifespan='on')
+
+
+if __name__ == "__main__":
+    main()
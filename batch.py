@@ -0,0 +1,133 @@
+import sqlite3
+
+from db_pool import transaction
+from write_pipeline import pipelined
+
+# Batched writes. POST /batch applies an ordered list of creates, updates and deletes
+# on workflows, protocols, steps and parameters in one transaction, so an edit touching
+# dozens of rows costs one request and one commit, and either all of it applies or
+# none of it does:
+#
+#   [
+#     {"op": "create", "table": "steps", "ref": "mix",
+#      "data": {"protocol_id": 1, "description": "Prepare the mix", "step_order": 1}},
+#     {"op": "create", "table": "parameters",
+#      "data": {"step_id": {"$ref": "mix"}, "name": "volume (μl)", "value_type": "numeric", "value": "50"}},
+#     {"op": "update", "table": "steps", "id": 7, "data": {...}},
+#     {"op": "delete", "table": "parameters", "id": 12}
+#   ]
+#
+# {"$ref": "<name>"}, as an id or any data value, stands for the id of the row created
+# by an earlier operation carrying that "ref". Updates replace the row like PUT does.
+
+MAX_OPERATIONS = 1000
+OPS = ('create', 'update', 'delete')
+
+
+class BatchError(ValueError):
+    # status is the HTTP status of the whole batch; index the failing operation
+    def __init__(self, message, index=None, status=400):
+        super().__init__(message)
+        self.index = index
+        self.status = status
+
+
+def _ref_name(value):
+    if isinstance(value, dict) and set(value) == {'$ref'}:
+        return value['$ref']
+    return None
+
+
+def _check_refs(value, defined, index):
+    name = _ref_name(value)
+    if name is not None:
+        if name not in defined:
+            raise BatchError("Operation %d refers to '%s', which no earlier create defines" % (index, name), index)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _check_refs(item, defined, index)
+    elif isinstance(value, list):
+        for item in value:
+            _check_refs(item, defined, index)
+
+
+def parse_operations(document, tables):
+    # Validates the whole batch up front, so a malformed one never opens a transaction
+    if not isinstance(document, list) or not document:
+        raise BatchError("A batch must be a non-empty list of operations")
+    if len(document) > MAX_OPERATIONS:
+        raise BatchError("A batch holds at most %d operations" % MAX_OPERATIONS)
+    defined = set()
+    for index, operation in enumerate(document):
+        if not isinstance(operation, dict):
+            raise BatchError("Operation %d must be an object" % index, index)
+        if operation.get('op') not in OPS:
+            raise BatchError("Operation %d: 'op' must be one of %s" % (index, ', '.join(OPS)), index)
+        if operation.get('table') not in tables:
+            raise BatchError("Operation %d: 'table' must be one of %s" % (index, ', '.join(tables)), index)
+        if operation['op'] != 'delete' and not isinstance(operation.get('data'), dict):
+            raise BatchError("Operation %d: %s needs a 'data' object" % (index, operation['op']), index)
+        if operation['op'] == 'create':
+            if 'id' in operation:
+                raise BatchError("Operation %d: create takes no 'id'" % index, index)
+        else:
+            id = operation.get('id')
+            if _ref_name(id) is None and (not isinstance(id, int) or isinstance(id, bool)):
+                raise BatchError("Operation %d: %s needs an integer 'id' or a $ref" % (index, operation['op']), index)
+        _check_refs(operation.get('id'), defined, index)
+        _check_refs(operation.get('data'), defined, index)
+        ref = operation.get('ref')
+        if ref is not None:
+            if operation['op'] != 'create' or not isinstance(ref, str):
+                raise BatchError("Operation %d: only a create can carry a 'ref', and it must be a string" % index, index)
+            if ref in defined:
+                raise BatchError("Operation %d: ref '%s' is already defined" % (index, ref), index)
+            defined.add(ref)
+    return document
+
+
+def _resolve(value, ids):
+    name = _ref_name(value)
+    if name is not None:
+        return ids[name]
+    if isinstance(value, dict):
+        return {key: _resolve(item, ids) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve(item, ids) for item in value]
+    return value
+
+
+@pipelined
+def apply_batch(operations, writers):
+    # writers: table -> (create, update, delete, fields), the same helpers the single
+    # row routes call; nested inside this transaction, none of them commits on its own
+    results = []
+    ids = {}
+    with transaction(immediate=True):
+        for index, operation in enumerate(operations):
+            create, update, delete, fields = writers[operation['table']]
+            data = _resolve(operation.get('data') or {}, ids)
+            values = [data.get(field) for field in fields]
+            try:
+                if operation['op'] == 'create':
+                    row = create(*values)
+                    result = {'status': 201, 'id': row['id'], 'row': row}
+                    if operation.get('ref') is not None:
+                        ids[operation['ref']] = row['id']
+                        result['ref'] = operation['ref']
+                elif operation['op'] == 'update':
+                    id = _resolve(operation['id'], ids)
+                    row = update(id, *values)
+                    if row is None:
+                        raise BatchError("Operation %d: %s %d not found" % (index, operation['table'], id), index, 404)
+                    result = {'status': 200, 'id': id, 'row': row}
+                else:
+                    id = _resolve(operation['id'], ids)
+                    delete(id)
+                    result = {'status': 200, 'id': id}
+            except sqlite3.IntegrityError as e:
+                raise BatchError("Operation %d: constraint violated: %s" % (index, e), index, 409) from e
+            result['op'] = operation['op']
+            result['table'] = operation['table']
+            results.append(result)
+    return results
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import db_pool
+from crud_db import app
+from migrations import migrate
+
+# Latency of GET /steps/protocol_id/<id> before (schema v1) and after (latest schema)
+# the foreign key / ordering indexes.
+#
+#   python -m benchmarks.bench_indexes --rows 10000 100000 1000000
+
+STEPS_PER_PROTOCOL = 50
+
+
+def populate(db_name, rows):
+    protocols = max(1, rows // STEPS_PER_PROTOCOL)
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("INSERT INTO workflows (id, name) VALUES (1, 'Benchmark Workflow')")
+        conn.executemany(
+            "INSERT INTO protocols (id, workflow_id, name, description) VALUES (?, 1, ?, '')",
+            ((p, "Protocol %d" % p) for p in range(1, protocols + 1)))
+        # Interleave protocols the way concurrent editing does, so no protocol's steps are contiguous
+        conn.executemany(
+            "INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (?, ?, NULL, ?, ?)",
+            ((i, i % protocols + 1, "Step %d" % i, i // protocols) for i in range(1, rows + 1)))
+    conn.close()
+    return protocols
+
+
+def measure(client, protocols, requests):
+    ids = [random.randint(1, protocols) for _ in range(requests)]
+    client.get('/steps/protocol_id/%d' % ids[0])  # warm the pool and page cache
+    timings = []
+    for protocol_id in ids:
+        started = time.perf_counter()
+        response = client.get('/steps/protocol_id/%d' % protocol_id)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+    timings.sort()
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1], 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+    }
+
+
+def run(sizes, requests):
+    client = app.test_client()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            db_name = os.path.join(tmp, 'bench_%d.db' % rows)
+            migrate(db_name, target=1)
+            protocols = populate(db_name, rows)
+            db_pool.configure(db_name=db_name)
+            before = measure(client, protocols, requests)
+            db_pool.close_all()
+            migrate(db_name)
+            after = measure(client, protocols, requests)
+            db_pool.close_all()
+            results.append({'rows': rows, 'before': before, 'after': after})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /steps/protocol_id/<id> before and after the schema indexes")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.requests)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%10s %16s %16s %10s" % ("rows", "before p50 (ms)", "after p50 (ms)", "speedup"))
+        for r in results:
+            print("%10d %16.3f %16.3f %9.1fx" % (
+                r['rows'], r['before']['p50_ms'], r['after']['p50_ms'],
+                r['before']['p50_ms'] / r['after']['p50_ms']))
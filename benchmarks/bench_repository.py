@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import db_pool
+import repository
+from db_pool import get_connection, transaction
+from migrations import migrate
+
+# Per-call time and peak allocation of the repository.py helpers against the
+# cursor-per-call, sqlite3.Row based helpers crud_db.py used before them (copied below
+# as the baseline), on the same database and connection pool.
+#
+#   python -m benchmarks.bench_repository --rows 2000 --calls 20000
+
+
+def legacy_get(id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM parameters WHERE id=?", (id,))
+        return cursor.fetchone()
+
+
+def legacy_all():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT * FROM parameters")
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def legacy_update(id, step_id, name, value_type, value):
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("UPDATE parameters SET step_id=?, name=?, value_type=?, value=? WHERE id=? RETURNING *", (step_id, name, value_type, value, id))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def populate(db_name, rows):
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("INSERT INTO workflows (id, name) VALUES (1, 'Benchmark Workflow')")
+        conn.execute("INSERT INTO protocols (id, workflow_id, name, description) VALUES (1, 1, 'Benchmark Protocol', '')")
+        conn.executemany("INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (?, 1, NULL, ?, ?)",
+                         ((i, "Step %d" % i, i) for i in range(1, rows + 1)))
+        conn.executemany("INSERT INTO parameters (id, step_id, name, value_type, value) VALUES (?, ?, 'volume (μl)', 'numeric', ?)",
+                         ((i, i, str(i)) for i in range(1, rows + 1)))
+    conn.close()
+
+
+def measure(fn, calls):
+    fn()  # warm the pool and the statement cache
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    per_call = (time.perf_counter() - started) / calls
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'us_per_call': round(per_call * 1e6, 2), 'peak_kib': round(peak / 1024, 2)}
+
+
+def run(rows, calls):
+    ids = list(range(1, rows + 1))
+    cases = [
+        ('get by id', lambda: legacy_get(7), lambda: repository.PARAMETERS.get(7), calls),
+        ('all rows as dicts', legacy_all, lambda: [row._asdict() for row in repository.PARAMETERS.all()], max(1, calls // 1000)),
+        ('update', lambda: legacy_update(7, 7, 'volume (μl)', 'numeric', '50'),
+         lambda: repository.PARAMETERS.update(7, 7, 'volume (μl)', 'numeric', '50')._asdict(), max(1, calls // 20)),
+        ('%d ids: get per id / get_many' % rows, lambda: [legacy_get(id) for id in ids],
+         lambda: repository.PARAMETERS.get_many(ids), max(1, calls // 1000)),
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, 'bench_repository.db')
+        migrate(db_name)
+        populate(db_name, rows)
+        db_pool.configure(db_name=db_name)
+        try:
+            for name, before, after, count in cases:
+                results.append({'case': name, 'before': measure(before, count), 'after': measure(after, count)})
+        finally:
+            db_pool.close_all()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the repository helpers against the previous per-call helpers")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.calls)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("%-32s %14s %14s %16s %16s" % ("case", "before (us)", "after (us)", "before peak KiB", "after peak KiB"))
+        for r in results:
+            print("%-32s %14.2f %14.2f %16.2f %16.2f" % (
+                r['case'], r['before']['us_per_call'], r['after']['us_per_call'],
+                r['before']['peak_kib'], r['after']['peak_kib']))
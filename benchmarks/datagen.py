@@ -0,0 +1,77 @@
+import random
+
+# Synthetic registry content shaped like real protocols: workflow -> protocols -> a nested
+# step tree (a few top-level stages, each with sub-steps, some with their own sub-steps)
+# -> numeric and categorical parameters. Output is in the bulk import document format.
+
+STAGES = ["Prepare the reaction mix", "Thermocycling", "Purification", "Quantification", "Storage"]
+ACTIONS = ["Add", "Pipette", "Spin", "Incubate", "Transfer", "Wash", "Mix", "Denature", "Anneal", "Extend"]
+REAGENTS = ["sterile water", "forward primer", "reverse primer", "dNTPs", "MgCl2 buffer",
+            "DNA template", "DNA polymerase", "ethanol", "elution buffer", "loading dye"]
+NUMERIC_PARAMETERS = [("temperature (°C)", 4, 98), ("time (seconds)", 5, 900), ("volume (μl)", 1, 200),
+                      ("speed (RPM)", 500, 14000), ("cycle", 1, 40), ("concentration (μM)", 0.1, 50)]
+CATEGORICAL_PARAMETERS = [("tube type", ["PCR tube", "Eppendorf", "96-well plate"]),
+                          ("mixing", ["pipette", "vortex", "invert"])]
+
+
+def _step(rng, depth, max_depth, children, params_per_step):
+    action = rng.choice(ACTIONS)
+    step = {
+        'description': "%s %d μl of %s" % (action, rng.randint(1, 50), rng.choice(REAGENTS)),
+        'parameters': [],
+    }
+    for _ in range(rng.randint(0, params_per_step)):
+        if rng.random() < 0.8:
+            name, low, high = rng.choice(NUMERIC_PARAMETERS)
+            step['parameters'].append({'name': name, 'value_type': 'numeric', 'value': str(round(rng.uniform(low, high), 1))})
+        else:
+            name, values = rng.choice(CATEGORICAL_PARAMETERS)
+            step['parameters'].append({'name': name, 'value_type': 'categorical', 'value': rng.choice(values)})
+    if depth < max_depth and children:
+        step['children'] = [_step(rng, depth + 1, max_depth, children // 2, params_per_step)
+                            for _ in range(rng.randint(1, children))]
+    return step
+
+
+def generate_protocol(rng, workflow_id=None, workflow_name=None, steps=20, max_depth=3, params_per_step=2):
+    # Roughly `steps` steps spread over a few top-level stages
+    stages = []
+    total = 0
+    while total < steps:
+        stage = {'description': rng.choice(STAGES), 'parameters': [], 'children': []}
+        while total < steps and len(stage['children']) < 8:
+            child = _step(rng, 1, max_depth, 4, params_per_step)
+            stage['children'].append(child)
+            total += _count(child)
+        stages.append(stage)
+        total += 1
+    document = {
+        'protocol': {'name': "%s version %d" % (rng.choice(["PCR", "qPCR", "Miniprep", "Gel extraction"]), rng.randint(1, 9)),
+                     'description': "Synthetic protocol with %d steps" % total},
+        'steps': stages,
+    }
+    if workflow_id is not None:
+        document['workflow_id'] = workflow_id
+    else:
+        document['workflow'] = {'name': workflow_name or "Workflow %d" % rng.randint(1, 10 ** 6)}
+    return document
+
+
+def _count(step):
+    return 1 + sum(_count(child) for child in step.get('children', []))
+
+
+def populate(workflows=10, protocols_per_workflow=10, steps_per_protocol=20, max_depth=3, params_per_step=2, seed=0):
+    # Loads a generated registry through import_protocol() into the configured database
+    from bulk_import import import_protocol
+    rng = random.Random(seed)
+    protocol_ids = []
+    for w in range(workflows):
+        workflow_id = None
+        for _ in range(protocols_per_workflow):
+            document = generate_protocol(rng, workflow_id=workflow_id, workflow_name="Workflow %d" % (w + 1),
+                                         steps=steps_per_protocol, max_depth=max_depth, params_per_step=params_per_step)
+            result = import_protocol(document)
+            workflow_id = result['workflow_id']
+            protocol_ids.append(result['protocol_id'])
+    return protocol_ids
@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.datagen import generate_protocol
+
+# Load-testing harness for the Flask API.
+#
+#   python -m benchmarks.suite --scale small --output results.json
+#   python -m benchmarks.suite --scenarios tree-fetch mixed-crud --concurrency 8
+#   python -m benchmarks.suite --base-url http://127.0.0.1:5000     (a running server)
+#   python -m benchmarks.suite --compare results.json                (exit 1 on p95 regressions)
+#
+# Without --base-url the app runs in-process through the Flask test client against a
+# scratch database, so peak RSS covers the server side as well.
+
+SCALES = {
+    # workflows, protocols per workflow, steps per protocol
+    'small': (2, 5, 20),
+    'medium': (10, 10, 50),
+    'large': (20, 25, 200),
+}
+
+
+class FlaskClient:
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers or {})
+        data = response.get_data()
+        return response.status_code, dict(response.headers), data
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, dict(response.headers), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read()
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def populate(client, scale, seed):
+    workflows, protocols_per_workflow, steps_per_protocol = SCALES[scale]
+    rng = random.Random(seed)
+    context = {'protocol_ids': [], 'step_ids': [], 'parameter_ids': []}
+    for w in range(workflows):
+        workflow_id = None
+        for _ in range(protocols_per_workflow):
+            document = generate_protocol(rng, workflow_id=workflow_id, workflow_name="Workflow %d" % (w + 1),
+                                         steps=steps_per_protocol)
+            status, _, data = client.request('POST', '/protocols/bulk', document)
+            if status != 201:
+                raise RuntimeError("bulk import failed with %s: %s" % (status, data[:200]))
+            result = json.loads(data)
+            workflow_id = result['workflow_id']
+            context['protocol_ids'].append(result['protocol_id'])
+            context['step_ids'].extend(result['step_ids'])
+            context['parameter_ids'].extend(result['parameter_ids'])
+    return context
+
+
+# Scenarios are generators of operations: (endpoint label, method, path, body, poll).
+# `poll` operations replay the last ETag seen for the path, as instrument clients do.
+
+def read_heavy_polling(rng, context):
+    protocols = context['protocol_ids']
+    while True:
+        protocol_id = rng.choice(protocols[:10])  # a handful of hot protocols
+        yield 'GET /protocols/<id>', 'GET', '/protocols/%d' % protocol_id, None, True
+        yield 'GET /steps/protocol_id/<id>', 'GET', '/steps/protocol_id/%d' % protocol_id, None, True
+        yield 'GET /parameters?step_id=', 'GET', '/parameters?step_id=%d' % rng.choice(context['step_ids']), None, True
+
+
+def bulk_import(rng, context):
+    while True:
+        document = generate_protocol(rng, workflow_id=None, steps=rng.randint(10, 60))
+        yield 'POST /protocols/bulk', 'POST', '/protocols/bulk', document, False
+
+
+def tree_fetch(rng, context):
+    while True:
+        yield 'GET /protocols/<id>/tree', 'GET', '/protocols/%d/tree' % rng.choice(context['protocol_ids']), None, False
+
+
+def mixed_crud(rng, context):
+    protocols = context['protocol_ids']
+    steps = context['step_ids']
+    while True:
+        roll = rng.random()
+        step_id = rng.choice(steps)
+        if roll < 0.4:
+            yield 'GET /steps/<id>', 'GET', '/steps/%d' % step_id, None, False
+        elif roll < 0.6:
+            yield 'GET /steps/protocol_id/<id>', 'GET', '/steps/protocol_id/%d' % rng.choice(protocols), None, False
+        elif roll < 0.75:
+            yield 'GET /parameters?limit=', 'GET', '/parameters?limit=100&after=%d' % rng.randint(0, 1000), None, False
+        elif roll < 0.85:
+            yield 'PUT /steps/<id>', 'PUT', '/steps/%d' % step_id, {
+                'protocol_id': rng.choice(protocols), 'parent_step_id': None,
+                'description': "Edited step %d" % rng.randint(1, 10 ** 6), 'step_order': rng.randint(1, 20)}, False
+        elif roll < 0.95:
+            yield 'POST /parameters', 'POST', '/parameters', {
+                'step_id': step_id, 'name': "temperature (°C)", 'value_type': 'numeric',
+                'value': str(rng.randint(4, 98))}, False
+        else:
+            yield 'DELETE /parameters/<id>', 'DELETE', '/parameters/%d' % rng.choice(context['parameter_ids']), None, False
+
+
+SCENARIOS = {
+    'read-heavy-polling': read_heavy_polling,
+    'bulk-import': bulk_import,
+    'tree-fetch': tree_fetch,
+    'mixed-crud': mixed_crud,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(client, name, context, requests, concurrency, seed, measure_rss):
+    samples = {}
+    lock = threading.Lock()
+    per_worker = max(1, requests // concurrency)
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        etags = {}
+        local = {}
+        operations = SCENARIOS[name](rng, context)
+        for _ in range(per_worker):
+            label, method, path, body, poll = next(operations)
+            headers = {'If-None-Match': etags[path]} if poll and path in etags else None
+            started = time.perf_counter()
+            status, response_headers, data = client.request(method, path, body, headers)
+            elapsed = time.perf_counter() - started
+            if poll and 'ETag' in response_headers:
+                etags[path] = response_headers['ETag']
+            sample = local.setdefault(label, {'latencies': [], 'errors': 0, 'bytes': 0, 'statuses': {}, 'peak_rss_mb': 0.0})
+            sample['latencies'].append(elapsed)
+            sample['bytes'] += len(data)
+            sample['statuses'][status] = sample['statuses'].get(status, 0) + 1
+            if status >= 500:
+                sample['errors'] += 1
+            if measure_rss:
+                sample['peak_rss_mb'] = max(sample['peak_rss_mb'], current_rss_mb())
+        with lock:
+            for label, sample in local.items():
+                merged = samples.setdefault(label, {'latencies': [], 'errors': 0, 'bytes': 0, 'statuses': {}, 'peak_rss_mb': 0.0})
+                merged['latencies'].extend(sample['latencies'])
+                merged['errors'] += sample['errors']
+                merged['bytes'] += sample['bytes']
+                merged['peak_rss_mb'] = max(merged['peak_rss_mb'], sample['peak_rss_mb'])
+                for status, count in sample['statuses'].items():
+                    merged['statuses'][status] = merged['statuses'].get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    endpoints = {}
+    for label, sample in sorted(samples.items()):
+        latencies = sorted(sample['latencies'])
+        endpoints[label] = {
+            'requests': len(latencies),
+            'errors': sample['errors'],
+            'statuses': {str(status): count for status, count in sorted(sample['statuses'].items())},
+            'throughput_rps': round(len(latencies) / duration, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+            'bytes_per_request': round(sample['bytes'] / len(latencies)),
+            'peak_rss_mb': round(sample['peak_rss_mb'], 1) if measure_rss else None,
+        }
+    total = sum(endpoint['requests'] for endpoint in endpoints.values())
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(total / duration, 1),
+        'endpoints': endpoints,
+    }
+
+
+def compare(baseline, results, tolerance):
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        for label, endpoint in scenario['endpoints'].items():
+            before = baseline.get('scenarios', {}).get(name, {}).get('endpoints', {}).get(label)
+            if before and endpoint['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append((name, label, before['p95_ms'], endpoint['p95_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmarks for the protocol registry API")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=1000, help="requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--base-url', help="benchmark a running server instead of the in-process app")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="baseline results JSON; exit 1 when a p95 regresses")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    scratch = None
+    if args.base_url:
+        client = HttpClient(args.base_url)
+    else:
+        import db_pool
+        from migrations import migrate
+        from crud_db import app
+        scratch = tempfile.TemporaryDirectory()
+        db_name = os.path.join(scratch.name, 'benchmark.db')
+        migrate(db_name)
+        db_pool.configure(db_name=db_name)
+        client = FlaskClient(app)
+
+    try:
+        context = populate(client, args.scale, args.seed)
+        results = {
+            'meta': {
+                'scale': args.scale,
+                'target': args.base_url or 'in-process',
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'rows': {'protocols': len(context['protocol_ids']), 'steps': len(context['step_ids']),
+                         'parameters': len(context['parameter_ids'])},
+            },
+            'scenarios': {},
+        }
+        for name in args.scenarios:
+            results['scenarios'][name] = run_scenario(client, name, context, args.requests, args.concurrency,
+                                                      args.seed, measure_rss=not args.base_url)
+        results['meta']['peak_rss_mb'] = round(current_rss_mb(), 1) if not args.base_url else None
+    finally:
+        if scratch is not None:
+            import db_pool
+            db_pool.close_all()
+            scratch.cleanup()
+
+    print("%-20s %-32s %8s %9s %9s %9s %10s %9s" % ("scenario", "endpoint", "requests", "p50 ms", "p95 ms", "p99 ms", "req/s", "RSS MB"))
+    for name, scenario in results['scenarios'].items():
+        for label, endpoint in scenario['endpoints'].items():
+            print("%-20s %-32s %8d %9.3f %9.3f %9.3f %10.1f %9s" % (
+                name, label, endpoint['requests'], endpoint['p50_ms'], endpoint['p95_ms'], endpoint['p99_ms'],
+                endpoint['throughput_rps'], endpoint['peak_rss_mb'] if endpoint['peak_rss_mb'] is not None else '-'))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+        for name, label, before, after in regressions:
+            print("REGRESSION %s %s: p95 %.3f ms -> %.3f ms" % (name, label, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
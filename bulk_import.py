@@ -0,0 +1,178 @@
+import sharding
+from db_pool import transaction
+from write_pipeline import pipelined
+
+# Bulk import of a whole protocol from one nested document:
+#
+#   {
+#     "workflow": {"name": "PCR Workflow"},        (or "workflow_id": <existing id>)
+#     "protocol": {"name": "PCR version 1", "description": "..."},
+#     "steps": [
+#       {"temp_id": "mix", "description": "Prepare the mix", "step_order": 1,
+#        "parameters": [{"name": "volume (μl)", "value_type": "numeric", "value": "50"}],
+#        "children": [{"description": "Add 38 μl sterile water"}]},
+#       {"description": "Store at 4°C", "parent": "mix"}
+#     ]
+#   }
+#
+# A step's parent is the step it is nested under, else the step named by its "parent"
+# temp_id (earlier or later in the document, parents are inserted first), else the
+# existing row given as "parent_step_id". step_order defaults to the position among its
+# siblings: nested children first, then steps attached by temp_id in document order.
+# Everything is inserted with executemany in one transaction.
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+def allocate_ids(conn, table, count):
+    # Must run inside a write transaction (BEGIN IMMEDIATE) so no other writer can
+    # take the same ids. Matches what SQLite itself would assign to INTEGER PRIMARY KEY,
+    # except when sharded, where the catalog hands out ids unique across all shards.
+    if sharding.enabled():
+        return sharding.allocate_ids(table, count)
+    start = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM %s" % table).fetchone()[0]
+    return range(start, start + count)
+
+
+def _require(mapping, key, where):
+    value = mapping.get(key) if isinstance(mapping, dict) else None
+    if value is None:
+        raise BulkImportError("%s is missing required field '%s'" % (where, key))
+    return value
+
+
+def _flatten_steps(steps):
+    # Depth-first, in document order, without recursion so deep trees are fine
+    flat = []
+    pending = [(step, None, position) for position, step in reversed(list(enumerate(steps or [], 1)))]
+    while pending:
+        step, parent_index, position = pending.pop()
+        if not isinstance(step, dict):
+            raise BulkImportError("step #%d is not an object" % (len(flat) + 1))
+        index = len(flat)
+        flat.append((step, parent_index, position))
+        children = step.get('children') or []
+        pending.extend((child, index, child_position)
+                       for child_position, child in reversed(list(enumerate(children, 1))))
+    return flat
+
+
+def _plan(document):
+    if not isinstance(document, dict):
+        raise BulkImportError("document must be an object")
+    protocol = document.get('protocol')
+    if not isinstance(protocol, dict):
+        raise BulkImportError("document is missing the 'protocol' object")
+    _require(protocol, 'name', "protocol")
+
+    workflow = document.get('workflow')
+    if workflow is not None:
+        _require(workflow, 'name', "workflow")
+
+    flat = _flatten_steps(document.get('steps'))
+    temp_ids = {}
+    for index, (step, _, _) in enumerate(flat):
+        where = "step #%d" % (index + 1)
+        _require(step, 'description', where)
+        temp_id = step.get('temp_id')
+        if temp_id is not None:
+            if temp_id in temp_ids:
+                raise BulkImportError("duplicate temp_id '%s'" % temp_id)
+            temp_ids[temp_id] = index
+        for parameter in step.get('parameters') or []:
+            for field in ('name', 'value_type', 'value'):
+                _require(parameter, field, "parameter of %s" % where)
+
+    parents = []
+    attached = {}
+    positions = []
+    for index, (step, parent_index, position) in enumerate(flat):
+        parent = step.get('parent')
+        if parent_index is None and parent is not None:
+            if parent not in temp_ids:
+                raise BulkImportError("step #%d references unknown parent '%s'" % (index + 1, parent))
+            parent_index = temp_ids[parent]
+            # After the parent's nested children and any step attached to it before
+            attached[parent_index] = attached.get(parent_index, len(flat[parent_index][0].get('children') or [])) + 1
+            position = attached[parent_index]
+        parents.append(parent_index)
+        positions.append(position)
+    return protocol, workflow, flat, temp_ids, parents, positions, _insert_order(flat, parents)
+
+
+def _step_name(flat, index):
+    temp_id = flat[index][0].get('temp_id')
+    return "'%s'" % temp_id if temp_id is not None else "step #%d" % (index + 1)
+
+
+def _insert_order(flat, parents):
+    # Step indexes with every parent before its children, since a "parent" temp_id may
+    # point further down the document; a cycle of parents can never be inserted
+    order = []
+    state = [0] * len(flat)  # 0 pending, 1 on the current parent chain, 2 ordered
+    for index in range(len(flat)):
+        chain = []
+        node = index
+        while node is not None and state[node] == 0:
+            state[node] = 1
+            chain.append(node)
+            node = parents[node]
+        if node is not None and state[node] == 1:
+            cycle = chain[chain.index(node):] + [node]
+            raise BulkImportError("steps form a parent cycle: %s" % ' -> '.join(_step_name(flat, step) for step in cycle))
+        for node in reversed(chain):
+            state[node] = 2
+            order.append(node)
+    return order
+
+
+@pipelined
+def import_protocol(document):
+    protocol, workflow, flat, temp_ids, parents, positions, order = _plan(document)
+
+    with transaction(immediate=True) as conn:
+        if workflow is not None:
+            workflow_id = allocate_ids(conn, 'workflows', 1)[0]
+            conn.execute("INSERT INTO workflows (id, name) VALUES (?, ?)", (workflow_id, workflow['name']))
+        else:
+            workflow_id = document.get('workflow_id')
+
+        protocol_id = allocate_ids(conn, 'protocols', 1)[0]
+        conn.execute("INSERT INTO protocols (id, workflow_id, name, description) VALUES (?, ?, ?, ?)",
+                     (protocol_id, workflow_id, protocol['name'], protocol.get('description')))
+
+        step_ids = allocate_ids(conn, 'steps', len(flat))
+        step_rows = []
+        parameter_rows = []
+        for index in order:
+            step = flat[index][0]
+            if parents[index] is not None:
+                parent_step_id = step_ids[parents[index]]
+            else:
+                parent_step_id = step.get('parent_step_id')
+            step_order = step.get('step_order', positions[index])
+            step_rows.append((step_ids[index], protocol_id, parent_step_id, step['description'], step_order))
+            for parameter in step.get('parameters') or []:
+                parameter_rows.append((step_ids[index], parameter['name'], parameter['value_type'], str(parameter['value'])))
+
+        conn.executemany("INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (?, ?, ?, ?, ?)", step_rows)
+        parameter_ids = allocate_ids(conn, 'parameters', len(parameter_rows))
+        conn.executemany("INSERT INTO parameters (id, step_id, name, value_type, value) VALUES (?, ?, ?, ?, ?)",
+                         [(parameter_id,) + row for parameter_id, row in zip(parameter_ids, parameter_rows)])
+
+    return {
+        'workflow_id': workflow_id,
+        'protocol_id': protocol_id,
+        'steps': {temp_id: step_ids[index] for temp_id, index in temp_ids.items()},
+        'step_ids': list(step_ids),
+        'parameter_ids': list(parameter_ids),
+    }
+
+
+@pipelined
+def import_protocols(documents):
+    # Many documents, still one transaction and one commit
+    with transaction(immediate=True):
+        return [import_protocol(document) for document in documents]
@@ -0,0 +1,166 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import db_pool
+from conditional import current_version
+
+CACHE_MAXSIZE = 4096
+CACHE_TTL = 60  # seconds
+
+MISS = object()
+
+
+class LRUCache:
+    # Bounded in-process LRU with a per-entry TTL. Also serves as the local stand-in
+    # for a shared backend in tests.
+    def __init__(self, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=MISS):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'backend': 'lru',
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SharedCache:
+    # Adapter for a cache shared between processes. `client` is any memcached/redis
+    # style object with get(key), set(key, value, ttl), delete(key) and clear();
+    # eviction and expiry are left to the server.
+    def __init__(self, client, prefix='protocol_registry:', ttl=CACHE_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=MISS):
+        data = self.client.get(self.prefix + key)
+        return default if data is None else pickle.loads(data)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), self.ttl)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.client.delete(self.prefix + key)
+
+    def clear(self):
+        self.client.clear()
+
+    def stats(self):
+        return {'backend': 'shared', 'ttl': self.ttl}
+
+
+_backend = LRUCache()
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def configure_cache(backend=None, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL):
+    global _backend
+    _backend = backend if backend is not None else LRUCache(maxsize, ttl)
+    reset_stats()
+
+
+def reset_stats():
+    for name in _counters:
+        _counters[name] = 0
+
+
+def cache_stats():
+    stats = dict(_counters)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    stats.update(_backend.stats())
+    return stats
+
+
+def clear():
+    _backend.clear()
+
+
+def cached(namespace, scope=None):
+    # Read-through cache for a helper taking one id. Each entry carries the version of
+    # the resource_versions counter `scope` (default: namespace) it was read at, and is
+    # a miss once the counter has moved: the triggers bump it for writes from any
+    # connection or process, which invalidate() alone cannot see. Missing rows are not
+    # cached, and nothing read inside an open transaction is stored, since it may still
+    # roll back. Neither is anything read from a replica: it may predate a write already
+    # invalidated. Reads routed to a shard are cached like any other, since ids are
+    # unique across shards and each shard keeps its own counters.
+    scope = scope or namespace
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(id):
+            key = '%s:%s' % (namespace, id)
+            version = current_version(scope, id)
+            entry = _backend.get(key)
+            if entry is not MISS and entry[0] == version:
+                _counters['hits'] += 1
+                return entry[1]
+            _counters['misses'] += 1
+            value = fn(id)
+            if value is not None and not db_pool.in_transaction() and not db_pool.reading_replica():
+                _backend.set(key, (version, value))
+            return value
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+
+def invalidate(*keys):
+    # Drop now, and again once the writing transaction commits, so a reader that
+    # raced the write cannot leave the old row behind
+    keys = [key for key in keys if not key.endswith(':None')]
+    if not keys:
+        return
+    _counters['invalidations'] += len(keys)
+    _backend.delete_many(keys)
+    db_pool.on_commit(lambda: _backend.delete_many(keys))
+
+
+def invalidate_all():
+    _backend.clear()
+    db_pool.on_commit(_backend.clear)
@@ -0,0 +1,263 @@
+import asyncio
+import threading
+import time
+
+from flask import has_app_context
+
+import db_pool
+from db_pool import get_connection
+from listing import MAX_PAGE_SIZE, TABLES, parse_int
+from repository import REPOSITORIES
+from serialization import dumps
+
+# Change feed over the changes table (see migrations.py), so clients follow edits
+# instead of re-reading whole protocols:
+#
+#   /changes?since=<seq>&protocol_id=<id>         change entries after seq, oldest first
+#   /changes?since=<seq>&wait=25                  long-poll: hold the request until one arrives
+#   /changes (Accept: text/event-stream)          server-sent events, resumable with Last-Event-ID
+#   /changes/delta?since=<seq>&protocol_id=<id>   the changed rows themselves, one entry per row
+#
+# Waiting clients hold neither a database connection nor a query loop: one notifier
+# thread per process watches MAX(seq) while anyone is waiting and wakes them. It also
+# sees writes made by other processes. Under asgi.py they hold no thread either: the
+# *_async twins below wait on the event loop and borrow a request thread only to read.
+
+POLL_INTERVAL = 0.1  # seconds between the notifier's MAX(seq) checks while clients wait
+MAX_WAIT = 30
+HEARTBEAT = 15  # seconds between SSE keep-alive comments
+SSE_MIMETYPE = 'text/event-stream'
+CHANGE_COLUMNS = ('seq', 'table_name', 'row_id', 'op', 'protocol_id', 'changed_at')
+
+
+class ChangesGone(LookupError):
+    # The requested position was pruned from the log; the client must reload
+    pass
+
+
+class ChangeNotifier:
+    def __init__(self, db_name=None, interval=POLL_INTERVAL):
+        self.db_name = db_name or db_pool.DB_NAME
+        self.interval = interval
+        self.latest = None
+        self._waiters = 0
+        self._futures = set()  # (loop, future) of wait_async callers
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='change-notifier', daemon=True)
+        self._thread.start()
+
+    def wait(self, since, timeout):
+        # The newest seq once it is past `since`, or whatever is newest at the timeout
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._waiters += 1
+            self._condition.notify_all()
+            try:
+                while self.latest is None or self.latest <= since:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                return self.latest
+            finally:
+                self._waiters -= 1
+
+    async def wait_async(self, since, timeout):
+        # wait() for a coroutine: the notifier thread resolves a future on its loop
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._condition:
+                remaining = deadline - loop.time()
+                if (self.latest is not None and self.latest > since) or remaining <= 0:
+                    return self.latest
+                waiter = (loop, loop.create_future())
+                self._futures.add(waiter)
+                self._waiters += 1
+                self._condition.notify_all()
+            try:
+                await asyncio.wait([waiter[1]], timeout=remaining)
+            finally:
+                with self._condition:
+                    self._futures.discard(waiter)
+                    self._waiters -= 1
+
+    def _run(self):
+        conn = db_pool.open_connection(self.db_name)
+        while True:
+            with self._condition:
+                while not self._waiters:
+                    self._condition.wait()
+            latest = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            with self._condition:
+                if latest != self.latest:
+                    self.latest = latest
+                    self._condition.notify_all()
+                    for loop, future in self._futures:
+                        loop.call_soon_threadsafe(_wake, future)
+            time.sleep(self.interval)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_notifiers = {}
+_notifiers_lock = threading.Lock()
+
+
+def get_notifier(db_name=None):
+    db_name = db_name or db_pool.DB_NAME
+    with _notifiers_lock:
+        if db_name not in _notifiers:
+            _notifiers[db_name] = ChangeNotifier(db_name)
+        return _notifiers[db_name]
+
+
+def parse_changes_query(args, last_event_id=None):
+    # (since, protocol_id, limit, wait) from the query string; without since the feed
+    # starts at the newest entry
+    since = last_event_id if last_event_id is not None else args.get('since')
+    since = parse_int('since', since, 0, 1 << 62) if since else None
+    protocol_id = parse_int('protocol_id', args['protocol_id'], 0, 1 << 62) if args.get('protocol_id') else None
+    limit = parse_int('limit', args['limit'], 1, MAX_PAGE_SIZE) if args.get('limit') else MAX_PAGE_SIZE
+    wait = parse_int('wait', args['wait'], 0, MAX_WAIT) if args.get('wait') else 0
+    return since, protocol_id, limit, wait
+
+
+def _head(conn):
+    # The last seq ever assigned, kept by AUTOINCREMENT even once the log is pruned
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+
+def _check_retained(conn, since):
+    # seq values are never reused, so anything between since and the oldest entry left
+    # was pruned
+    oldest = conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+    if oldest is None:
+        oldest = _head(conn) + 1
+    if since < oldest - 1:
+        raise ChangesGone("Changes after %d have been pruned; reload and resume from %d" % (since, oldest - 1))
+
+
+def list_changes(since=None, protocol_id=None, limit=MAX_PAGE_SIZE):
+    # (entries, next seq to pass as since)
+    sql = "SELECT %s FROM changes WHERE seq > ?" % ', '.join(CHANGE_COLUMNS)
+    params = [since]
+    if protocol_id is not None:
+        sql += " AND protocol_id = ?"
+        params.append(protocol_id)
+    sql += " ORDER BY seq LIMIT ?"
+    params.append(limit)
+    with get_connection() as conn:
+        if since is None:
+            return [], _head(conn)
+        _check_retained(conn, since)
+        entries = [dict(zip(CHANGE_COLUMNS, row)) for row in conn.execute(sql, params).fetchall()]
+    return entries, entries[-1]['seq'] if entries else since
+
+
+def _release():
+    # Hand a request's pooled connection back before blocking, so idle clients hold none
+    if has_app_context():
+        db_pool.release_request_connections()
+
+
+def wait_for_changes(since, protocol_id=None, limit=MAX_PAGE_SIZE, wait=0):
+    entries, next_seq = list_changes(since, protocol_id, limit)
+    deadline = time.monotonic() + wait
+    while not entries:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        _release()
+        latest = get_notifier().wait(next_seq, remaining)
+        if latest is not None and latest > next_seq:
+            entries, next_seq = list_changes(next_seq, protocol_id, limit)
+            if not entries:
+                next_seq = max(next_seq, latest)  # only other protocols changed
+    return entries, next_seq
+
+
+async def wait_for_changes_async(since, protocol_id, limit, wait, run):
+    # wait_for_changes on an event loop; run(fn, *args) reads on a request thread
+    entries, next_seq = await run(list_changes, since, protocol_id, limit)
+    deadline = time.monotonic() + wait
+    while not entries:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        latest = await get_notifier().wait_async(next_seq, remaining)
+        if latest is not None and latest > next_seq:
+            entries, next_seq = await run(list_changes, next_seq, protocol_id, limit)
+            if not entries:
+                next_seq = max(next_seq, latest)
+    return entries, next_seq
+
+
+async def poll_async(since, protocol_id, limit, wait, run):
+    # The body of a long-poll /changes answered by asgi.py once something arrives
+    try:
+        entries, next_seq = await wait_for_changes_async(since, protocol_id, limit, wait, run)
+    except ChangesGone:
+        entries, next_seq = [], since  # pruned while waiting: the next poll gets the 410
+    yield dumps({'data': entries, 'next': next_seq}) + '\n'
+
+
+def _events(entries):
+    if not entries:
+        return ': keep-alive\n\n'
+    return ''.join('id: %d\nevent: change\ndata: %s\n\n' % (entry['seq'], dumps(entry)) for entry in entries)
+
+
+def _gone_event(e):
+    return 'event: gone\ndata: %s\n\n' % dumps({'message': str(e)})
+
+
+def iter_events(since, protocol_id=None):
+    # Server-sent events, one per change entry; the event id is its seq. Run outside the
+    # request context, so each batch borrows a pooled connection only while it reads.
+    yield 'retry: 2000\n\n'
+    while True:
+        try:
+            entries, since = wait_for_changes(since, protocol_id, MAX_PAGE_SIZE, HEARTBEAT)
+        except ChangesGone as e:
+            yield _gone_event(e)
+            return
+        yield _events(entries)
+
+
+async def iter_events_async(since, protocol_id, run):
+    yield 'retry: 2000\n\n'
+    while True:
+        try:
+            entries, since = await wait_for_changes_async(since, protocol_id, MAX_PAGE_SIZE, HEARTBEAT, run)
+        except ChangesGone as e:
+            yield _gone_event(e)
+            return
+        yield _events(entries)
+
+
+def changes_delta(since, protocol_id=None, limit=MAX_PAGE_SIZE):
+    # Collapses the next `limit` entries to one per row: the row as it is now, or its
+    # id under deletes when it no longer exists
+    entries, next_seq = list_changes(since, protocol_id, limit)
+    since = next_seq if since is None else since
+    touched = {}
+    for entry in entries:
+        # Version entries (row_id is the version number) are only listed by /changes
+        if entry['table_name'] in TABLES:
+            touched.setdefault(entry['table_name'], set()).add(entry['row_id'])
+    upserts = {}
+    deletes = {}
+    for table, ids in touched.items():
+        rows = REPOSITORIES[table].get_many(ids)
+        if rows:
+            upserts[table] = [row._asdict() for row in rows]
+        gone = sorted(ids - {row.id for row in rows})
+        if gone:
+            deletes[table] = gone
+    return {'since': since, 'next': next_seq, 'more': len(entries) == limit, 'upserts': upserts, 'deletes': deletes}
+
@@ -0,0 +1,80 @@
+import zlib
+
+from flask import request
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+# Response compression negotiated by Accept-Encoding: zstd when the zstandard package
+# is installed and the client accepts it, otherwise gzip. Buffered bodies under
+# MIN_SIZE are sent as they are; streamed bodies (NDJSON, trees) are compressed chunk
+# by chunk, each flushed so clients can decode rows as they arrive.
+
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+def negotiate():
+    # The best encoding the client accepts (q-values honoured), or None for identity
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def _compressor(encoding):
+    # (compress, flush chunk, finish) for one response body
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress(data, encoding):
+    compress_chunk, _, finish = _compressor(encoding)
+    return compress_chunk(data) + finish()
+
+
+def _compressed_stream(chunks, encoding):
+    compress_chunk, flush, finish = _compressor(encoding)
+    for chunk in chunks:
+        if chunk:
+            yield compress_chunk(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + flush()
+    yield finish()
+
+
+def _compressible(response):
+    # direct_passthrough bodies go out untouched, e.g. the change waits asgi.py sends
+    return (response.status_code == 200 and request.method != 'HEAD' and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers
+            and (response.mimetype in COMPRESSIBLE_MIMETYPES or response.mimetype.startswith('text/')))
+
+
+def _after_request(response):
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+    if not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compressed_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    # Register after metrics.init_app: after_request hooks run in reverse order, so the
+    # metrics hook then counts the compressed bytes
+    app.after_request(_after_request)
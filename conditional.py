@@ -0,0 +1,78 @@
+import zlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import g, has_app_context, make_response, request
+
+import sharding
+from compression import negotiate
+from db_pool import get_connection
+
+# Strong ETags for GET routes, derived from the version counters the schema triggers
+# keep in resource_versions (see migrations.py). Validating a request costs one
+# primary-key lookup; a matching If-None-Match is answered 304 before the view runs.
+
+
+def read_version(scope, key):
+    with get_connection() as conn:
+        row = conn.execute("SELECT version, updated_at FROM resource_versions WHERE scope=? AND key=?", (scope, key)).fetchone()
+    return row if row else (0, None)
+
+
+def current_version(scope, key):
+    # The version this request's ETag was computed from, so a body read through the
+    # cache (see cache.py) matches its validator; outside such a request, a fresh read
+    versions = g.get('_resource_versions') if has_app_context() else None
+    if versions is not None and (scope, key) in versions:
+        return versions[scope, key]
+    return read_version(scope, key)[0]
+
+
+def get_version(scope, key):
+    if not sharding.fan_out():
+        return read_version(scope, key)
+    # A collection read across shards changes whenever any shard's counter does
+    versions = sharding.gather(read_version, scope, key)
+    updated = [updated_at for _, updated_at in versions if updated_at]
+    return sum(version for version, _ in versions), max(updated) if updated else None
+
+
+def make_etag(scope, key, version):
+    # Query string, Accept and the negotiated content coding select different
+    # representations of the same version
+    variant = zlib.crc32(('%s|%s|%s' % (request.full_path, request.headers.get('Accept', ''), negotiate())).encode())
+    return '%s-%s-%s-%08x' % (scope, key, version, variant)
+
+
+def _not_modified(etag):
+    # Last-Modified is informational only: at one-second resolution it cannot tell
+    # apart two writes in the same second, so If-Modified-Since never yields a 304
+    return bool(request.if_none_match) and request.if_none_match.contains(etag)
+
+
+def conditional(scope=None, key_arg=None, scope_arg=None):
+    # `scope` (or the URL argument `scope_arg`) names the counter and `key_arg` the URL
+    # argument holding its key; collection routes use the table-wide counter, key 0
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            scope_name = kwargs[scope_arg] if scope_arg else scope
+            key = kwargs[key_arg] if key_arg else 0
+            version, updated_at = get_version(scope_name, key)
+            if not sharding.fan_out():
+                g.setdefault('_resource_versions', {})[scope_name, key] = version
+            etag = make_etag(scope_name, key, version)
+            last_modified = datetime.fromtimestamp(updated_at, timezone.utc) if updated_at else None
+
+            if _not_modified(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return decorator
@@ -1,177 +1,287 @@
 import sqlite3
-from flask import Flask, request, jsonify
-
-DB_NAME = 'protocols_registry.db'
+import sys
+from flask import Flask, Response, request, jsonify, stream_with_context, url_for
+from db_pool import DB_NAME, get_connection, transaction, init_app, pool_stats
+import compression
+import metrics
+import replication
+import sharding
+import serialization
+from migrations import migrate
+from bulk_import import BulkImportError, import_protocol, import_protocols
+from batch import BatchError, apply_batch, parse_operations
+from protocol_tree import iter_protocol_tree_json
+from listing import TABLES, QueryError, list_json, parse_list_query
+from export import NDJSON_MIMETYPE, iter_protocol_ndjson, iter_query_ndjson
+from sharding import ShardingError, for_each_shard
+from repository import PARAMETERS, PROTOCOLS, STEPS, WORKFLOWS
+from cache import cached, cache_stats, invalidate, invalidate_all
+from conditional import conditional
+from write_pipeline import pipelined, pipeline_stats
+from numeric_parameters import find_numeric_parameters, numeric_parameter_stats
+from search import search
+from changes import SSE_MIMETYPE, ChangesGone, changes_delta, iter_events, iter_events_async, parse_changes_query, poll_async, wait_for_changes
+from protocol_versions import VersionNotFound, create_version, diff_versions, get_version, list_versions
+from step_subtree import ProtocolNotFound, StepNotFound, SubtreeError, copy_subtree, delete_subtree, move_subtree, renumber_children
+
+migrate(DB_NAME)
 app = Flask(__name__)
+init_app(app)
+metrics.init_app(app)
+compression.init_app(app)
+replication.init_app(app)
+sharding.init_app(app)
+serialization.init_app(app)
+
+# Steps removed together with the seed rows: their parent_step_id descendants (ON DELETE CASCADE)
+CASCADED_STEPS_SQL = """
+WITH RECURSIVE subtree(id) AS (
+    %s
+    UNION
+    SELECT s.id FROM steps s JOIN subtree t ON s.parent_step_id = t.id
+)
+SELECT s.id, s.protocol_id FROM steps s JOIN subtree USING (id)
+"""
+
+def cascaded_step_keys(cursor, seed_sql, params):
+    cursor.execute(CASCADED_STEPS_SQL % seed_sql, params)
+    rows = cursor.fetchall()
+    return ['step:%s' % id for id, _ in rows] + ['steps_by_protocol:%s' % protocol_id for protocol_id in {protocol_id for _, protocol_id in rows}]
 
 # Create Operations
+@pipelined
 def create_workflow(name):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO workflows (name) VALUES (?)", (name,))
-        conn.commit()
+    return WORKFLOWS.insert(name)._asdict()
 
+@pipelined
 def create_protocol(workflow_id, name, description):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO protocols (workflow_id, name, description) VALUES (?, ?, ?)", (workflow_id, name, description))
-        conn.commit()
+    return PROTOCOLS.insert(workflow_id, name, description)._asdict()
 
+@pipelined
 def create_step(protocol_id, parent_step_id, description, step_order):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO steps (protocol_id, parent_step_id, description, step_order) VALUES (?, ?, ?, ?)", (protocol_id, parent_step_id, description, step_order))
-        conn.commit()
+    return STEPS.insert(protocol_id, parent_step_id, description, step_order)._asdict()
 
+@pipelined
 def create_parameter(step_id, name, value_type, value):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO parameters (step_id, name, value_type, value) VALUES (?, ?, ?, ?)", (step_id, name, value_type, value))
-        conn.commit()
+    return PARAMETERS.insert(step_id, name, value_type, value)._asdict()
 
 # Read Operations
 def get_workflow_by_id(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM workflows WHERE id=?", (id,))
-        return cursor.fetchone()
+    return WORKFLOWS.get(id)
 
+@cached('protocol')
 def get_protocol_by_id(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM protocols WHERE id=?", (id,))
-        return cursor.fetchone()
+    return PROTOCOLS.get(id)
 
+@cached('step')
 def get_step_by_id(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM steps WHERE id=?", (id,))
-        return cursor.fetchone()
+    return STEPS.get(id)
 
 def get_parameter_by_id(id):
-    with sqlite3.connect(DB_NAME) as conn:
+    return PARAMETERS.get(id)
+
+# Hierarchy queries, each one range scan of the step_closure index
+def get_step_descendants(id, max_depth=None):
+    with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM parameters WHERE id=?", (id,))
-        return cursor.fetchone()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT s.*, c.depth FROM step_closure c JOIN steps s ON s.id = c.descendant_id "
+                       "WHERE c.ancestor_id=? AND c.depth BETWEEN 1 AND ? ORDER BY c.depth, s.step_order, s.id",
+                       (id, max_depth if max_depth is not None else sys.maxsize))
+        rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+
+def get_step_ancestors(id):
+    # Root first, i.e. the path from the root down to the step's parent
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT s.*, c.depth FROM step_closure c JOIN steps s ON s.id = c.ancestor_id "
+                       "WHERE c.descendant_id=? AND c.depth > 0 ORDER BY c.depth DESC", (id,))
+        rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+
+def get_step_depth(id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(depth) FROM step_closure WHERE descendant_id=?", (id,))
+        return cursor.fetchone()[0]
 
 # Update Operations
+def as_dict(row):
+    return row._asdict() if row is not None else None
+
+@pipelined
 def update_workflow(id, name):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE workflows SET name=? WHERE id=?", (name, id))
-        conn.commit()
+    return as_dict(WORKFLOWS.update(id, name))
 
+@pipelined
 def update_protocol(id, workflow_id, name, description):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE protocols SET workflow_id=?, name=?, description=? WHERE id=?", (workflow_id, name, description, id))
-        conn.commit()
+    return as_dict(PROTOCOLS.update(id, workflow_id, name, description))
 
+@pipelined
 def update_step(id, protocol_id, parent_step_id, description, step_order):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE steps SET protocol_id=?, parent_step_id=?, description=?, step_order=? WHERE id=?", (protocol_id, parent_step_id, description, step_order, id))
-        conn.commit()
+    return as_dict(STEPS.update(id, protocol_id, parent_step_id, description, step_order))
 
+@pipelined
 def update_parameter(id, step_id, name, value_type, value):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE parameters SET step_id=?, name=?, value_type=?, value=? WHERE id=?", (step_id, name, value_type, value, id))
-        conn.commit()
+    return as_dict(PARAMETERS.update(id, step_id, name, value_type, value))
 
 # Delete Operations
+@pipelined
 def delete_workflow(id):
-    with sqlite3.connect(DB_NAME) as conn:
+    with transaction() as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM workflows WHERE id=?", (id,))
-        conn.commit()
+        keys = cascaded_step_keys(cursor, "SELECT s.id FROM steps s JOIN protocols p ON p.id = s.protocol_id WHERE p.workflow_id = ?", (id,))
+        cursor.execute("SELECT id FROM protocols WHERE workflow_id=?", (id,))
+        keys += ['protocol:%s' % protocol_id for protocol_id, in cursor.fetchall()]
+        WORKFLOWS.delete(id)
+        invalidate(*keys)
 
+@pipelined
 def delete_protocol(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM protocols WHERE id=?", (id,))
-        conn.commit()
+    with transaction() as conn:
+        keys = cascaded_step_keys(conn.cursor(), "SELECT id FROM steps WHERE protocol_id = ?", (id,))
+        PROTOCOLS.delete(id)
+        invalidate('protocol:%s' % id, 'steps_by_protocol:%s' % id, *keys)
 
+@pipelined
 def delete_step(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM steps WHERE id=?", (id,))
-        conn.commit()
+    with transaction() as conn:
+        keys = cascaded_step_keys(conn.cursor(), "SELECT ?", (id,))
+        STEPS.delete(id)
+        invalidate(*keys)
 
+@pipelined
 def delete_parameter(id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM parameters WHERE id=?", (id,))
-        conn.commit()
+    PARAMETERS.delete(id)
 
 def get_all_protocols_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM protocols")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    return [row._asdict() for row in PROTOCOLS.all()]
 
+@pipelined
 def delete_all_steps_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM steps")
-        conn.commit()
+    with transaction():
+        STEPS.delete_all()
+        invalidate_all()  # every cached protocol and step may be gone
 
 
+@pipelined
 def delete_all_protocols_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM protocols")
-        conn.commit()
+    with transaction():
+        PROTOCOLS.delete_all()
+        invalidate_all()  # every cached protocol and step may be gone
 
 
 def get_all_steps():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM steps")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    return [row._asdict() for row in STEPS.all()]
 
 def get_all_parameters_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM parameters")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    return [row._asdict() for row in PARAMETERS.all()]
 
+@cached('steps_by_protocol', 'protocol')
 def get_steps_by_protocol_id(protocol_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM steps WHERE protocol_id=?", (protocol_id,))
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    return [row._asdict() for row in STEPS.find('protocol_id', protocol_id, 'step_order, id')]
 
 # Additional Delete Operation
+@pipelined
 def delete_all_workflows():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM workflows")
-        conn.commit()
+    with transaction():
+        WORKFLOWS.delete_all()
+        invalidate_all()  # every cached protocol and step may be gone
 
+@pipelined
 def delete_all_parameters_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM parameters")
-        conn.commit()
+    PARAMETERS.delete_all()
+
+# The helpers POST /batch applies, with the body fields each create/update takes
+BATCH_WRITERS = {
+    'workflows': (create_workflow, update_workflow, delete_workflow, ('name',)),
+    'protocols': (create_protocol, update_protocol, delete_protocol, ('workflow_id', 'name', 'description')),
+    'steps': (create_step, update_step, delete_step, ('protocol_id', 'parent_step_id', 'description', 'step_order')),
+    'parameters': (create_parameter, update_parameter, delete_parameter, ('step_id', 'name', 'value_type', 'value')),
+}
 
 # API endpoints
 
+@app.errorhandler(sqlite3.IntegrityError)
+def handle_integrity_error(e):
+    # e.g. a workflow_id, protocol_id, parent_step_id or step_id that does not exist
+    return jsonify({"message": "Constraint violated: %s" % e}), 409
+
+@app.errorhandler(SubtreeError)
+def handle_subtree_error(e):
+    return jsonify({"message": str(e)}), 404 if isinstance(e, (StepNotFound, ProtocolNotFound)) else 400
+
+@app.errorhandler(ShardingError)
+def handle_sharding_error(e):
+    return jsonify({"message": str(e)}), 400
+
+@app.errorhandler(BatchError)
+def handle_batch_error(e):
+    # The whole batch was rolled back; index points at the operation that failed
+    return jsonify({"message": str(e), "index": e.index}), e.status
+
+@app.errorhandler(VersionNotFound)
+def handle_version_not_found(e):
+    return jsonify({"message": str(e)}), 404
+
+def revalidated(response):
+    # A version never changes, but its URL can name a different one later: protocol ids
+    # may be reused once deleted, taking their versions with them. So caches keep the
+    # body under an ETag of its content and revalidate it instead of trusting it forever.
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.add_etag(weak=True)  # weak: compression.py may re-encode the body
+    return response.make_conditional(request)
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def ndjson_response(chunks):
+    return Response(stream_with_context(chunks), mimetype=NDJSON_MIMETYPE)
+
+def list_response(table, not_found_message):
+    try:
+        query = parse_list_query(table, request.args)
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+    if wants_ndjson():
+        return ndjson_response(sharding.iter_ndjson(query) if sharding.fan_out() else iter_query_ndjson(query)), 200
+    body, count = sharding.list_json(query) if sharding.fan_out() else list_json(query)
+    if count or query.paginated:
+        return Response(body, mimetype='application/json'), 200
+    else:
+        return jsonify({"message": not_found_message}), 404
+
+def wants_minimal():
+    # RFC 7240: "Prefer: return=minimal" asks for a short confirmation instead of the row
+    return any(token.strip().lower() == 'return=minimal' for token in request.headers.get('Prefer', '').split(','))
+
+def write_response(row, endpoint, message, not_found_message, status=200):
+    # POST/PUT answer with the row as written (RETURNING), so clients skip the follow-up GET
+    if row is None:
+        return jsonify({"message": not_found_message}), 404
+    if wants_minimal():
+        response = jsonify({"message": message, "id": row['id']})
+        response.headers['Preference-Applied'] = 'return=minimal'
+    else:
+        response = jsonify(row)
+    location = url_for(endpoint, id=row['id'])
+    if status == 201:
+        response.headers['Location'] = location
+    else:
+        response.headers['Content-Location'] = location
+    response.headers['Vary'] = 'Prefer'
+    return response, status
+
 @app.route('/workflows', methods=['POST'])
 def add_workflow():
     name = request.json.get('name')
-    create_workflow(name)
-    return jsonify({"message": "Workflow created successfully!"}), 201
+    row = create_workflow(name)
+    return write_response(row, 'get_a_workflow', "Workflow created successfully!", None, 201)
 
 @app.route('/workflows/<int:id>', methods=['GET'])
+@conditional('workflow', 'id')
 def get_a_workflow(id):
     workflow = get_workflow_by_id(id)
     if workflow:
@@ -180,27 +290,19 @@ def get_a_workflow(id):
         return jsonify({"message": "Workflow not found!"}), 404
 
 @app.route('/workflows', methods=['GET'])
+@conditional('workflows')
 def fetch_all_workflows():  # Renamed to avoid name conflict
-    workflows = get_all_workflows_db()
-    if workflows:
-        return jsonify(workflows), 200
-    else:
-        return jsonify({"message": "No workflows found!"}), 404
+    return list_response('workflows', "No workflows found!")
 
 def get_all_workflows_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.row_factory = sqlite3.Row  # This allows you to return rows as dictionaries
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM workflows")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]  # Convert rows to dictionaries
+    return [row._asdict() for row in WORKFLOWS.all()]
 
 
 @app.route('/workflows/<int:id>', methods=['PUT'])
 def modify_workflow(id):
     name = request.json.get('name')
-    update_workflow(id, name)
-    return jsonify({"message": "Workflow updated successfully!"}), 200
+    row = update_workflow(id, name)
+    return write_response(row, 'get_a_workflow', "Workflow updated successfully!", "Workflow not found!")
 
 @app.route('/workflows/<int:id>', methods=['DELETE'])
 def remove_workflow(id):
@@ -209,11 +311,12 @@ def remove_workflow(id):
 
 @app.route('/workflows', methods=['DELETE'])
 def remove_all_workflows():
-    delete_all_workflows()
+    for_each_shard(delete_all_workflows)
     return jsonify({"message": "All workflows deleted successfully!"}), 200
 
 
 @app.route('/protocols/<int:id>', methods=['GET'])
+@conditional('protocol', 'id')
 def get_a_protocol(id):
     protocol = get_protocol_by_id(id)
     if protocol:
@@ -221,17 +324,42 @@ def get_a_protocol(id):
     else:
         return jsonify({"message": "Protocol not found!"}), 404
 
+@app.route('/protocols/<int:id>/tree', methods=['GET'])
+@conditional('protocol', 'id')
+def get_a_protocol_tree(id):
+    protocol = get_protocol_by_id(id)
+    if protocol:
+        return Response(stream_with_context(iter_protocol_tree_json(protocol)), mimetype='application/json'), 200
+    else:
+        return jsonify({"message": "Protocol not found!"}), 404
+
+@app.route('/protocols/<int:id>/versions', methods=['POST'])
+def add_protocol_version(id):
+    result = create_version(id, (request.get_json(silent=True) or {}).get('message'))
+    return jsonify(result), 201, {'Location': url_for('get_a_protocol_version', id=id, version=result['version'])}
+
+@app.route('/protocols/<int:id>/versions', methods=['GET'])
+def get_protocol_versions(id):
+    if get_protocol_by_id(id) is None:
+        return jsonify({"message": "Protocol not found!"}), 404
+    return jsonify(list_versions(id)), 200
+
+@app.route('/protocols/<int:id>/versions/<int:version>', methods=['GET'])
+def get_a_protocol_version(id, version):
+    return revalidated(jsonify(get_version(id, version)))
+
+@app.route('/protocols/<int:id>/versions/<int:version>/diff/<int:other>', methods=['GET'])
+def diff_protocol_versions(id, version, other):
+    return revalidated(jsonify(diff_versions(id, version, other)))
+
 @app.route('/protocols', methods=['GET'])
+@conditional('protocols')
 def get_all_protocols():
-    protocols = get_all_protocols_db()
-    if protocols:
-        return jsonify(protocols), 200
-    else:
-        return jsonify({"message": "No protocols found!"}), 404
+    return list_response('protocols', "No protocols found!")
 
 @app.route('/protocols', methods=['DELETE'])
 def delete_all_protocols():
-    delete_all_protocols_db()
+    for_each_shard(delete_all_protocols_db)
     return jsonify({"message": "All protocols deleted successfully!"}), 200
 
 @app.route('/protocols/<int:id>', methods=['PUT'])
@@ -239,8 +367,8 @@ def modify_protocol(id):
     workflow_id = request.json.get('workflow_id')
     name = request.json.get('name')
     description = request.json.get('description')
-    update_protocol(id, workflow_id, name, description)
-    return jsonify({"message": "Protocol updated successfully!"}), 200
+    row = update_protocol(id, workflow_id, name, description)
+    return write_response(row, 'get_a_protocol', "Protocol updated successfully!", "Protocol not found!")
 
 @app.route('/protocols/<int:id>', methods=['DELETE'])
 def remove_protocol(id):
@@ -248,6 +376,7 @@ def remove_protocol(id):
     return jsonify({"message": "Protocol deleted successfully!"}), 200
 
 @app.route('/steps/<int:id>', methods=['GET'])
+@conditional('step', 'id')
 def get_a_step(id):
     step = get_step_by_id(id)
     if step:
@@ -256,16 +385,13 @@ def get_a_step(id):
         return jsonify({"message": "Step not found!"}), 404
 
 @app.route('/steps', methods=['GET'])
-def get_all_steps():
-    steps = get_all_steps()
-    if steps:
-        return jsonify(steps), 200
-    else:
-        return jsonify({"message": "No steps found!"}), 404
+@conditional('steps')
+def fetch_all_steps():  # Renamed so it no longer shadows the get_all_steps() helper
+    return list_response('steps', "No steps found!")
 
 @app.route('/steps', methods=['DELETE'])
 def delete_all_steps():
-    delete_all_steps_db()
+    for_each_shard(delete_all_steps_db)
     return jsonify({"message": "All steps deleted successfully!"}), 200
 
 @app.route('/steps/<int:id>', methods=['PUT'])
@@ -274,15 +400,65 @@ def modify_step(id):
     parent_step_id = request.json.get('parent_step_id')
     description = request.json.get('description')
     step_order = request.json.get('step_order')
-    update_step(id, protocol_id, parent_step_id, description, step_order)
-    return jsonify({"message": "Step updated successfully!"}), 200
+    row = update_step(id, protocol_id, parent_step_id, description, step_order)
+    return write_response(row, 'get_a_step', "Step updated successfully!", "Step not found!")
 
 @app.route('/steps/<int:id>', methods=['DELETE'])
 def remove_step(id):
     delete_step(id)
     return jsonify({"message": "Step deleted successfully!"}), 200
 
+@app.route('/steps/<int:id>/descendants', methods=['GET'])
+@conditional('steps')
+def get_a_step_descendants(id):
+    if get_step_by_id(id) is None:
+        return jsonify({"message": "Step not found!"}), 404
+    return jsonify(get_step_descendants(id, request.args.get('max_depth', type=int))), 200
+
+@app.route('/steps/<int:id>/ancestors', methods=['GET'])
+@conditional('steps')
+def get_a_step_ancestors(id):
+    if get_step_by_id(id) is None:
+        return jsonify({"message": "Step not found!"}), 404
+    return jsonify(get_step_ancestors(id)), 200
+
+@app.route('/steps/<int:id>/depth', methods=['GET'])
+@conditional('steps')
+def get_a_step_depth(id):
+    depth = get_step_depth(id)
+    if depth is None:
+        return jsonify({"message": "Step not found!"}), 404
+    return jsonify({"id": id, "depth": depth}), 200
+
+@app.route('/steps/<int:id>/move', methods=['POST'])
+def move_step_subtree(id):
+    body = request.json or {}
+    result = move_subtree(id, body.get('parent_step_id'), body.get('protocol_id'), body.get('step_order'))
+    return jsonify(result), 200
+
+@app.route('/steps/<int:id>/copy', methods=['POST'])
+def copy_step_subtree(id):
+    body = request.json or {}
+    result = copy_subtree(id, body.get('protocol_id'), body.get('parent_step_id'), body.get('step_order'))
+    return jsonify(result), 201, {'Location': url_for('get_a_step', id=result['id'])}
+
+@app.route('/steps/<int:id>/renumber', methods=['POST'])
+def renumber_step_children(id):
+    order = renumber_children(parent_step_id=id, order=(request.get_json(silent=True) or {}).get('order'))
+    return jsonify({"order": order}), 200
+
+@app.route('/protocols/<int:id>/renumber', methods=['POST'])
+def renumber_protocol_steps(id):
+    order = renumber_children(protocol_id=id, order=(request.get_json(silent=True) or {}).get('order'))
+    return jsonify({"order": order}), 200
+
+@app.route('/steps/<int:id>/subtree', methods=['DELETE'])
+def remove_step_subtree(id):
+    deleted = delete_subtree(id)
+    return jsonify({"message": "Step subtree deleted successfully!", "deleted": deleted}), 200
+
 @app.route('/steps/protocol_id/<int:protocol_id>', methods=['GET'])
+@conditional('protocol', 'protocol_id')
 def get_steps_by_protocol(protocol_id):
     steps = get_steps_by_protocol_id(protocol_id)
     if steps:
@@ -291,6 +467,7 @@ def get_steps_by_protocol(protocol_id):
         return jsonify({"message": "No steps found for this protocol!"}), 404
 
 @app.route('/parameters/<int:id>', methods=['GET'])
+@conditional('parameter', 'id')
 def get_a_parameter(id):
     parameter = get_parameter_by_id(id)
     if parameter:
@@ -299,16 +476,33 @@ def get_a_parameter(id):
         return jsonify({"message": "Parameter not found!"}), 404
 
 @app.route('/parameters', methods=['GET'])
+@conditional('parameters')
 def get_all_parameters():
-    parameters = get_all_parameters_db()
-    if parameters:
-        return jsonify(parameters), 200
-    else:
-        return jsonify({"message": "No parameters found!"}), 404
+    return list_response('parameters', "No parameters found!")
+
+@app.route('/parameters/numeric', methods=['GET'])
+@conditional('parameters')
+def get_numeric_parameters():
+    try:
+        if sharding.fan_out():
+            return jsonify(sharding.merged_numeric_parameters(find_numeric_parameters, request.args)), 200
+        return jsonify(find_numeric_parameters(request.args)), 200
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+
+@app.route('/parameters/numeric/stats', methods=['GET'])
+@conditional('parameters')
+def get_numeric_parameter_stats():
+    try:
+        if sharding.fan_out():
+            return jsonify(sharding.merged_numeric_stats(numeric_parameter_stats, request.args)), 200
+        return jsonify(numeric_parameter_stats(request.args)), 200
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
 
 @app.route('/parameters', methods=['DELETE'])
 def delete_all_parameters():
-    delete_all_parameters_db()
+    for_each_shard(delete_all_parameters_db)
     return jsonify({"message": "All parameters deleted successfully!"}), 200
 
 
@@ -318,8 +512,8 @@ def modify_parameter(id):
     name = request.json.get('name')
     value_type = request.json.get('value_type')
     value = request.json.get('value')
-    update_parameter(id, step_id, name, value_type, value)
-    return jsonify({"message": "Parameter updated successfully!"}), 200
+    row = update_parameter(id, step_id, name, value_type, value)
+    return write_response(row, 'get_a_parameter', "Parameter updated successfully!", "Parameter not found!")
 
 @app.route('/parameters/<int:id>', methods=['DELETE'])
 def remove_parameter(id):
@@ -331,8 +525,20 @@ def add_protocol():
     workflow_id = request.json.get('workflow_id')
     name = request.json.get('name')
     description = request.json.get('description')
-    create_protocol(workflow_id, name, description)
-    return jsonify({"message": "Protocol created successfully!"}), 201
+    row = create_protocol(workflow_id, name, description)
+    return write_response(row, 'get_a_protocol', "Protocol created successfully!", None, 201)
+
+@app.route('/protocols/bulk', methods=['POST'])
+def add_protocols_bulk():
+    document = request.json
+    try:
+        if isinstance(document, list):
+            result = import_protocols(document)
+        else:
+            result = import_protocol(document)
+    except BulkImportError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify(result), 201
 
 @app.route('/steps', methods=['POST'])
 def add_step():
@@ -340,8 +546,8 @@ def add_step():
     parent_step_id = request.json.get('parent_step_id')
     description = request.json.get('description')
     step_order = request.json.get('step_order')
-    create_step(protocol_id, parent_step_id, description, step_order)
-    return jsonify({"message": "Step created successfully!"}), 201
+    row = create_step(protocol_id, parent_step_id, description, step_order)
+    return write_response(row, 'get_a_step', "Step created successfully!", None, 201)
 
 @app.route('/parameters', methods=['POST'])
 def add_parameter():
@@ -349,9 +555,135 @@ def add_parameter():
     name = request.json.get('name')
     value_type = request.json.get('value_type')
     value = request.json.get('value')
-    create_parameter(step_id, name, value_type, value)
-    return jsonify({"message": "Parameter created successfully!"}), 201
+    row = create_parameter(step_id, name, value_type, value)
+    return write_response(row, 'get_a_parameter', "Parameter created successfully!", None, 201)
+
+@app.route('/batch', methods=['POST'])
+def apply_write_batch():
+    operations = parse_operations(request.get_json(silent=True), list(BATCH_WRITERS))
+    results = apply_batch(operations, BATCH_WRITERS)
+    minimal = wants_minimal()
+    if minimal:
+        for result in results:
+            result.pop('row', None)
+    response = jsonify({"message": "Batch applied successfully!", "results": results})
+    if minimal:
+        response.headers['Preference-Applied'] = 'return=minimal'
+    response.headers['Vary'] = 'Prefer'
+    return response, 200
+
+@app.route('/export/<table>', methods=['GET'])
+@conditional(scope_arg='table')
+def export_table(table):
+    if table not in TABLES:
+        return jsonify({"message": "Unknown table!"}), 404
+    try:
+        query = parse_list_query(table, request.args)
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+    return ndjson_response(sharding.iter_ndjson(query) if sharding.fan_out() else iter_query_ndjson(query)), 200
+
+@app.route('/export/protocols/<int:id>', methods=['GET'])
+@conditional('protocol', 'id')
+def export_protocol(id):
+    if not get_protocol_by_id(id):
+        return jsonify({"message": "Protocol not found!"}), 404
+    return ndjson_response(iter_protocol_ndjson(id)), 200
+
+@app.route('/search', methods=['GET'])
+def search_registry():
+    try:
+        if sharding.fan_out():
+            hits, next_offset = sharding.merged_search(search, request.args)
+        else:
+            hits, next_offset = search(request.args)
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"data": hits, "next": next_offset}), 200
+
+@app.errorhandler(ChangesGone)
+def handle_changes_gone(e):
+    return jsonify({"message": str(e)}), 410
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    try:
+        since, protocol_id, limit, wait = parse_changes_query(request.args, request.headers.get('Last-Event-ID'))
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+    # Under asgi.py, waits happen on its event loop instead of a bounded request thread:
+    # the route hands over an async body, and the WSGI one is never read. The adapter
+    # sends that body as it is, so the response is marked to skip compression.
+    defer = request.environ.get('protocol_registry.defer')
+    if request.accept_mimetypes.best_match(['application/json', SSE_MIMETYPE]) == SSE_MIMETYPE:
+        # Not bound to the request context: the stream outlives it and borrows a
+        # connection only for each read
+        response = Response(iter_events(since, protocol_id), mimetype=SSE_MIMETYPE)
+        response.headers['Cache-Control'] = 'no-cache'
+        if defer is not None:
+            defer(lambda run: iter_events_async(since, protocol_id, run))
+            response.direct_passthrough = True
+        return response
+    entries, next_seq = wait_for_changes(since, protocol_id, limit, 0 if defer is not None else wait)
+    if not entries and wait and defer is not None:
+        defer(lambda run: poll_async(next_seq, protocol_id, limit, wait, run))
+        return Response(iter(()), mimetype='application/json', direct_passthrough=True)
+    return jsonify({"data": entries, "next": next_seq}), 200
+
+@app.route('/changes/delta', methods=['GET'])
+def get_changes_delta():
+    try:
+        since, protocol_id, limit, _ = parse_changes_query(request.args)
+    except QueryError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify(changes_delta(since, protocol_id, limit)), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(cache_stats()), 200
+
+@app.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(pool_stats()), 200
+
+@app.route('/replication/stats', methods=['GET'])
+def get_replication_stats():
+    return jsonify(replication.replication_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/metrics/config', methods=['GET', 'PUT'])
+def metrics_config():
+    if request.method == 'PUT':
+        body = request.get_json(silent=True) or {}
+        slow_query_ms = body.get('slow_query_ms')
+        if slow_query_ms is not None and (not isinstance(slow_query_ms, (int, float)) or isinstance(slow_query_ms, bool)):
+            return jsonify({"message": "'slow_query_ms' must be a number"}), 400
+        enabled = body.get('enabled', metrics.enabled())
+        if not isinstance(enabled, bool):
+            return jsonify({"message": "'enabled' must be true or false"}), 400
+        if enabled:
+            metrics.enable(slow_query_ms / 1000 if slow_query_ms is not None else None)
+        else:
+            metrics.disable()
+    return jsonify(metrics.config()), 200
+
+@app.route('/metrics/slow_queries', methods=['GET'])
+def get_slow_queries():
+    return jsonify(list(metrics.slow_queries)), 200
+
+@app.route('/pipeline/stats', methods=['GET'])
+def get_pipeline_stats():
+    return jsonify(pipeline_stats()), 200
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # Production serving goes through asgi.py (ASGI server, bounded database thread pool);
+    # `python crud_db.py --dev` still starts the single-process Werkzeug debug server.
+    if '--dev' in sys.argv[1:]:
+        app.run(debug=True)
+    else:
+        from asgi import main
+        main(sys.argv[1:])
\ No newline at end of file
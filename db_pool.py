@@ -0,0 +1,411 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+DB_NAME = 'protocols_registry.db'
+POOL_SIZE = 5
+POOL_TIMEOUT = 30            # seconds to wait for a free connection
+HEALTH_CHECK_INTERVAL = 30   # idle seconds after which a connection is pinged before reuse
+STATEMENT_CACHE_SIZE = 256   # prepared statements kept per connection (sqlite3 defaults to 128)
+
+# Storage profiles: the PRAGMAs every connection gets when it opens. foreign_keys is
+# always switched on on top of the profile so ON DELETE CASCADE actually fires.
+# journal_mode=WAL lets readers run alongside the single writer; it is a property of
+# the database file, so the read-replica profile leaves it to whoever writes the file.
+STORAGE_PROFILES = {
+    'durable': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,       # KiB
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+    'throughput': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',    # durable across crashes of the process, not of the OS
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    'read-replica': {
+        'busy_timeout': 5000,
+        'journal_mode': None,
+        'synchronous': 'OFF',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'query_only': 'ON',
+    },
+}
+STORAGE_PROFILE = 'durable'
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def apply_profile(conn, profile=None):
+    settings = STORAGE_PROFILES[profile or STORAGE_PROFILE]
+    for pragma, value in settings.items():
+        if value is not None:
+            conn.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+    conn.execute("PRAGMA foreign_keys = ON")
+
+
+def open_connection(db_name=None, profile=None, **kwargs):
+    conn = sqlite3.connect(db_name or DB_NAME, **kwargs)
+    apply_profile(conn, profile)
+    return conn
+
+
+# Cursor class handed out by pooled connections; metrics.py swaps in a timing cursor
+# while instrumentation is switched on
+cursor_factory = sqlite3.Cursor
+
+
+class PooledConnection(sqlite3.Connection):
+    # sqlite3.Connection has no __dict__, the subclass lets us keep bookkeeping on it
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transaction_depth = 0
+        self.commit_callbacks = []
+        self.last_used = time.monotonic()
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or cursor_factory)
+
+    # Connection.execute()/executemany() do not go through cursor(), so route them there
+    # only while a different cursor class is installed
+    def execute(self, sql, parameters=()):
+        if cursor_factory is sqlite3.Cursor:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        if cursor_factory is sqlite3.Cursor:
+            return super().executemany(sql, parameters)
+        return self.cursor().executemany(sql, parameters)
+
+
+class ConnectionPool:
+    def __init__(self, db_name, size=POOL_SIZE, timeout=POOL_TIMEOUT, profile=None):
+        self.db_name = db_name
+        self.profile = profile or STORAGE_PROFILE
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._counters = {
+            'created': 0,
+            'acquired': 0,
+            'released': 0,
+            'reconnects': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'peak_in_use': 0,
+            'wait_seconds': 0.0,
+        }
+
+    def connect(self):
+        conn = open_connection(self.db_name, self.profile, check_same_thread=False, factory=PooledConnection,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        with self._cond:
+            self._counters['created'] += 1
+        return conn
+
+    def acquire(self):
+        deadline = None
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool for %s is closed" % self.db_name)
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    conn = None
+                    break
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = started + self.timeout
+                    self._counters['waits'] += 1
+                if now >= deadline:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout("Timed out waiting for a connection to %s" % self.db_name)
+                self._cond.wait(deadline - now)
+            if deadline is not None:
+                self._counters['wait_seconds'] += time.monotonic() - started
+            self._in_use += 1
+            self._counters['acquired'] += 1
+            self._counters['peak_in_use'] = max(self._counters['peak_in_use'], self._in_use)
+
+        try:
+            if conn is None:
+                conn = self.connect()
+            else:
+                conn = self._ensure_healthy(conn)
+        except BaseException:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        try:
+            if not discard and conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            discard = True
+        conn.transaction_depth = 0
+        conn.commit_callbacks = []
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            self._counters['released'] += 1
+            if discard or self._closed:
+                self._open -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+        if discard or self._closed:
+            conn.close()
+
+    def _ensure_healthy(self, conn):
+        if time.monotonic() - conn.last_used < HEALTH_CHECK_INTERVAL:
+            return conn
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return conn
+        except sqlite3.Error:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            with self._cond:
+                self._counters['reconnects'] += 1
+            return self.connect()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'db_name': self.db_name,
+                'profile': self.profile,
+                'size': self.size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'utilization': self._in_use / self.size if self.size else 0.0,
+            })
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_size = POOL_SIZE
+_pool_profiles = {}  # storage profile per database file, when not the default
+_local = threading.local()
+
+
+def configure(db_name=None, pool_size=None, profile=None):
+    global DB_NAME, STORAGE_PROFILE, _pool_size
+    if profile is not None and profile not in STORAGE_PROFILES:
+        raise ValueError("Unknown storage profile '%s'" % profile)
+    if db_name is not None:
+        DB_NAME = db_name
+    if pool_size is not None:
+        _pool_size = pool_size
+    if profile is not None:
+        STORAGE_PROFILE = profile
+    close_all()
+
+
+def get_pool(db_name=None):
+    db_name = db_name or DB_NAME
+    pool = _pools.get(db_name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_name)
+            if pool is None:
+                pool = _pools[db_name] = ConnectionPool(db_name, size=_pool_size, profile=_pool_profiles.get(db_name))
+    return pool
+
+
+def reset_pool(db_name, profile=None):
+    # Closes db_name's pool so the next get_pool() connects afresh, e.g. after the file
+    # was replaced; connections still in use are closed as they are released
+    if profile is not None:
+        _pool_profiles[db_name] = profile
+    with _pools_lock:
+        pool = _pools.pop(db_name, None)
+    if pool is not None:
+        pool.close()
+
+
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def pool_stats():
+    return {name: pool.stats() for name, pool in list(_pools.items())}
+
+
+def route_database(db_name, replica=False):
+    # Points this request's connections (outside a request: this thread's) at another
+    # database file, a shard or a read-only replica
+    if has_app_context():
+        g._db_route = db_name
+        g._db_route_replica = replica
+    else:
+        _local.route = db_name
+        _local.route_replica = replica
+
+
+def routed_database():
+    # The file this request or thread was routed to, or None for the main database
+    if has_app_context():
+        return g.get('_db_route')
+    return getattr(_local, 'route', None)
+
+
+def reading_replica():
+    # Whether reads go to a replica, which may lag writes already seen elsewhere
+    if has_app_context():
+        return g.get('_db_route_replica', False)
+    return getattr(_local, 'route_replica', False)
+
+
+@contextmanager
+def routed(db_name):
+    # Temporarily route this request to db_name
+    previous = routed_database(), reading_replica()
+    route_database(db_name)
+    try:
+        yield
+    finally:
+        route_database(*previous)
+
+
+def _database(db_name):
+    return db_name or routed_database() or DB_NAME
+
+
+@contextmanager
+def get_connection(db_name=None):
+    db_name = _database(db_name)
+    if has_app_context():
+        # One connection per database for the whole request, handed back on teardown
+        conns = g.setdefault('_db_conns', {})
+        if db_name not in conns:
+            pool = get_pool(db_name)
+            conns[db_name] = (pool, pool.acquire())
+        yield conns[db_name][1]
+        return
+
+    # Outside Flask the outermost block on this thread owns the connection, so nested
+    # helpers (and nested transaction() blocks) share it
+    held = getattr(_local, 'conns', None)
+    if held is None:
+        held = _local.conns = {}
+    if db_name in held:
+        yield held[db_name]
+        return
+    pool = get_pool(db_name)
+    conn = held[db_name] = pool.acquire()
+    try:
+        yield conn
+    finally:
+        del held[db_name]
+        pool.release(conn)
+
+
+def current_connection(db_name=None):
+    # The connection this request or thread is already holding, if any
+    db_name = _database(db_name)
+    if has_app_context():
+        held = g.get('_db_conns')
+        return held[db_name][1] if held and db_name in held else None
+    held = getattr(_local, 'conns', None)
+    return held.get(db_name) if held else None
+
+
+def in_transaction(db_name=None):
+    conn = current_connection(db_name)
+    return conn is not None and (conn.transaction_depth > 0 or conn.in_transaction)
+
+
+def on_commit(callback, db_name=None):
+    # Runs callback once the surrounding transaction commits (dropped on rollback),
+    # or right away when no transaction is open
+    conn = current_connection(db_name)
+    if conn is not None and conn.transaction_depth:
+        conn.commit_callbacks.append(callback)
+    else:
+        callback()
+
+
+@contextmanager
+def transaction(db_name=None, immediate=False):
+    # Nested transaction() blocks join the outermost one, which alone commits or rolls back
+    with get_connection(db_name) as conn:
+        if conn.transaction_depth:
+            conn.transaction_depth += 1
+            try:
+                yield conn
+            finally:
+                conn.transaction_depth -= 1
+            return
+
+        conn.transaction_depth = 1
+        try:
+            if immediate and not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+            callbacks, conn.commit_callbacks = conn.commit_callbacks, []
+            for callback in callbacks:
+                callback()
+        finally:
+            conn.transaction_depth = 0
+            conn.commit_callbacks = []
+
+
+def release_request_connections(exc=None):
+    conns = g.pop('_db_conns', None)
+    if not conns:
+        return
+    for pool, conn in conns.values():
+        pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(release_request_connections)
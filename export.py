@@ -0,0 +1,81 @@
+from db_pool import get_connection
+from listing import TABLES
+from serialization import dumps
+
+# Newline-delimited JSON straight off the SQLite cursor: rows are fetched in batches
+# and written out as they arrive, so memory stays flat whatever the table size.
+NDJSON_MIMETYPE = 'application/x-ndjson'
+FETCH_SIZE = 500
+FLUSH_SIZE = 64 * 1024
+
+
+def _iter_lines(cursor, wrap=None):
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        lines = []
+        for row in rows:
+            row = dict(zip(columns, row))
+            lines.append(dumps(wrap(row) if wrap else row))
+        lines.append('')
+        yield '\n'.join(lines)
+
+
+def _buffered(chunks):
+    # The first batch goes out immediately for a fast first byte; later ones are coalesced
+    buffer = []
+    size = 0
+    first = True
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if first or size >= FLUSH_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+            first = False
+    if buffer:
+        yield ''.join(buffer)
+
+
+def iter_rows_ndjson(columns, rows):
+    # Rows from any iterable, e.g. several cursors merged in key order
+    def lines():
+        batch = []
+        for row in rows:
+            batch.append(dumps(dict(zip(columns, row))))
+            if len(batch) == FETCH_SIZE:
+                yield '\n'.join(batch) + '\n'
+                batch = []
+        if batch:
+            yield '\n'.join(batch) + '\n'
+    return _buffered(lines())
+
+
+def iter_query_ndjson(query):
+    sql, params = query.sql()
+    with get_connection() as conn:
+        yield from _buffered(_iter_lines(conn.execute(sql, params)))
+
+
+def iter_protocol_ndjson(protocol_id):
+    # One line per row, tagged with its table: the protocol, its steps, then their parameters
+    def tagged(table):
+        return lambda row: {'table': table, 'row': row}
+
+    def chunks(conn):
+        yield from _iter_lines(conn.execute(
+            "SELECT %s FROM protocols WHERE id=?" % ', '.join(TABLES['protocols']['columns']),
+            (protocol_id,)), tagged('protocols'))
+        yield from _iter_lines(conn.execute(
+            "SELECT %s FROM steps WHERE protocol_id=? ORDER BY step_order, id" % ', '.join(TABLES['steps']['columns']),
+            (protocol_id,)), tagged('steps'))
+        yield from _iter_lines(conn.execute(
+            "SELECT %s FROM parameters p WHERE p.step_id IN (SELECT id FROM steps WHERE protocol_id=?) ORDER BY p.step_id, p.id"
+            % ', '.join('p.' + column for column in TABLES['parameters']['columns']),
+            (protocol_id,)), tagged('parameters'))
+
+    with get_connection() as conn:
+        yield from _buffered(chunks(conn))
@@ -0,0 +1,138 @@
+from db_pool import get_connection
+from serialization import dumps
+
+# Collection queries: keyset pagination on id (?limit=&after=), field projection
+# (?fields=id,name) and equality filters (?step_id=&name=...). Every filter column
+# is the leading column of an index (see migrations.py). ?shape=columnar returns the
+# column names once and each row as an array: {"columns": [...], "rows": [[...]], "next": ...}
+TABLES = {
+    'workflows': {
+        'columns': ('id', 'name'),
+        'filters': {'name': str},
+    },
+    'protocols': {
+        'columns': ('id', 'workflow_id', 'name', 'description'),
+        'filters': {'workflow_id': int, 'name': str},
+    },
+    'steps': {
+        'columns': ('id', 'protocol_id', 'parent_step_id', 'description', 'step_order'),
+        'filters': {'protocol_id': int, 'parent_step_id': int},
+    },
+    'parameters': {
+        'columns': ('id', 'step_id', 'name', 'value_type', 'value'),
+        'filters': {'step_id': int, 'name': str, 'value_type': str},
+    },
+}
+
+MAX_PAGE_SIZE = 1000
+SHAPES = ('objects', 'columnar')
+
+
+class QueryError(ValueError):
+    pass
+
+
+class ListQuery:
+    __slots__ = ('table', 'fields', 'filters', 'after', 'limit', 'shape')
+
+    def __init__(self, table, fields=None, filters=None, after=None, limit=None, shape='objects'):
+        self.table = table
+        self.fields = fields or TABLES[table]['columns']
+        self.filters = filters or {}
+        self.after = after
+        self.limit = limit
+        self.shape = shape
+
+    @property
+    def paginated(self):
+        return self.limit is not None or self.after is not None
+
+    def sql(self):
+        clauses = ["%s=?" % column for column in self.filters]
+        params = list(self.filters.values())
+        if self.after is not None:
+            clauses.append("id>?")
+            params.append(self.after)
+        sql = "SELECT %s FROM %s" % (', '.join(self.fields), self.table)
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+        if self.limit is not None:
+            sql += " LIMIT ?"
+            params.append(self.limit)
+        return sql, params
+
+    def row_json(self):
+        if self.shape == 'columnar':
+            return "json_array(%s)" % ', '.join(self.fields)
+        return "json_object(%s)" % ', '.join("'%s', %s" % (field, field) for field in self.fields)
+
+    def json_sql(self):
+        # SQLite encodes the whole page as one JSON array, so no Python object is built
+        # per row; the aggregate keeps the ordered subquery's row order
+        sql, params = self.sql()
+        return "SELECT json_group_array(%s), COUNT(*), MAX(id) FROM (%s)" % (self.row_json(), sql), params
+
+    def rows_sql(self):
+        # (id, row as JSON text) per row, for merging pages from several databases
+        sql, params = self.sql()
+        return "SELECT id, %s FROM (%s)" % (self.row_json(), sql), params
+
+
+def parse_int(name, value, low=None, high=None):
+    # A query string integer, optionally bounded; shared by every route's query parsing
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise QueryError("'%s' must be an integer" % name)
+    if low is not None and not low <= value <= high:
+        raise QueryError("'%s' must be between %d and %d" % (name, low, high))
+    return value
+
+
+def parse_list_query(table, args):
+    spec = TABLES[table]
+    fields = None
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in spec['columns']]
+        if unknown:
+            raise QueryError("Unknown field(s) for %s: %s" % (table, ', '.join(unknown)))
+        if 'id' not in fields:
+            fields.insert(0, 'id')  # the pagination key is always returned
+
+    filters = {}
+    for column, convert in spec['filters'].items():
+        if column in args:
+            filters[column] = parse_int(column, args[column]) if convert is int else args[column]
+
+    after = parse_int('after', args['after']) if args.get('after') else None
+    limit = None
+    if args.get('limit'):
+        limit = parse_int('limit', args['limit'], 1, MAX_PAGE_SIZE)
+    elif after is not None:
+        limit = MAX_PAGE_SIZE
+    shape = args.get('shape') or 'objects'
+    if shape not in SHAPES:
+        raise QueryError("'shape' must be one of %s" % ', '.join(SHAPES))
+    return ListQuery(table, fields, filters, after, limit, shape)
+
+
+def list_json(query):
+    # The response body as JSON text, plus the number of rows in it
+    sql, params = query.json_sql()
+    with get_connection() as conn:
+        rows, count, last_id = conn.execute(sql, params).fetchone()
+    return encode_page(query, rows, count, last_id)
+
+
+def encode_page(query, rows, count, last_id):
+    # rows is the page's JSON array text
+    next_cursor = None
+    if query.limit is not None and count == query.limit:
+        next_cursor = str(last_id)
+    if query.shape == 'columnar':
+        return '{"columns":%s,"rows":%s,"next":%s}' % (dumps(list(query.fields)), rows, dumps(next_cursor)), count
+    if query.paginated:
+        return '{"data":%s,"next":%s}' % (rows, dumps(next_cursor)), count
+    return rows, count
@@ -0,0 +1,117 @@
+import argparse
+import time
+
+from db_pool import DB_NAME, open_connection
+from migrations import FTS_TABLES, REBUILD_CLOSURE_SQL
+
+# Database maintenance commands:
+#
+#   python maintenance.py orphans          list rows whose parent row no longer exists
+#   python maintenance.py purge-orphans    delete them (and, through ON DELETE CASCADE, their children)
+#   python maintenance.py rebuild-closure  recompute the step_closure hierarchy index from parent_step_id
+#   python maintenance.py rebuild-search   rebuild and optimize the full-text search indexes
+#   python maintenance.py gc-versions      delete version nodes no protocol version refers to any more
+#   python maintenance.py prune-changes    drop change log entries older than --days (default 7)
+
+
+def find_orphans(conn):
+    # PRAGMA foreign_key_check reports (table, rowid, parent table, fk index) per dangling reference
+    orphans = {}
+    for table, rowid, parent, _ in conn.execute("PRAGMA foreign_key_check").fetchall():
+        orphans.setdefault(table, {}).setdefault(rowid, set()).add(parent)
+    return orphans
+
+
+def purge_orphans(conn):
+    # Deleting an orphan cascades to its children, but a child of an orphan can itself be
+    # reported first, so repeat until the check comes back clean
+    purged = {}
+    with conn:
+        while True:
+            orphans = find_orphans(conn)
+            if not orphans:
+                break
+            for table, rows in orphans.items():
+                ids = list(rows)
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    conn.execute("DELETE FROM %s WHERE rowid IN (%s)" % (table, ','.join('?' * len(chunk))), chunk)
+                purged[table] = purged.get(table, 0) + len(ids)
+    return purged
+
+
+def rebuild_closure(conn):
+    with conn:
+        for statement in REBUILD_CLOSURE_SQL:
+            conn.execute(statement)
+    return conn.execute("SELECT COUNT(*) FROM step_closure").fetchone()[0]
+
+
+def rebuild_search(conn):
+    with conn:
+        for fts in FTS_TABLES:
+            conn.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (fts, fts))
+            conn.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (fts, fts))
+    return list(FTS_TABLES)
+
+
+def gc_versions(conn):
+    # Nodes are shared between versions, so only what no remaining version reaches can go
+    before = conn.total_changes
+    with conn:
+        conn.execute('''
+            WITH RECURSIVE live(hash) AS (
+                SELECT root_hash FROM protocol_versions
+                UNION
+                SELECT json_extract(child.value, '$[1]') FROM live JOIN step_nodes n ON n.hash = live.hash, json_each(n.children) child
+            )
+            DELETE FROM step_nodes WHERE hash NOT IN (SELECT hash FROM live)
+        ''')
+    return conn.total_changes - before
+
+
+def prune_changes(conn, older_than):
+    # Entries logged before the unix time older_than; clients still behind them get
+    # 410 Gone from /changes and reload
+    before = conn.total_changes
+    with conn:
+        conn.execute("DELETE FROM changes WHERE changed_at < ?", (older_than,))
+    return conn.total_changes - before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Protocol registry maintenance")
+    parser.add_argument('--db', default=DB_NAME)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('orphans', help="report rows whose parent row is missing")
+    commands.add_parser('purge-orphans', help="delete rows whose parent row is missing")
+    commands.add_parser('rebuild-closure', help="recompute the step hierarchy index")
+    commands.add_parser('rebuild-search', help="rebuild the full-text search indexes")
+    commands.add_parser('gc-versions', help="delete unreferenced protocol version nodes")
+    prune = commands.add_parser('prune-changes', help="drop old change log entries")
+    prune.add_argument('--days', type=float, default=7.0)
+    args = parser.parse_args(argv)
+
+    conn = open_connection(args.db)
+    try:
+        if args.command == 'orphans':
+            for table, rows in find_orphans(conn).items():
+                print("%s: %d orphaned row(s)" % (table, len(rows)))
+        elif args.command == 'purge-orphans':
+            for table, count in purge_orphans(conn).items():
+                print("%s: purged %d orphaned row(s)" % (table, count))
+        elif args.command == 'rebuild-closure':
+            print("step_closure: %d row(s)" % rebuild_closure(conn))
+        elif args.command == 'rebuild-search':
+            for fts in rebuild_search(conn):
+                print("%s: rebuilt" % fts)
+        elif args.command == 'gc-versions':
+            print("step_nodes: deleted %d unreferenced node(s)" % gc_versions(conn))
+        elif args.command == 'prune-changes':
+            print("changes: deleted %d entry(ies)" % prune_changes(conn, time.time() - args.days * 86400))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from flask import request
+
+import db_pool
+
+# Per-request profiling. While enabled, every Flask request records its latency, the
+# time spent inside SQLite, how many statements it ran, the rows it fetched and the
+# bytes it sent, into Prometheus histograms served at /metrics. Statements slower than
+# SLOW_QUERY_SECONDS are logged with their EXPLAIN QUERY PLAN.
+#
+# Disabled (the default), a request pays one flag check in each request hook and
+# statements run on the plain sqlite3 cursor. Switch at runtime with enable()/disable()
+# or PUT /metrics/config {"enabled": true, "slow_query_ms": 50}.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+SLOW_QUERY_SECONDS = 0.1
+SLOW_QUERY_LOG_SIZE = 100
+METRIC_PREFIX = 'protocol_registry_'
+
+logger = logging.getLogger('protocol_registry.slow_queries')
+
+_enabled = False
+_slow_query_seconds = SLOW_QUERY_SECONDS
+_current = ContextVar('request_metrics', default=None)
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    __slots__ = ('started', 'sql_seconds', 'statements', 'rows', 'bytes')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+def observe(name, labels, value, buckets=LATENCY_BUCKETS):
+    key = (name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def increment(name, labels, amount=1):
+    key = (name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def _record_statement(sql, parameters, seconds, conn):
+    current = _current.get()
+    if current is not None:
+        current.sql_seconds += seconds
+        current.statements += 1
+    observe('sql_statement_duration_seconds', (), seconds)
+    if seconds >= _slow_query_seconds:
+        _log_slow_query(sql, parameters, seconds, conn)
+
+
+def _log_slow_query(sql, parameters, seconds, conn):
+    try:
+        # A plain cursor, so the plan lookup is not itself timed
+        plan = [row[-1] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+    except (sqlite3.Error, ValueError):
+        plan = []
+    entry = {'sql': ' '.join(sql.split()), 'seconds': seconds, 'plan': plan, 'at': time.time()}
+    slow_queries.append(entry)
+    increment('slow_queries_total', ())
+    logger.warning("slow query (%.1f ms): %s\n  plan: %s", seconds * 1000, entry['sql'], '; '.join(plan) or '-')
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times execute and every fetch (SQLite does its work while stepping through rows)
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(sql, parameters, time.perf_counter() - started, self.connection)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_statement(sql, seq_of_parameters[0] if seq_of_parameters else (), time.perf_counter() - started, self.connection)
+
+    def _fetched(self, started, rows):
+        current = _current.get()
+        if current is not None:
+            current.sql_seconds += time.perf_counter() - started
+            current.rows += rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0)
+            raise
+        self._fetched(started, 1)
+        return row
+
+
+def enable(slow_query_seconds=None):
+    global _enabled, _slow_query_seconds
+    if slow_query_seconds is not None:
+        _slow_query_seconds = slow_query_seconds
+    db_pool.cursor_factory = TimedCursor
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    db_pool.cursor_factory = sqlite3.Cursor
+
+
+def enabled():
+    return _enabled
+
+
+def config():
+    return {'enabled': _enabled, 'slow_query_ms': _slow_query_seconds * 1000}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+    slow_queries.clear()
+
+
+def _before_request():
+    if _enabled:
+        _current.set(RequestMetrics())
+
+
+def _after_request(response):
+    if not _enabled:
+        return response
+    current = _current.get()
+    if current is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method
+    if response.is_streamed:
+        # Finish once the last chunk is out; until then the stream keeps adding SQL time
+        response.response = _counting(response.response, current)
+    else:
+        current.bytes = response.content_length or 0
+    response.call_on_close(lambda: _finish(current, endpoint, method, response.status_code))
+    return response
+
+
+def _counting(chunks, current):
+    for chunk in chunks:
+        current.bytes += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        yield chunk
+
+
+def _finish(current, endpoint, method, status):
+    _current.set(None)
+    labels = (('endpoint', endpoint), ('method', method))
+    observe('request_duration_seconds', labels, time.perf_counter() - current.started)
+    observe('request_sql_seconds', labels, current.sql_seconds)
+    observe('request_statements', labels, current.statements, COUNT_BUCKETS)
+    observe('request_rows', labels, current.rows, ROW_BUCKETS)
+    observe('response_bytes', labels, current.bytes, BYTE_BUCKETS)
+    increment('requests_total', labels + (('status', str(status)),))
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+def render():
+    # Prometheus text exposition format, version 0.0.4
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+        counters = sorted(_counters.items(), key=lambda item: item[0])
+    seen = set()
+    for (name, labels), histogram in histograms:
+        name = METRIC_PREFIX + name
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE %s histogram' % name)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', repr(float(bound)))]), cumulative))
+        lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', '+Inf')]), histogram.count))
+        lines.append('%s_sum%s %r' % (name, _format_labels(labels), histogram.sum))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+    for (name, labels), value in counters:
+        name = METRIC_PREFIX + name
+        if name not in seen:
+            seen.add(name)
+            lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %d' % (name, _format_labels(labels), value))
+    pools = db_pool.pool_stats()
+    for gauge in ('open', 'in_use', 'idle'):
+        name = '%spool_%s' % (METRIC_PREFIX, gauge)
+        lines.append('# TYPE %s gauge' % name)
+        lines += ['%s%s %d' % (name, _format_labels([('db', db_name)]), stats[gauge]) for db_name, stats in pools.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
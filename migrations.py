@@ -0,0 +1,392 @@
+import sqlite3
+import sys
+
+DB_NAME = 'protocols_registry.db'
+
+NOW_SQL = "(julianday('now') - 2440587.5) * 86400.0"  # unix time, stable within one statement
+
+
+def _bump(scope, key):
+    # Upsert that bumps one version counter; a NULL key (e.g. no workflow) is skipped
+    return (
+        "INSERT INTO resource_versions (scope, key, version, updated_at) "
+        "SELECT '%s', %s, 1, %s WHERE %s IS NOT NULL "
+        "ON CONFLICT (scope, key) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;"
+        % (scope, key, NOW_SQL, key))
+
+
+def _step_protocol(step_id):
+    return "(SELECT protocol_id FROM steps WHERE id = %s)" % step_id
+
+
+# Which counters each write bumps: the row itself, its owning step/protocol/workflow
+# and the table as a whole. Keyed by (table, event).
+VERSION_BUMPS = {
+    ('workflows', 'INSERT'): [('workflow', 'NEW.id')],
+    ('workflows', 'UPDATE'): [('workflow', 'NEW.id')],
+    ('workflows', 'DELETE'): [('workflow', 'OLD.id')],
+    ('protocols', 'INSERT'): [('protocol', 'NEW.id'), ('workflow', 'NEW.workflow_id')],
+    ('protocols', 'UPDATE'): [('protocol', 'NEW.id'), ('workflow', 'OLD.workflow_id'), ('workflow', 'NEW.workflow_id')],
+    ('protocols', 'DELETE'): [('protocol', 'OLD.id'), ('workflow', 'OLD.workflow_id')],
+    ('steps', 'INSERT'): [('step', 'NEW.id'), ('protocol', 'NEW.protocol_id')],
+    ('steps', 'UPDATE'): [('step', 'NEW.id'), ('protocol', 'OLD.protocol_id'), ('protocol', 'NEW.protocol_id')],
+    ('steps', 'DELETE'): [('step', 'OLD.id'), ('protocol', 'OLD.protocol_id')],
+    ('parameters', 'INSERT'): [('parameter', 'NEW.id'), ('step', 'NEW.step_id'), ('protocol', _step_protocol('NEW.step_id'))],
+    ('parameters', 'UPDATE'): [('parameter', 'NEW.id'), ('step', 'OLD.step_id'), ('step', 'NEW.step_id'),
+                               ('protocol', _step_protocol('OLD.step_id')), ('protocol', _step_protocol('NEW.step_id'))],
+    ('parameters', 'DELETE'): [('parameter', 'OLD.id'), ('step', 'OLD.step_id'), ('protocol', _step_protocol('OLD.step_id'))],
+}
+
+
+def _version_triggers():
+    statements = ['''
+        CREATE TABLE IF NOT EXISTS resource_versions (
+            scope TEXT NOT NULL,     -- workflow, protocol, step, parameter, or a table name
+            key INTEGER NOT NULL,    -- row id, 0 for a whole table
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID;
+        ''']
+    for (table, event), bumps in VERSION_BUMPS.items():
+        body = ''.join(_bump(scope, key) for scope, key in bumps + [(table, '0')])
+        statements.append("CREATE TRIGGER IF NOT EXISTS trg_%s_%s_version AFTER %s ON %s BEGIN %s END"
+                          % (table, event.lower(), event, table, body))
+    return statements
+
+
+# Closure table of the step hierarchy: one row per (ancestor, descendant) pair, including
+# each step paired with itself at depth 0, so subtree and path queries are a single range
+# scan. Triggers keep it in step with steps; a step that is its own parent is a root.
+CLOSURE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS step_closure (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    ) WITHOUT ROWID;
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_step_closure_descendant ON step_closure (descendant_id, depth)",
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_steps_insert_closure AFTER INSERT ON steps BEGIN
+        INSERT INTO step_closure (ancestor_id, descendant_id, depth) VALUES (NEW.id, NEW.id, 0);
+        INSERT INTO step_closure (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, NEW.id, depth + 1 FROM step_closure
+            WHERE descendant_id = NEW.parent_step_id AND NEW.parent_step_id != NEW.id;
+    END
+    ''',
+    # Re-parenting under one's own descendant would make the hierarchy a cycle
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_steps_parent_cycle BEFORE UPDATE OF parent_step_id ON steps
+    WHEN NEW.parent_step_id != NEW.id AND EXISTS (
+        SELECT 1 FROM step_closure WHERE ancestor_id = NEW.id AND descendant_id = NEW.parent_step_id)
+    BEGIN
+        SELECT RAISE(ABORT, 'step hierarchy cycle');
+    END
+    ''',
+    # Detach the moved subtree from its old ancestors, then attach it under the new parent
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_steps_update_closure AFTER UPDATE OF parent_step_id ON steps
+    WHEN OLD.parent_step_id IS NOT NEW.parent_step_id BEGIN
+        DELETE FROM step_closure
+        WHERE descendant_id IN (SELECT descendant_id FROM step_closure WHERE ancestor_id = NEW.id)
+          AND ancestor_id NOT IN (SELECT descendant_id FROM step_closure WHERE ancestor_id = NEW.id);
+        INSERT INTO step_closure (ancestor_id, descendant_id, depth)
+            SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+            FROM step_closure a, step_closure d
+            WHERE a.descendant_id = NEW.parent_step_id AND d.ancestor_id = NEW.id AND NEW.parent_step_id != NEW.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_steps_delete_closure AFTER DELETE ON steps BEGIN
+        DELETE FROM step_closure WHERE descendant_id = OLD.id;
+        DELETE FROM step_closure WHERE ancestor_id = OLD.id;
+    END
+    ''',
+]
+
+# Recomputes the closure table from parent_step_id (for data that predates it, or was
+# written with the triggers bypassed). The depth bound stops a pre-existing cycle from
+# recursing forever.
+REBUILD_CLOSURE_SQL = [
+    "DELETE FROM step_closure",
+    '''
+    INSERT OR IGNORE INTO step_closure (ancestor_id, descendant_id, depth)
+    WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+        SELECT id, id, 0 FROM steps
+        UNION ALL
+        SELECT c.ancestor_id, s.id, c.depth + 1
+        FROM closure c JOIN steps s ON s.parent_step_id = c.descendant_id AND s.parent_step_id != s.id
+        WHERE c.depth < (SELECT COUNT(*) FROM steps)
+    )
+    SELECT ancestor_id, descendant_id, MIN(depth) FROM closure GROUP BY ancestor_id, descendant_id
+    ''',
+]
+
+
+# Typed view of parameter values, computed by SQLite itself so no writer can forget it.
+# numeric_value is the value as a REAL when value_type is 'numeric' and the text is a
+# plain number; unit is the parenthesised suffix of the name, e.g. 'temperature (°C)',
+# unless it starts with a digit like 'dNTPs (50 μM)'. Both are VIRTUAL generated
+# columns (ALTER TABLE cannot add STORED ones); the index below stores them.
+NUMERIC_VALUE_SQL = (
+    "CASE WHEN value_type = 'numeric' AND trim(value) GLOB '*[0-9]*' AND trim(value) NOT GLOB '*[^0-9.eE+-]*' "
+    "AND trim(value) NOT GLOB '*[0-9.][+-]*' AND trim(value) NOT GLOB '*.*.*' AND trim(value) NOT GLOB '*[eE]*[eE]*' "
+    "AND (instr(lower(trim(value)), 'e') = 0 OR substr(trim(value), 1, instr(lower(trim(value)), 'e') - 1) GLOB '*[0-9]*') "
+    "THEN CAST(trim(value) AS REAL) END")
+# As migration 6 first deployed it: it let through mantissas without a digit, e.g.
+# 'e5' or '-e3', which CAST turns into 0.0
+NUMERIC_VALUE_SQL_V6 = (
+    "CASE WHEN value_type = 'numeric' AND trim(value) GLOB '*[0-9]*' AND trim(value) NOT GLOB '*[^0-9.eE+-]*' "
+    "AND trim(value) NOT GLOB '*[0-9.][+-]*' AND trim(value) NOT GLOB '*.*.*' "
+    "THEN CAST(trim(value) AS REAL) END")
+UNIT_SQL = (
+    "CASE WHEN name GLOB '*(*)' AND substr(name, instr(name, '(') + 1, 1) NOT GLOB '[0-9]' "
+    "THEN trim(substr(name, instr(name, '(') + 1, length(name) - instr(name, '(') - 1)) END")
+NUMERIC_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_parameters_name_numeric ON parameters (name, numeric_value) WHERE numeric_value IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_parameters_unit_numeric ON parameters (unit, numeric_value) WHERE numeric_value IS NOT NULL",
+]
+
+
+# Full-text indexes over protocol names/descriptions and step descriptions. They are
+# external-content FTS5 tables (the text itself stays in protocols/steps), kept in sync
+# by triggers; prefix='2 3' indexes short prefixes so "anneal*" queries stay cheap.
+FTS_TABLES = {
+    'protocols_fts': ('protocols', ('name', 'description')),
+    'steps_fts': ('steps', ('description',)),
+}
+
+
+def _fts_schema():
+    statements = []
+    for fts, (table, columns) in FTS_TABLES.items():
+        names = ', '.join(columns)
+        new = ', '.join('NEW.' + column for column in columns)
+        old = ', '.join('OLD.' + column for column in columns)
+        statements += [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')" % (fts, names, table),
+            "CREATE TRIGGER IF NOT EXISTS trg_%s_insert_fts AFTER INSERT ON %s BEGIN "
+            "INSERT INTO %s (rowid, %s) VALUES (NEW.id, %s); END" % (table, table, fts, names, new),
+            "CREATE TRIGGER IF NOT EXISTS trg_%s_delete_fts AFTER DELETE ON %s BEGIN "
+            "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', OLD.id, %s); END" % (table, table, fts, fts, names, old),
+            "CREATE TRIGGER IF NOT EXISTS trg_%s_update_fts AFTER UPDATE OF %s ON %s BEGIN "
+            "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', OLD.id, %s); "
+            "INSERT INTO %s (rowid, %s) VALUES (NEW.id, %s); END" % (table, names, table, fts, fts, names, old, fts, names, new),
+            "INSERT INTO %s (%s) VALUES ('rebuild')" % (fts, fts),
+        ]
+    return statements
+
+
+# Append-only change log behind /changes (see changes.py), written by triggers in the
+# same transaction as the change itself. Each entry names the row and the protocol it
+# belongs to; a second entry is logged under the old protocol when a row moves.
+CHANGE_LOG = {
+    ('workflows', 'INSERT'): [('NEW.id', 'NULL')],
+    ('workflows', 'UPDATE'): [('NEW.id', 'NULL')],
+    ('workflows', 'DELETE'): [('OLD.id', 'NULL')],
+    ('protocols', 'INSERT'): [('NEW.id', 'NEW.id')],
+    ('protocols', 'UPDATE'): [('NEW.id', 'NEW.id')],
+    ('protocols', 'DELETE'): [('OLD.id', 'OLD.id')],
+    ('steps', 'INSERT'): [('NEW.id', 'NEW.protocol_id')],
+    ('steps', 'UPDATE'): [('NEW.id', 'NEW.protocol_id'), ('NEW.id', 'OLD.protocol_id')],
+    ('steps', 'DELETE'): [('OLD.id', 'OLD.protocol_id')],
+    ('parameters', 'INSERT'): [('NEW.id', _step_protocol('NEW.step_id'))],
+    ('parameters', 'UPDATE'): [('NEW.id', _step_protocol('NEW.step_id')), ('NEW.id', _step_protocol('OLD.step_id'))],
+    ('parameters', 'DELETE'): [('OLD.id', _step_protocol('OLD.step_id'))],
+}
+
+
+def _log_change(table, op, row_id, protocol_id, where=None):
+    return ("INSERT INTO changes (table_name, row_id, op, protocol_id, changed_at) SELECT '%s', %s, '%s', %s, %s%s;"
+            % (table, row_id, op, protocol_id, NOW_SQL, " WHERE %s" % where if where else ''))
+
+
+def _change_log_schema():
+    statements = [
+        '''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,  -- never reused, so a client's position stays valid
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL,                       -- insert, update or delete
+            protocol_id INTEGER,                    -- owning protocol, NULL for workflows
+            changed_at REAL NOT NULL
+        );
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_changes_protocol_seq ON changes (protocol_id, seq)",
+        # A cascading step delete removes its parameters after the step row is gone, when
+        # their protocol can no longer be looked up: log them before the step goes instead
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_steps_delete_parameters_change BEFORE DELETE ON steps BEGIN
+            INSERT INTO changes (table_name, row_id, op, protocol_id, changed_at)
+                SELECT 'parameters', id, 'delete', OLD.protocol_id, %s FROM parameters WHERE step_id = OLD.id;
+        END
+        ''' % NOW_SQL,
+    ]
+    for (table, event), entries in CHANGE_LOG.items():
+        (row_id, protocol_id), others = entries[0], entries[1:]
+        body = _log_change(table, event.lower(), row_id, protocol_id)
+        body += ''.join(_log_change(table, event.lower(), other_row, other, "(%s) IS NOT (%s)" % (other, protocol_id))
+                        for other_row, other in others)
+        when = " WHEN EXISTS (SELECT 1 FROM steps WHERE id = OLD.step_id)" if (table, event) == ('parameters', 'DELETE') else ''
+        statements.append("CREATE TRIGGER IF NOT EXISTS trg_%s_%s_change AFTER %s ON %s%s BEGIN %s END"
+                          % (table, event.lower(), event, table, when, body))
+    return statements
+
+
+# Versioned schema migrations, applied in order and exactly once per database.
+# The version reached is recorded in the database header (PRAGMA user_version).
+# Every statement is either SQL or a callable taking the open connection.
+MIGRATIONS = [
+    (1, "initial schema", [
+        # Workflows table
+        '''
+        CREATE TABLE IF NOT EXISTS workflows (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+        ''',
+        # Protocols table
+        '''
+        CREATE TABLE IF NOT EXISTS protocols (
+            id INTEGER PRIMARY KEY,
+            workflow_id INTEGER REFERENCES workflows(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            description TEXT
+        );
+        ''',
+        # Steps table (with self-referencing foreign key for parent/child relationships)
+        '''
+        CREATE TABLE IF NOT EXISTS steps (
+            id INTEGER PRIMARY KEY,
+            protocol_id INTEGER REFERENCES protocols(id) ON DELETE CASCADE,
+            parent_step_id INTEGER REFERENCES steps(id) ON DELETE CASCADE,
+            description TEXT NOT NULL,
+            step_order INTEGER NOT NULL
+        );
+        ''',
+        # Parameters table
+        '''
+        CREATE TABLE IF NOT EXISTS parameters (
+            id INTEGER PRIMARY KEY,
+            step_id INTEGER REFERENCES steps(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            value_type TEXT NOT NULL,  -- can be "numeric" or "categorical"
+            value TEXT NOT NULL
+        );
+        ''',
+    ]),
+    (2, "foreign key and ordering indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_protocols_workflow_id ON protocols (workflow_id)",
+        "CREATE INDEX IF NOT EXISTS idx_steps_protocol_order ON steps (protocol_id, step_order)",
+        "CREATE INDEX IF NOT EXISTS idx_steps_parent_step_id ON steps (parent_step_id)",
+        "CREATE INDEX IF NOT EXISTS idx_parameters_step_name ON parameters (step_id, name)",
+    ]),
+    (3, "indexes for collection filters", [
+        "CREATE INDEX IF NOT EXISTS idx_workflows_name ON workflows (name)",
+        "CREATE INDEX IF NOT EXISTS idx_protocols_name ON protocols (name)",
+        "CREATE INDEX IF NOT EXISTS idx_parameters_name ON parameters (name)",
+        "CREATE INDEX IF NOT EXISTS idx_parameters_value_type ON parameters (value_type)",
+    ]),
+    (4, "version counters for conditional GETs", _version_triggers()),
+    (5, "step hierarchy closure table", CLOSURE_SCHEMA + REBUILD_CLOSURE_SQL),
+    (6, "typed numeric parameter values", [
+        "ALTER TABLE parameters ADD COLUMN numeric_value REAL GENERATED ALWAYS AS (%s) VIRTUAL" % NUMERIC_VALUE_SQL_V6,
+        "ALTER TABLE parameters ADD COLUMN unit TEXT GENERATED ALWAYS AS (%s) VIRTUAL" % UNIT_SQL,
+    ] + NUMERIC_INDEXES),
+    (7, "full-text search indexes", _fts_schema()),
+    # Immutable protocol versions as a Merkle DAG (see protocol_versions.py): a node is
+    # addressed by the hash of its content and its children's hashes, so subtrees that
+    # did not change between versions are the same rows
+    (8, "protocol versions", [
+        '''
+        CREATE TABLE IF NOT EXISTS step_nodes (
+            hash TEXT PRIMARY KEY,
+            step_id INTEGER,            -- the live step it was taken from, NULL for a version's root
+            description TEXT,
+            step_order INTEGER,
+            parameters TEXT NOT NULL,   -- JSON [[name, value_type, value], ...]
+            children TEXT NOT NULL      -- JSON [[step_id, hash], ...] in tree order
+        ) WITHOUT ROWID;
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS protocol_versions (
+            protocol_id INTEGER NOT NULL REFERENCES protocols(id) ON DELETE CASCADE,
+            version INTEGER NOT NULL,
+            workflow_id INTEGER,
+            name TEXT NOT NULL,
+            description TEXT,
+            root_hash TEXT NOT NULL,
+            message TEXT,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (protocol_id, version)
+        );
+        ''',
+    ]),
+    (9, "change log", _change_log_schema()),
+    # Protocol versions are logged too, so every write advances the change log position
+    # that read replicas are compared against (see replication.py)
+    (10, "protocol versions in the change log", [
+        "CREATE TRIGGER IF NOT EXISTS trg_protocol_versions_insert_change AFTER INSERT ON protocol_versions BEGIN %s END"
+        % _log_change('protocol_versions', 'insert', 'NEW.version', 'NEW.protocol_id'),
+        "CREATE TRIGGER IF NOT EXISTS trg_protocol_versions_delete_change AFTER DELETE ON protocol_versions BEGIN %s END"
+        % _log_change('protocol_versions', 'delete', 'OLD.version', 'OLD.protocol_id'),
+    ]),
+    # A generated column cannot be altered: drop both, with their indexes, and add them
+    # back in the same order
+    (11, "numeric parameter values need a digit in the mantissa", [
+        "DROP INDEX IF EXISTS idx_parameters_name_numeric",
+        "DROP INDEX IF EXISTS idx_parameters_unit_numeric",
+        "ALTER TABLE parameters DROP COLUMN unit",
+        "ALTER TABLE parameters DROP COLUMN numeric_value",
+        "ALTER TABLE parameters ADD COLUMN numeric_value REAL GENERATED ALWAYS AS (%s) VIRTUAL" % NUMERIC_VALUE_SQL,
+        "ALTER TABLE parameters ADD COLUMN unit TEXT GENERATED ALWAYS AS (%s) VIRTUAL" % UNIT_SQL,
+    ] + NUMERIC_INDEXES),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_name=DB_NAME, target=LATEST_VERSION):
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    applied = []
+    try:
+        for version, description, statements in MIGRATIONS:
+            if version > target:
+                break
+            if version <= current_version(conn):
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have migrated while we waited for the write lock
+                if version <= current_version(conn):
+                    conn.execute("ROLLBACK")
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute("PRAGMA user_version = %d" % version)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            applied.append((version, description))
+    finally:
+        conn.close()
+    return applied
+
+
+if __name__ == "__main__":
+    db_name = sys.argv[1] if len(sys.argv) > 1 else DB_NAME
+    for version, description in migrate(db_name):
+        print("applied migration %d: %s" % (version, description))
@@ -0,0 +1,77 @@
+import sqlite3
+
+from db_pool import get_connection
+from listing import MAX_PAGE_SIZE, QueryError
+
+# Range filters and aggregates over the typed numeric_value/unit columns of parameters
+# (see migrations.py), evaluated entirely in SQLite against the (name, numeric_value)
+# and (unit, numeric_value) indexes:
+#
+#   /parameters/numeric?name=temperature (°C)&max=62     parameters, with their protocol
+#   /parameters/numeric/stats?unit=°C                    count/min/max/avg per name and unit
+#
+# min and max are inclusive; name, unit and protocol_id narrow either query.
+
+RANGE_SQL = """
+SELECT p.id, p.step_id, s.protocol_id, p.name, p.value_type, p.value, p.numeric_value, p.unit
+FROM parameters p JOIN steps s ON s.id = p.step_id
+WHERE %s
+ORDER BY p.numeric_value, p.id
+LIMIT ?
+"""
+
+STATS_SQL = """
+SELECT p.name, p.unit, COUNT(*) AS count, COUNT(DISTINCT s.protocol_id) AS protocols,
+       MIN(p.numeric_value) AS min, MAX(p.numeric_value) AS max, AVG(p.numeric_value) AS avg
+FROM parameters p JOIN steps s ON s.id = p.step_id
+WHERE %s
+GROUP BY p.name, p.unit
+ORDER BY p.name, p.unit
+"""
+
+
+def _parse(name, value, convert=float):
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise QueryError("'%s' must be %s" % (name, "an integer" if convert is int else "a number"))
+
+
+def _where(args):
+    clauses = ["p.numeric_value IS NOT NULL"]
+    params = []
+    for column in ('name', 'unit'):
+        if column in args:
+            clauses.append("p.%s = ?" % column)
+            params.append(args[column])
+    if 'protocol_id' in args:
+        clauses.append("s.protocol_id = ?")
+        params.append(_parse('protocol_id', args['protocol_id'], int))
+    if args.get('min'):
+        clauses.append("p.numeric_value >= ?")
+        params.append(_parse('min', args['min']))
+    if args.get('max'):
+        clauses.append("p.numeric_value <= ?")
+        params.append(_parse('max', args['max']))
+    return ' AND '.join(clauses), params
+
+
+def _query(sql, params):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def find_numeric_parameters(args):
+    where, params = _where(args)
+    limit = _parse('limit', args['limit'], int) if args.get('limit') else MAX_PAGE_SIZE
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise QueryError("'limit' must be between 1 and %d" % MAX_PAGE_SIZE)
+    return _query(RANGE_SQL % where, params + [limit])
+
+
+def numeric_parameter_stats(args):
+    where, params = _where(args)
+    return _query(STATS_SQL % where, params)
@@ -0,0 +1,101 @@
+from db_pool import get_connection
+from serialization import dumps
+
+# A step is a root of its protocol's tree when it has no parent, is its own parent
+# (as in the PCR fixture), or points at a step outside the protocol. Siblings are
+# ordered by step_order then id; the sort key assumes |step_order| < 10^9.
+TREE_SQL = """
+WITH RECURSIVE tree(id, parent_step_id, description, step_order, depth, path) AS (
+    SELECT s.id, s.parent_step_id, s.description, s.step_order, 0,
+           printf('%011d.%010d', s.step_order + 1000000000, s.id)
+    FROM steps s
+    WHERE s.protocol_id = :protocol_id
+      AND (s.parent_step_id IS NULL OR s.parent_step_id = s.id
+           OR NOT EXISTS (SELECT 1 FROM steps p WHERE p.id = s.parent_step_id AND p.protocol_id = s.protocol_id))
+    UNION ALL
+    SELECT c.id, c.parent_step_id, c.description, c.step_order, t.depth + 1,
+           t.path || '/' || printf('%011d.%010d', c.step_order + 1000000000, c.id)
+    FROM tree t
+    JOIN steps c ON c.parent_step_id = t.id AND c.id != t.id AND c.protocol_id = :protocol_id
+)
+SELECT t.id, t.parent_step_id, t.description, t.step_order, t.depth,
+       p.id, p.name, p.value_type, p.value
+FROM tree t
+LEFT JOIN parameters p ON p.step_id = t.id
+ORDER BY t.path, p.id
+"""
+
+STREAM_CHUNK_SIZE = 8192
+
+
+def iter_tree_steps(conn, protocol_id):
+    # Yields (depth, step) depth-first with each step's parameters attached
+    step = None
+    depth = 0
+    for row in conn.execute(TREE_SQL, {'protocol_id': protocol_id}):
+        if step is None or step['id'] != row[0]:
+            if step is not None:
+                yield depth, step
+            step = {
+                'id': row[0],
+                'parent_step_id': row[1],
+                'description': row[2],
+                'step_order': row[3],
+                'parameters': [],
+            }
+            depth = row[4]
+        if row[5] is not None:
+            step['parameters'].append({'id': row[5], 'name': row[6], 'value_type': row[7], 'value': row[8]})
+    if step is not None:
+        yield depth, step
+
+
+def _protocol_dict(protocol):
+    id, workflow_id, name, description = protocol
+    return {'id': id, 'workflow_id': workflow_id, 'name': name, 'description': description}
+
+
+def get_protocol_tree(protocol):
+    tree = _protocol_dict(protocol)
+    tree['steps'] = []
+    stack = [tree['steps']]
+    with get_connection() as conn:
+        for depth, step in iter_tree_steps(conn, tree['id']):
+            del stack[depth + 1:]
+            step['children'] = []
+            stack[depth].append(step)
+            stack.append(step['children'])
+    return tree
+
+
+def _split(document, key):
+    # The encoding of `document` around its `key`, whose value is the placeholder 0.
+    # Keys are sorted, so the key may fall anywhere; the quoted "key": can only be the
+    # real one, since every quote inside an encoded string is escaped.
+    document[key] = 0
+    before, _, after = dumps(document).partition('"%s":0' % key)
+    return before + '"%s":[' % key, ']' + after
+
+
+def iter_protocol_tree_json(protocol):
+    # Streams the same document get_protocol_tree() builds, without holding it in memory
+    opening, closing = _split(_protocol_dict(protocol), 'steps')
+    buffer = [opening]
+    closings = [closing]  # what ends each open object, innermost last
+    size = 0
+    with get_connection() as conn:
+        for depth, step in iter_tree_steps(conn, protocol[0]):
+            if depth + 1 < len(closings):
+                buffer.extend(reversed(closings[depth + 1:]))
+                del closings[depth + 1:]
+                buffer.append(',')
+            chunk, closing = _split(step, 'children')
+            buffer.append(chunk)
+            closings.append(closing)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+    buffer.extend(reversed(closings))
+    yield ''.join(buffer)
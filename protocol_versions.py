@@ -0,0 +1,211 @@
+import hashlib
+import json
+import time
+
+from db_pool import get_connection, transaction
+from protocol_tree import iter_tree_steps
+from write_pipeline import pipelined
+
+# Immutable protocol versions, stored copy-on-write as a Merkle DAG in step_nodes.
+# A node's hash covers its step's content, its parameters and its children's hashes,
+# so a version shares every unchanged subtree with the versions before it: snapshotting
+# after an edit adds only the edited steps and their ancestors. Diffs descend only into
+# subtrees whose hashes differ.
+
+
+class VersionNotFound(LookupError):
+    pass
+
+
+def node_hash(step_id, description, step_order, parameters, children):
+    content = json.dumps([step_id, description, step_order, parameters, children], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _snapshot_nodes(conn, protocol_id):
+    # Preorder from the tree query; walking it backwards meets every child before its parent
+    steps = []
+    stack = []
+    roots = []
+    for depth, step in iter_tree_steps(conn, protocol_id):
+        del stack[depth:]
+        step['children'] = []
+        (stack[-1]['children'] if stack else roots).append(step)
+        stack.append(step)
+        steps.append(step)
+
+    nodes = []
+    for step in reversed(steps):
+        parameters = [[p['name'], p['value_type'], p['value']] for p in step['parameters']]
+        children = [[child['id'], child['hash']] for child in step['children']]
+        step['hash'] = node_hash(step['id'], step['description'], step['step_order'], parameters, children)
+        nodes.append((step['hash'], step['id'], step['description'], step['step_order'], json.dumps(parameters), json.dumps(children)))
+    children = [[step['id'], step['hash']] for step in roots]
+    root_hash = node_hash(None, None, None, [], children)
+    nodes.append((root_hash, None, None, None, '[]', json.dumps(children)))
+    return root_hash, nodes
+
+
+@pipelined
+def create_version(protocol_id, message=None):
+    with transaction(immediate=True) as conn:
+        protocol = conn.execute("SELECT workflow_id, name, description FROM protocols WHERE id=?", (protocol_id,)).fetchone()
+        if protocol is None:
+            raise VersionNotFound("Protocol %s not found" % protocol_id)
+        root_hash, nodes = _snapshot_nodes(conn, protocol_id)
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO step_nodes (hash, step_id, description, step_order, parameters, children) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", nodes)
+        new_nodes = conn.total_changes - before
+        version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM protocol_versions WHERE protocol_id=?", (protocol_id,)).fetchone()[0]
+        conn.execute("INSERT INTO protocol_versions (protocol_id, version, workflow_id, name, description, root_hash, message, created_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (protocol_id, version) + tuple(protocol) + (root_hash, message, time.time()))
+    return {'protocol_id': protocol_id, 'version': version, 'root_hash': root_hash,
+            'nodes': len(nodes), 'new_nodes': new_nodes}
+
+
+VERSION_COLUMNS = ('protocol_id', 'version', 'workflow_id', 'name', 'description', 'root_hash', 'message', 'created_at')
+
+
+def list_versions(protocol_id):
+    with get_connection() as conn:
+        rows = conn.execute("SELECT %s FROM protocol_versions WHERE protocol_id=? ORDER BY version" % ', '.join(VERSION_COLUMNS),
+                            (protocol_id,)).fetchall()
+    return [dict(zip(VERSION_COLUMNS, row)) for row in rows]
+
+
+def _version(conn, protocol_id, version):
+    row = conn.execute("SELECT %s FROM protocol_versions WHERE protocol_id=? AND version=?" % ', '.join(VERSION_COLUMNS),
+                       (protocol_id, version)).fetchone()
+    if row is None:
+        raise VersionNotFound("Version %s of protocol %s not found" % (version, protocol_id))
+    return dict(zip(VERSION_COLUMNS, row))
+
+
+def _load_nodes(conn, hashes):
+    nodes = {}
+    hashes = list(hashes)
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        for hash, step_id, description, step_order, parameters, children in conn.execute(
+                "SELECT hash, step_id, description, step_order, parameters, children FROM step_nodes WHERE hash IN (%s)"
+                % ','.join('?' * len(chunk)), chunk):
+            nodes[hash] = {'step_id': step_id, 'description': description, 'step_order': step_order,
+                           'parameters': json.loads(parameters), 'children': json.loads(children)}
+    return nodes
+
+
+def _load_tree(conn, root_hash):
+    # Every node of one version, fetched level by level
+    nodes = {}
+    level = [root_hash]
+    while level:
+        loaded = _load_nodes(conn, set(level) - set(nodes))
+        nodes.update(loaded)
+        level = [hash for node in loaded.values() for _, hash in node['children']]
+    return nodes
+
+
+def _step_documents(nodes, root_hash):
+    # Nested step documents under the version's root, built without recursion
+    steps = []
+    stack = [(root_hash, steps)]
+    while stack:
+        hash, siblings = stack.pop()
+        for _, child in nodes[hash]['children']:
+            node = nodes[child]
+            document = {
+                'id': node['step_id'],
+                'description': node['description'],
+                'step_order': node['step_order'],
+                'parameters': [{'name': name, 'value_type': value_type, 'value': value} for name, value_type, value in node['parameters']],
+                'children': [],
+            }
+            siblings.append(document)
+            stack.append((child, document['children']))
+    return steps
+
+
+def get_version(protocol_id, version):
+    # The same document shape as /protocols/<id>/tree, as it was at that version
+    with get_connection() as conn:
+        document = _version(conn, protocol_id, version)
+        nodes = _load_tree(conn, document['root_hash'])
+    document['id'] = document.pop('protocol_id')
+    document['steps'] = _step_documents(nodes, document['root_hash'])
+    return document
+
+
+def _expand(conn, roots):
+    # {step_id: (node, parent_step_id)} for every step in the given subtrees
+    steps = {}
+    level = list(roots)
+    while level:
+        nodes = _load_nodes(conn, {hash for hash, _ in level})
+        next_level = []
+        for hash, parent_step_id in level:
+            node = nodes[hash]
+            steps[node['step_id']] = (node, parent_step_id)
+            next_level += [(child, node['step_id']) for _, child in node['children']]
+        level = next_level
+    return steps
+
+
+def _summary(step_id, node, parent_step_id):
+    return {'id': step_id, 'parent_step_id': parent_step_id, 'description': node['description'], 'step_order': node['step_order']}
+
+
+def _changes(old, new):
+    return {field: [old[field], new[field]] for field in ('description', 'step_order', 'parameters') if old[field] != new[field]}
+
+
+def diff_versions(protocol_id, old_version, new_version):
+    # Walks both DAGs together, descending only where hashes differ. Steps are matched
+    # by the live step id they were snapshotted from; a step found under a different
+    # parent in the new version is reported as moved.
+    with get_connection() as conn:
+        old = _version(conn, protocol_id, old_version)
+        new = _version(conn, protocol_id, new_version)
+        modified = []
+        removed_roots = []
+        added_roots = []
+        pairs = [(old['root_hash'], new['root_hash'])]
+        while pairs:
+            nodes = _load_nodes(conn, {hash for pair in pairs for hash in pair})
+            next_pairs = []
+            for old_hash, new_hash in pairs:
+                a, b = nodes[old_hash], nodes[new_hash]
+                if a['step_id'] is not None and _changes(a, b):
+                    modified.append({'id': a['step_id'], 'changes': _changes(a, b)})
+                old_children = dict(a['children'])
+                new_children = dict(b['children'])
+                for step_id, hash in a['children']:
+                    if step_id not in new_children:
+                        removed_roots.append((hash, a['step_id']))
+                    elif hash != new_children[step_id]:
+                        next_pairs.append((hash, new_children[step_id]))
+                added_roots += [(hash, b['step_id']) for step_id, hash in b['children'] if step_id not in old_children]
+            pairs = next_pairs
+
+        # Only the changed subtrees are expanded
+        removed = _expand(conn, removed_roots)
+        added = _expand(conn, added_roots)
+
+    moved = []
+    for step_id in sorted(set(removed) & set(added)):
+        (a, old_parent), (b, new_parent) = removed.pop(step_id), added.pop(step_id)
+        if old_parent != new_parent:
+            moved.append({'id': step_id, 'from_parent_step_id': old_parent, 'to_parent_step_id': new_parent})
+        if _changes(a, b):
+            modified.append({'id': step_id, 'changes': _changes(a, b)})
+
+    return {
+        'protocol_id': protocol_id,
+        'from_version': old_version,
+        'to_version': new_version,
+        'protocol': {field: [old[field], new[field]] for field in ('workflow_id', 'name', 'description') if old[field] != new[field]},
+        'added': [_summary(step_id, *added[step_id]) for step_id in sorted(added)],
+        'removed': [_summary(step_id, *removed[step_id]) for step_id in sorted(removed)],
+        'moved': moved,
+        'modified': sorted(modified, key=lambda change: change['id']),
+    }
@@ -0,0 +1,197 @@
+import itertools
+import os
+import shutil
+import sqlite3
+import threading
+
+from flask import g, request
+
+import db_pool
+
+# Read replicas. A refresher copies the primary into N local replica files with the
+# SQLite online backup API: each copy is written to a temporary file and renamed over
+# the replica, so readers never see a half-written file and connections still open on
+# the previous copy finish on it. GET requests are spread across the replicas while
+# writes, and everything outside a request, stay on the primary.
+#
+# Positions are the change log's seq (see changes.py), which every write advances.
+# Write responses carry the primary's position in X-Registry-Seq and replica reads the
+# position of the copy they read; a client that sends the header back is only routed
+# to a replica at least that recent, falling back to the primary, so it always reads
+# its own writes.
+
+REFRESH_INTERVAL = 1.0  # seconds between checks of the primary for new writes
+SEQ_HEADER = 'X-Registry-Seq'
+REPLICA_PROFILE = 'read-replica'
+# Routes answered from the primary only: the long-poll feed waits on the primary's log
+PRIMARY_ENDPOINTS = {'get_changes'}
+
+_replicas = []
+_next = itertools.count()
+_refresher = None
+_counters = {'replica_reads': 0, 'stale_fallbacks': 0, 'refreshes': 0}
+
+
+def replica_paths(count, db_name=None):
+    base, ext = os.path.splitext(db_name or db_pool.DB_NAME)
+    return ['%s.replica-%d%s' % (base, index, ext) for index in range(1, count + 1)]
+
+
+def log_position(conn):
+    # The last change log seq, kept by AUTOINCREMENT even after pruning
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row[0] if row else 0
+
+
+class Replica:
+    def __init__(self, path):
+        self.path = path
+        self.seq = None
+        self.refreshed_at = None
+        self._identity = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        # The replica's position, reopening its pool whenever the file was swapped
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity != self._identity:
+            with self._lock:
+                if identity != self._identity:
+                    db_pool.reset_pool(self.path, REPLICA_PROFILE)
+                    conn = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+                    try:
+                        self.seq = log_position(conn)
+                    finally:
+                        conn.close()
+                    self.refreshed_at = stat.st_mtime
+                    self._identity = identity
+        return self.seq
+
+
+def refresh_replicas(paths, db_name=None):
+    # One consistent backup of the primary, copied to every replica path; returns its seq
+    tmp_paths = ['%s.%d.tmp' % (path, os.getpid()) for path in paths]
+    source = db_pool.open_connection(db_name)
+    target = sqlite3.connect(tmp_paths[0])
+    try:
+        source.backup(target)  # one step, so the copy is a single snapshot
+        target.execute("PRAGMA journal_mode = DELETE").fetchall()  # readers need no -wal/-shm files
+        seq = log_position(target)
+    finally:
+        target.close()
+        source.close()
+    for tmp_path in tmp_paths[1:]:
+        shutil.copyfile(tmp_paths[0], tmp_path)
+    for tmp_path, path in zip(tmp_paths, paths):
+        os.replace(tmp_path, path)
+    _counters['refreshes'] += 1
+    return seq
+
+
+class ReplicaRefresher(threading.Thread):
+    # Refreshes the replicas whenever the primary's log position has moved
+    def __init__(self, paths, db_name=None, interval=REFRESH_INTERVAL):
+        super().__init__(name='replica-refresher', daemon=True)
+        self.paths = paths
+        self.db_name = db_name
+        self.interval = interval
+        self._stop = threading.Event()
+        self._refreshed_seq = refresh_replicas(paths, db_name)
+
+    def run(self):
+        conn = db_pool.open_connection(self.db_name)
+        try:
+            while not self._stop.wait(self.interval):
+                if log_position(conn) != self._refreshed_seq:
+                    self._refreshed_seq = refresh_replicas(self.paths, self.db_name)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+
+def start_refresher(count, db_name=None, interval=REFRESH_INTERVAL):
+    # Run in one process per primary; every server process can route to the files
+    global _refresher
+    stop_refresher()
+    _refresher = ReplicaRefresher(replica_paths(count, db_name), db_name, interval)
+    _refresher.start()
+    return _refresher
+
+
+def stop_refresher():
+    global _refresher
+    if _refresher is not None:
+        _refresher.stop()
+        _refresher = None
+
+
+def enable(count, db_name=None):
+    # Route this process's GET requests to `count` replicas (refreshed elsewhere)
+    global _replicas
+    _replicas = [Replica(path) for path in replica_paths(count, db_name)]
+
+
+def disable():
+    global _replicas
+    replicas, _replicas = _replicas, []
+    for replica in replicas:
+        db_pool.reset_pool(replica.path)
+
+
+def enabled():
+    return bool(_replicas)
+
+
+def replication_stats():
+    stats = dict(_counters)
+    stats['replicas'] = [{'path': replica.path, 'seq': replica.current(), 'refreshed_at': replica.refreshed_at}
+                         for replica in _replicas]
+    return stats
+
+
+def _choose(min_seq):
+    # Round robin over the replicas recent enough for the client
+    start = next(_next)
+    for offset in range(len(_replicas)):
+        replica = _replicas[(start + offset) % len(_replicas)]
+        seq = replica.current()
+        if seq is not None and seq >= min_seq:
+            return replica, seq
+    return None, None
+
+
+def _before_request():
+    if not _replicas or request.method not in ('GET', 'HEAD') or request.endpoint in PRIMARY_ENDPOINTS:
+        return
+    replica, seq = _choose(request.headers.get(SEQ_HEADER, 0, type=int))
+    if replica is None:
+        _counters['stale_fallbacks'] += 1
+        return
+    _counters['replica_reads'] += 1
+    db_pool.route_database(replica.path, replica=True)
+    g.replica_seq = seq
+
+
+def _after_request(response):
+    if not _replicas:
+        return response
+    if request.method in ('GET', 'HEAD'):
+        if 'replica_seq' in g:
+            response.headers[SEQ_HEADER] = str(g.replica_seq)
+    elif response.status_code < 400:
+        with db_pool.get_connection(db_pool.DB_NAME) as conn:
+            response.headers[SEQ_HEADER] = str(log_position(conn))
+    response.vary.add(SEQ_HEADER)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
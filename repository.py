@@ -0,0 +1,157 @@
+from collections import namedtuple
+
+import sharding
+from cache import invalidate
+from db_pool import get_connection, transaction
+from listing import TABLES
+
+# Table-driven data access for the four resources, behind the helpers in crud_db.py.
+# Each Repository builds its SQL once and hands rows back as namedtuples, which index
+# like the plain tuples the single-row routes always returned and skip the per-row
+# dict of sqlite3.Row. The SQL strings never change, so sqlite3's per-connection
+# statement cache (db_pool.STATEMENT_CACHE_SIZE) keeps every one of them prepared.
+#
+# Writes invalidate the read-through cache entries of the rows they touch; deletes
+# leave that to the caller, which knows what else cascades with the row.
+
+CHUNK_SIZE = 500  # ids per IN (...) list, well under SQLite's bound parameter limit
+# Read-only columns SQLite computes (see migrations.py), returned with every row
+GENERATED_COLUMNS = {'parameters': ('numeric_value', 'unit')}
+
+# Module level so cached rows can be pickled by the memcached/redis backends
+Workflow = namedtuple('Workflow', TABLES['workflows']['columns'])
+Protocol = namedtuple('Protocol', TABLES['protocols']['columns'])
+Step = namedtuple('Step', TABLES['steps']['columns'])
+Parameter = namedtuple('Parameter', TABLES['parameters']['columns'] + GENERATED_COLUMNS['parameters'])
+
+
+def _row_factory(row_type):
+    new = tuple.__new__
+    return lambda cursor, row: new(row_type, row)
+
+
+class Repository:
+    def __init__(self, table, row_type, cache_scope=None, cache_groups=()):
+        # cache_scope: the @cached namespace of one row by id; cache_groups: (namespace,
+        # column) pairs of cached lists the row belongs to, e.g. steps by protocol_id
+        self.table = table
+        self.row_type = row_type
+        self.columns = row_type._fields
+        self.writable = TABLES[table]['columns']
+        self.cache_scope = cache_scope
+        self.cache_groups = cache_groups
+        self.row_factory = _row_factory(row_type)
+        columns = ', '.join(self.columns)
+        writable = ', '.join(self.writable)
+        placeholders = ', '.join('?' * len(self.writable))
+        fields = self.writable[1:]
+        self.select_sql = "SELECT %s FROM %s WHERE id = ?" % (columns, table)
+        self.select_all_sql = "SELECT %s FROM %s ORDER BY id" % (columns, table)
+        self.insert_sql = "INSERT INTO %s (%s) VALUES (%s) RETURNING %s" % (table, writable, placeholders, columns)
+        self.update_sql = "UPDATE %s SET %s WHERE id = ? RETURNING %s" % (table, ', '.join('%s = ?' % field for field in fields), columns)
+        self.upsert_sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (id) DO UPDATE SET %s" % (
+            table, writable, placeholders, ', '.join('%s = excluded.%s' % (field, field) for field in fields))
+        self.delete_sql = "DELETE FROM %s WHERE id = ?" % table
+        self.delete_all_sql = "DELETE FROM %s" % table
+        self._select_in_sql = {}
+        self._find_sql = {}
+
+    def cursor(self, conn):
+        cursor = conn.cursor()  # not conn.execute, which would bypass metrics' timing cursor
+        cursor.row_factory = self.row_factory
+        return cursor
+
+    def _select_in(self, count):
+        sql = self._select_in_sql.get(count)
+        if sql is None:
+            sql = self._select_in_sql[count] = "SELECT %s FROM %s WHERE id IN (%s) ORDER BY id" % (
+                ', '.join(self.columns), self.table, ','.join('?' * count))
+        return sql
+
+    def _group_keys(self, rows):
+        return ['%s:%s' % (namespace, getattr(row, column)) for row in rows for namespace, column in self.cache_groups]
+
+    # Reads
+    def get(self, id):
+        with get_connection() as conn:
+            return self.cursor(conn).execute(self.select_sql, (id,)).fetchone()
+
+    def get_many(self, ids):
+        # The rows that exist, in id order
+        ids = sorted(set(ids))
+        rows = []
+        with get_connection() as conn:
+            cursor = self.cursor(conn)
+            for start in range(0, len(ids), CHUNK_SIZE):
+                chunk = ids[start:start + CHUNK_SIZE]
+                rows += cursor.execute(self._select_in(len(chunk)), chunk).fetchall()
+        return rows
+
+    def all(self):
+        with get_connection() as conn:
+            return self.cursor(conn).execute(self.select_all_sql).fetchall()
+
+    def find(self, column, value, order_by='id'):
+        key = (column, order_by)
+        sql = self._find_sql.get(key)
+        if sql is None:
+            if column not in self.columns:
+                raise ValueError("%s has no column %s" % (self.table, column))
+            sql = self._find_sql[key] = "SELECT %s FROM %s WHERE %s = ? ORDER BY %s" % (', '.join(self.columns), self.table, column, order_by)
+        with get_connection() as conn:
+            return self.cursor(conn).execute(sql, (value,)).fetchall()
+
+    # Writes
+    def insert(self, *values):
+        with transaction() as conn:
+            row = self.cursor(conn).execute(self.insert_sql, (sharding.new_id(self.table),) + values).fetchone()
+            invalidate(*self._group_keys([row]))  # the new id itself was never cached
+            return row
+
+    def update(self, id, *values):
+        # The row as written, or None if there is no such row
+        with transaction() as conn:
+            cursor = self.cursor(conn)
+            previous = cursor.execute(self.select_sql, (id,)).fetchone() if self.cache_groups else None
+            row = cursor.execute(self.update_sql, values + (id,)).fetchone()
+            keys = self._group_keys([row for row in (previous, row) if row is not None])
+            if self.cache_scope:
+                keys.append('%s:%s' % (self.cache_scope, id))
+            invalidate(*keys)
+            return row
+
+    def upsert_many(self, rows):
+        # Inserts or replaces whole rows (dicts, or sequences of the writable columns in
+        # order) with one executemany; rows without an id get a new one. When sharded,
+        # explicit ids must be ones the catalog gave this shard. Returns how many were
+        # written.
+        values = [tuple(row.get(column) for column in self.writable) if isinstance(row, dict) else tuple(row) for row in rows]
+        with transaction(immediate=True) as conn:
+            if sharding.enabled():
+                sharding.check_ids(self.table, [row[0] for row in values if row[0] is not None])
+                fresh = iter(sharding.allocate_ids(self.table, sum(1 for row in values if row[0] is None)))
+                values = [row if row[0] is not None else (next(fresh),) + row[1:] for row in values]
+            if self.cache_scope or self.cache_groups:
+                previous = self.get_many(row[0] for row in values if row[0] is not None)
+                padding = (None,) * (len(self.columns) - len(self.writable))
+                keys = self._group_keys(previous + [self.row_type._make(row + padding) for row in values])
+                if self.cache_scope:
+                    keys += ['%s:%s' % (self.cache_scope, row[0]) for row in values]
+                invalidate(*keys)
+            conn.cursor().executemany(self.upsert_sql, values)
+        return len(values)
+
+    def delete(self, id):
+        with transaction() as conn:
+            return conn.cursor().execute(self.delete_sql, (id,)).rowcount
+
+    def delete_all(self):
+        with transaction() as conn:
+            return conn.cursor().execute(self.delete_all_sql).rowcount
+
+
+WORKFLOWS = Repository('workflows', Workflow)
+PROTOCOLS = Repository('protocols', Protocol, 'protocol')
+STEPS = Repository('steps', Step, 'step', (('steps_by_protocol', 'protocol_id'),))
+PARAMETERS = Repository('parameters', Parameter)
+REPOSITORIES = {repository.table: repository for repository in (WORKFLOWS, PROTOCOLS, STEPS, PARAMETERS)}
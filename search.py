@@ -0,0 +1,88 @@
+import re
+import sqlite3
+
+from db_pool import get_connection
+from listing import MAX_PAGE_SIZE, QueryError, parse_int
+
+# /search?q=annealing MgCl2&type=step&limit=20&offset=20
+#
+# Ranked full-text search over the FTS5 indexes from migrations.py. Every word of q
+# must match (a trailing * makes it a prefix: "anneal*"); protocol names weigh ten
+# times their descriptions. Hits are ordered by bm25 score, best first, and carry a
+# highlighted snippet plus the owning protocol and workflow ids.
+
+SEARCH_TYPES = ('protocol', 'step')
+DEFAULT_LIMIT = 20
+SNIPPET_TOKENS = 12
+
+# Ranking only touches the FTS index; joins and snippets are computed for the one page
+# of hits that is returned
+RANK_SQL = {
+    'protocol': "SELECT * FROM (SELECT 'protocol' AS type, rowid AS id, bm25(protocols_fts, 10.0, 1.0) AS score "
+                "FROM protocols_fts WHERE protocols_fts MATCH :q ORDER BY score LIMIT :window)",
+    'step': "SELECT * FROM (SELECT 'step' AS type, rowid AS id, bm25(steps_fts) AS score "
+            "FROM steps_fts WHERE steps_fts MATCH :q ORDER BY score LIMIT :window)",
+}
+
+HITS_SQL = {
+    'protocol': """
+        SELECT p.id, p.id AS protocol_id, p.workflow_id,
+               snippet(protocols_fts, -1, '<mark>', '</mark>', '…', %d) AS snippet
+        FROM protocols_fts JOIN protocols p ON p.id = protocols_fts.rowid
+        WHERE protocols_fts MATCH ? AND protocols_fts.rowid IN (%%s)
+    """ % SNIPPET_TOKENS,
+    'step': """
+        SELECT s.id, s.protocol_id, p.workflow_id,
+               snippet(steps_fts, 0, '<mark>', '</mark>', '…', %d) AS snippet
+        FROM steps_fts JOIN steps s ON s.id = steps_fts.rowid
+        LEFT JOIN protocols p ON p.id = s.protocol_id
+        WHERE steps_fts MATCH ? AND steps_fts.rowid IN (%%s)
+    """ % SNIPPET_TOKENS,
+}
+
+
+def fts_query(text):
+    # Quote every word so user input can never be FTS5 syntax; keep a trailing * as a
+    # prefix search
+    terms = []
+    for word in re.findall(r'[^\s"]+', text or ''):
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append('"%s"%s' % (word, '*' if prefix else ''))
+    if not terms:
+        raise QueryError("'q' must contain at least one word")
+    return ' '.join(terms)
+
+
+def search(args):
+    query = fts_query(args.get('q'))
+    types = SEARCH_TYPES
+    if args.get('type'):
+        if args['type'] not in SEARCH_TYPES:
+            raise QueryError("'type' must be one of %s" % ', '.join(SEARCH_TYPES))
+        types = (args['type'],)
+    limit = parse_int('limit', args['limit'], 1, MAX_PAGE_SIZE) if args.get('limit') else DEFAULT_LIMIT
+    offset = parse_int('offset', args['offset'], 0, 1 << 31) if args.get('offset') else 0
+
+    sql = "SELECT * FROM (%s) ORDER BY score, type, id LIMIT :limit OFFSET :offset" % ' UNION ALL '.join(RANK_SQL[type] for type in types)
+    with get_connection() as conn:
+        # One row past the page tells whether there is a next one
+        ranked = conn.execute(sql, {'q': query, 'window': offset + limit + 1, 'limit': limit + 1, 'offset': offset}).fetchall()
+        next_offset = str(offset + limit) if len(ranked) > limit else None
+        ranked = ranked[:limit]
+
+        details = {}
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        for type in types:
+            ids = [id for hit_type, id, _ in ranked if hit_type == type]
+            if ids:
+                cursor.execute(HITS_SQL[type] % ','.join('?' * len(ids)), [query] + ids)
+                details.update(((type, row['id']), dict(row)) for row in cursor.fetchall())
+    hits = []
+    for type, id, score in ranked:
+        hit = {'type': type, 'score': score}
+        hit.update(details[type, id])
+        hits.append(hit)
+    return hits, next_offset
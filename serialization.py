@@ -0,0 +1,67 @@
+import json
+
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+# Pluggable JSON encoding for API responses and exports. orjson (when installed) encodes
+# several times faster than the stdlib; output stays the same JSON, with sorted keys
+# like Flask's default. set_backend('json') forces the stdlib encoder.
+
+BACKENDS = ('orjson', 'json')
+backend = 'orjson' if orjson is not None else 'json'
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+
+def set_backend(name):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend '%s'" % name)
+    if name == 'orjson' and orjson is None:
+        raise ValueError("The orjson backend needs: pip install orjson")
+    backend = name
+
+
+def _default_tuple(obj):
+    # orjson encodes plain tuples but not subclasses, e.g. the namedtuple rows of
+    # repository.py; they go out as arrays, as with the stdlib encoder
+    if isinstance(obj, tuple):
+        return list(obj)
+    return _default(obj)
+
+
+def dumps_bytes(obj):
+    if backend == 'orjson':
+        return orjson.dumps(obj, default=_default_tuple, option=ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj):
+    return dumps_bytes(obj).decode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # Flask's request.json, jsonify() and view return values all go through the app's
+    # provider; calls with stdlib-specific keyword arguments keep the stdlib path
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs or backend != 'orjson':
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
+
+
+def init_app(app):
+    app.json = FastJSONProvider(app)
@@ -0,0 +1,494 @@
+import bisect
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+from contextlib import ExitStack
+from operator import itemgetter
+
+from flask import g, jsonify, request
+
+import db_pool
+import replication
+import write_pipeline
+from export import iter_rows_ndjson
+from listing import MAX_PAGE_SIZE, TABLES, QueryError, encode_page, parse_int
+from migrations import migrate
+from search import DEFAULT_LIMIT
+
+# Optional sharding by workflow. Every workflow gets its own database file holding it
+# and its protocols, steps and parameters, so writes to one workflow never wait on
+# another's lock and each file can be vacuumed or backed up on its own. Protocols
+# without a workflow, and everything that existed before sharding was switched on,
+# stay in the main database file (shard 0).
+#
+# A small catalog database maps ids to shards. Ids stay unique across all files: each
+# process reserves ids from the catalog in blocks per (table, shard), and the catalog
+# records which shard owns each block, so finding the shard of /steps/<id> is one
+# cached range lookup.
+#
+# Each request is routed to the one file it touches (by the id in its URL, or the
+# parent id in its body). Collection routes without a narrowing filter read every
+# shard and merge the sorted results on their pagination key.
+
+SHARD_DIR = 'shards'
+BLOCK_SIZE = 1000
+BLOCK_SIZES = {'workflows': 1}  # a workflow's shard owns exactly its id
+CATALOG_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS shards (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE
+    );
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS id_counters (
+        table_name TEXT PRIMARY KEY,
+        next_id INTEGER NOT NULL
+    );
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS id_blocks (
+        table_name TEXT NOT NULL,
+        start_id INTEGER NOT NULL,
+        end_id INTEGER NOT NULL,    -- exclusive
+        shard_id INTEGER NOT NULL REFERENCES shards(id),
+        PRIMARY KEY (table_name, start_id)
+    ) WITHOUT ROWID;
+    ''',
+]
+
+# Creates routed by the parent id in their body: endpoint -> (body field, parent table)
+BODY_ROUTES = {
+    'add_protocol': ('workflow_id', 'workflows'),
+    'add_step': ('protocol_id', 'protocols'),
+    'add_parameter': ('step_id', 'steps'),
+}
+# The filter that pins a collection route to one shard
+LIST_ROUTES = {
+    'workflows': None,
+    'protocols': ('workflow_id', 'workflows'),
+    'steps': ('protocol_id', 'protocols'),
+    'parameters': ('step_id', 'steps'),
+}
+FAN_OUT_ENDPOINTS = {'search_registry', 'get_numeric_parameters', 'get_numeric_parameter_stats'}
+# Change log positions are per file, so there is no single feed to serve
+UNSHARDED_ENDPOINTS = {'get_changes', 'get_changes_delta'}
+FAN_OUT = object()
+
+
+class ShardingError(ValueError):
+    pass
+
+
+class Catalog:
+    def __init__(self, path, default_shard, shard_dir=SHARD_DIR):
+        self.path = path
+        self.shard_dir = shard_dir
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA busy_timeout = 5000")
+        self._lock = threading.RLock()
+        self._paths = {}
+        self._ids = {}
+        self._blocks = {}    # table -> ([start_id, ...], [(end_id, shard_id), ...]) sorted by start
+        self._reserved = {}  # (table, shard_id) -> [next id, end] handed out by this process
+        for statement in CATALOG_SCHEMA:
+            self._conn.execute(statement)
+        self._seed(default_shard)
+
+    def _write(self):
+        # Catalog writes serialize across processes on the catalog's write lock
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def _seed(self, default_shard):
+        # Shard 0 is the existing database: its current ids become its first blocks
+        with self._lock:
+            conn = self._write()
+            try:
+                if conn.execute("SELECT 1 FROM shards").fetchone() is None:
+                    conn.execute("INSERT INTO shards (id, path) VALUES (0, ?)", (default_shard,))
+                    existing = sqlite3.connect(default_shard)
+                    try:
+                        for table in TABLES:
+                            next_id = existing.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM %s" % table).fetchone()[0]
+                            conn.execute("INSERT INTO id_counters (table_name, next_id) VALUES (?, ?)", (table, next_id))
+                            if next_id > 1:
+                                conn.execute("INSERT INTO id_blocks VALUES (?, 1, ?, 0)", (table, next_id))
+                    finally:
+                        existing.close()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def shard_path(self, shard_id):
+        with self._lock:
+            if shard_id not in self._paths:
+                self._paths.update(self._conn.execute("SELECT id, path FROM shards").fetchall())
+            return self._paths[shard_id]
+
+    def shard_id(self, path):
+        with self._lock:
+            if path not in self._ids:
+                row = self._conn.execute("SELECT id FROM shards WHERE path = ?", (path,)).fetchone()
+                if row is None:
+                    raise ShardingError("%s is not a shard" % path)
+                self._ids[path] = row[0]
+            return self._ids[path]
+
+    def all_shards(self):
+        with self._lock:
+            return [path for path, in self._conn.execute("SELECT path FROM shards ORDER BY id")]
+
+    def shard_of(self, table, id):
+        # Path of the shard owning that id, or None if no shard was ever given it
+        if not isinstance(id, int) or id < 1:
+            return None
+        with self._lock:
+            shard_id = self._find(table, id)
+            if shard_id is None:
+                self._load_blocks(table)  # another process may have reserved it since
+                shard_id = self._find(table, id)
+        return None if shard_id is None else self.shard_path(shard_id)
+
+    def _find(self, table, id):
+        starts, ends = self._blocks.get(table, ([], []))
+        index = bisect.bisect_right(starts, id) - 1
+        if index >= 0 and id < ends[index][0]:
+            return ends[index][1]
+        return None
+
+    def _load_blocks(self, table):
+        starts, ends = self._blocks.setdefault(table, ([], []))
+        for start_id, end_id, shard_id in self._conn.execute(
+                "SELECT start_id, end_id, shard_id FROM id_blocks WHERE table_name = ? AND start_id > ? ORDER BY start_id",
+                (table, starts[-1] if starts else 0)):
+            starts.append(start_id)
+            ends.append((end_id, shard_id))
+
+    def _reserve(self, conn, table, shard_id, count):
+        size = max(count, BLOCK_SIZES.get(table, BLOCK_SIZE))
+        start = conn.execute("SELECT next_id FROM id_counters WHERE table_name = ?", (table,)).fetchone()[0]
+        conn.execute("UPDATE id_counters SET next_id = ? WHERE table_name = ?", (start + size, table))
+        conn.execute("INSERT INTO id_blocks VALUES (?, ?, ?, ?)", (table, start, start + size, shard_id))
+        return [start, start + size]
+
+    def allocate_ids(self, table, path, count):
+        # Consecutive ids owned by the shard at path, from this process's current block
+        if not count:
+            return range(0)
+        shard_id = self.shard_id(path)
+        with self._lock:
+            block = self._reserved.get((table, shard_id))
+            if block is None or block[1] - block[0] < count:
+                conn = self._write()
+                try:
+                    block = self._reserved[table, shard_id] = self._reserve(conn, table, shard_id, count)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            start = block[0]
+            block[0] += count
+        return range(start, start + count)
+
+    def new_workflow_shard(self):
+        # A new file for a workflow about to be created; its id is reserved for it. Shard
+        # ids come from a counter rather than the rowid, so one dropped by drop_shard is
+        # never handed out again while other processes still cache its path.
+        with self._lock:
+            conn = self._write()
+            try:
+                workflow_id = conn.execute("SELECT next_id FROM id_counters WHERE table_name = 'workflows'").fetchone()[0]
+                path = os.path.join(self.shard_dir, 'workflow-%d.db' % workflow_id)
+                conn.execute("INSERT OR IGNORE INTO id_counters (table_name, next_id) SELECT 'shards', COALESCE(MAX(id), 0) + 1 FROM shards")
+                shard_id = conn.execute("UPDATE id_counters SET next_id = next_id + 1 WHERE table_name = 'shards' RETURNING next_id - 1").fetchone()[0]
+                conn.execute("INSERT INTO shards (id, path) VALUES (?, ?)", (shard_id, path))
+                self._reserved['workflows', shard_id] = self._reserve(conn, 'workflows', shard_id, 1)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        os.makedirs(self.shard_dir, exist_ok=True)
+        migrate(path)
+        return path
+
+    def drop_shard(self, path):
+        # Undoes new_workflow_shard when the workflow it was made for was not created.
+        # The ids reserved for it are skipped, never reused.
+        shard_id = self.shard_id(path)
+        with self._lock:
+            conn = self._write()
+            try:
+                conn.execute("DELETE FROM id_blocks WHERE shard_id = ?", (shard_id,))
+                conn.execute("DELETE FROM shards WHERE id = ?", (shard_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self._paths.pop(shard_id, None)
+            self._ids.pop(path, None)
+            for key in [key for key in self._reserved if key[1] == shard_id]:
+                del self._reserved[key]
+            for starts, ends in self._blocks.values():
+                kept = [(start, end) for start, end in zip(starts, ends) if end[1] != shard_id]
+                starts[:] = [start for start, _ in kept]
+                ends[:] = [end for _, end in kept]
+        write_pipeline.close_shard_pipelines([path])
+        db_pool.reset_pool(path)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def close(self):
+        self._conn.close()
+
+
+_catalog = None
+
+
+def catalog_path(db_name=None):
+    base, ext = os.path.splitext(db_name or db_pool.DB_NAME)
+    return '%s.catalog%s' % (base, ext)
+
+
+def enable(path=None, shard_dir=SHARD_DIR):
+    global _catalog
+    if replication.enabled():
+        raise ShardingError("Sharding and read replicas cannot be combined")
+    disable()
+    _catalog = Catalog(path or catalog_path(), db_pool.DB_NAME, shard_dir)
+    return _catalog
+
+
+def disable():
+    global _catalog
+    catalog, _catalog = _catalog, None
+    if catalog is not None:
+        write_pipeline.close_shard_pipelines()
+        for path in catalog.all_shards()[1:]:
+            db_pool.reset_pool(path)
+        catalog.close()
+
+
+def enabled():
+    return _catalog is not None
+
+
+def all_shards():
+    return _catalog.all_shards() if _catalog is not None else [db_pool.DB_NAME]
+
+
+def allocate_ids(table, count):
+    # Ids for rows about to be written through the current connection's database
+    return _catalog.allocate_ids(table, db_pool.routed_database() or db_pool.DB_NAME, count)
+
+
+def check_ids(table, ids):
+    # Explicit ids written through the current connection must already belong to its
+    # shard: the catalog never handed out any other, and could later give those to
+    # another shard
+    path = db_pool.routed_database() or db_pool.DB_NAME
+    foreign = [id for id in ids if _catalog.shard_of(table, id) != path]
+    if foreign:
+        raise ShardingError("%s id(s) %s were not allocated to %s" % (table, ', '.join(map(str, foreign[:10])), path))
+
+
+def new_id(table):
+    # An explicit id for an INSERT when sharded; None lets SQLite pick one
+    return allocate_ids(table, 1)[0] if _catalog is not None else None
+
+
+def fan_out():
+    # True when this request reads every shard
+    return _catalog is not None and g.get('_shard_fan_out', False)
+
+
+def gather(fn, *args):
+    # fn's result on every shard, each call routed to its file
+    results = []
+    for path in all_shards():
+        with db_pool.routed(path):
+            results.append(fn(*args))
+    return results
+
+
+def for_each_shard(fn):
+    if not fan_out():
+        return fn()
+    gather(fn)
+
+
+def _merged_rows(sql, params, key=itemgetter(0)):
+    # Rows of one sorted query over every shard, k-way merged on key
+    with ExitStack() as stack:
+        cursors = [stack.enter_context(db_pool.get_connection(path)).execute(sql, params) for path in all_shards()]
+        yield from heapq.merge(*cursors, key=key)
+
+
+def list_json(query):
+    # listing.list_json across shards; each shard returns at most one page
+    sql, params = query.rows_sql()
+    rows = list(itertools.islice(_merged_rows(sql, params), query.limit))
+    return encode_page(query, '[%s]' % ','.join(row for _, row in rows), len(rows), rows[-1][0] if rows else None)
+
+
+def iter_ndjson(query):
+    sql, params = query.sql()
+    return iter_rows_ndjson(query.fields, _merged_rows(sql, params))
+
+
+def merged_search(search, args):
+    # Each shard ranks its own top offset+limit hits and the pages are merged on (score,
+    # type, id). bm25 weighs terms by each shard's own document counts and lengths, so
+    # scores from different shards are not strictly comparable: the order within one
+    # shard is exact, the interleaving of shards only approximates one big index.
+    limit = parse_int('limit', args['limit'], 1, MAX_PAGE_SIZE) if args.get('limit') else DEFAULT_LIMIT
+    offset = parse_int('offset', args['offset'], 0, MAX_PAGE_SIZE) if args.get('offset') else 0
+    if offset + limit > MAX_PAGE_SIZE:
+        raise QueryError("'offset' + 'limit' must be at most %d when sharded" % MAX_PAGE_SIZE)
+    shard_args = dict(args.items(), limit=str(offset + limit), offset='0')
+    pages = gather(search, shard_args)
+    hits = list(heapq.merge(*(hits for hits, _ in pages), key=lambda hit: (hit['score'], hit['type'], hit['id'])))
+    more = len(hits) > offset + limit or any(next_offset for _, next_offset in pages)
+    return hits[offset:offset + limit], str(offset + limit) if more else None
+
+
+def merged_numeric_parameters(find, args):
+    rows = heapq.merge(*gather(find, args), key=lambda row: (row['numeric_value'], row['id']))
+    return list(itertools.islice(rows, int(args['limit']) if args.get('limit') else MAX_PAGE_SIZE))
+
+
+def merged_numeric_stats(stats, args):
+    combined = {}
+    for row in itertools.chain.from_iterable(gather(stats, args)):
+        total = combined.get((row['name'], row['unit']))
+        if total is None:
+            combined[row['name'], row['unit']] = dict(row)
+            continue
+        count = total['count'] + row['count']
+        total['avg'] = (total['avg'] * total['count'] + row['avg'] * row['count']) / count
+        total['count'] = count
+        total['protocols'] += row['protocols']  # a protocol lives in exactly one shard
+        total['min'] = min(total['min'], row['min'])
+        total['max'] = max(total['max'], row['max'])
+    return [combined[key] for key in sorted(combined, key=lambda key: (key[0], key[1] is not None, key[1] or ''))]
+
+
+def _body_shard(field, table):
+    body = request.get_json(silent=True)
+    value = body.get(field) if isinstance(body, dict) else None
+    return _catalog.shard_of(table, value) if value is not None else None
+
+
+def _bulk_shard():
+    # A bulk import is one transaction, so it has to stay within one file
+    body = request.get_json(silent=True)
+    documents = body if isinstance(body, list) else [body]
+    targets = set()
+    for document in documents:
+        if not isinstance(document, dict):
+            return None  # rejected by the importer itself
+        if document.get('workflow') is not None:
+            if len(documents) > 1:
+                raise ShardingError("A sharded bulk import can only create a workflow from a single document")
+            return _new_workflow_shard()
+        workflow_id = document.get('workflow_id')
+        targets.add(_catalog.shard_of('workflows', workflow_id) if workflow_id is not None else None)
+    if len(targets) > 1:
+        raise ShardingError("A sharded bulk import must stay within one workflow")
+    return targets.pop() if targets else None
+
+
+def _batch_shard():
+    # Like a bulk import, a batch is one transaction within one file. Rows named by a
+    # $ref were created by the batch itself, so they are in its shard already.
+    body = request.get_json(silent=True)
+    targets = set()
+    for operation in body if isinstance(body, list) else []:
+        if not isinstance(operation, dict) or operation.get('table') not in LIST_ROUTES:
+            continue  # rejected by the batch parser itself
+        table = operation['table']
+        if table == 'workflows' and operation.get('op') == 'create':
+            raise ShardingError("A sharded batch cannot create workflows; POST /workflows first")
+        if operation.get('op') != 'create':
+            targets.add(_catalog.shard_of(table, operation.get('id')))
+        data = operation.get('data')
+        if LIST_ROUTES[table] is not None and isinstance(data, dict):
+            field, parent = LIST_ROUTES[table]
+            if data.get(field) is None and operation.get('op') == 'create':
+                targets.add(_catalog.shard_path(0))  # e.g. a protocol without a workflow
+            else:
+                targets.add(_catalog.shard_of(parent, data.get(field)))
+    targets.discard(None)
+    if len(targets) > 1:
+        raise ShardingError("A sharded batch must stay within one workflow")
+    return targets.pop() if targets else None
+
+
+def _new_workflow_shard():
+    # The file has to exist before the workflow can be inserted into it; _after_request
+    # drops it again if the request fails
+    g._new_shard = _catalog.new_workflow_shard()
+    return g._new_shard
+
+
+def _route():
+    endpoint = request.endpoint
+    if endpoint == 'add_workflow':
+        return _new_workflow_shard()
+    if endpoint == 'add_protocols_bulk':
+        return _bulk_shard()
+    if endpoint == 'apply_write_batch':
+        return _batch_shard()
+    if endpoint in BODY_ROUTES:
+        return _body_shard(*BODY_ROUTES[endpoint])
+    if endpoint in FAN_OUT_ENDPOINTS:
+        return FAN_OUT
+    if request.url_rule is None:
+        return None
+
+    view_args = request.view_args or {}
+    segments = request.url_rule.rule.strip('/').split('/')
+    table = segments[1] if segments[0] == 'export' and len(segments) > 1 else segments[0]
+    if 'protocol_id' in view_args:
+        return _catalog.shard_of('protocols', view_args['protocol_id'])
+    if table in TABLES and 'id' in view_args:
+        return _catalog.shard_of(table, view_args['id'])
+    if view_args.get('table') in TABLES:
+        table = view_args['table']
+    if table in LIST_ROUTES:
+        pin = LIST_ROUTES[table]
+        if request.method == 'GET' and pin is not None and request.args.get(pin[0], '').isdigit():
+            return _catalog.shard_of(pin[1], int(request.args[pin[0]]))
+        return FAN_OUT
+    return None
+
+
+def _before_request():
+    if _catalog is None:
+        return None
+    if request.endpoint in UNSHARDED_ENDPOINTS:
+        return jsonify({"message": "Not available while the registry is sharded"}), 501
+    shard = _route()
+    if shard is FAN_OUT:
+        g._shard_fan_out = True
+    elif shard is not None:
+        db_pool.route_database(shard)
+    return None
+
+
+def _after_request(response):
+    path = g.pop('_new_shard', None)
+    if path is not None and response.status_code >= 300 and _catalog is not None:
+        db_pool.release_request_connections()  # the request's connection to the file
+        _catalog.drop_shard(path)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,159 @@
+from bulk_import import allocate_ids
+from cache import invalidate
+from db_pool import transaction
+from write_pipeline import pipelined
+
+# Server-side restructuring of the step hierarchy. Each operation is one transaction;
+# the subtree of a step is one range scan of the step_closure index (see migrations.py).
+# A step that is its own parent (as in the PCR fixture) is a root, not a cycle.
+
+SUBTREE_SQL = """
+SELECT s.id, s.protocol_id, s.parent_step_id, s.description, s.step_order
+FROM step_closure c JOIN steps s ON s.id = c.descendant_id
+WHERE c.ancestor_id = :root
+ORDER BY c.depth, s.id
+"""
+
+# Roots of a protocol, by the same rule protocol_tree.TREE_SQL uses
+ROOTS_WHERE = """protocol_id = :protocol_id
+    AND (parent_step_id IS NULL OR parent_step_id = id
+         OR NOT EXISTS (SELECT 1 FROM steps p WHERE p.id = steps.parent_step_id AND p.protocol_id = steps.protocol_id))"""
+CHILDREN_WHERE = "parent_step_id = :parent_step_id AND id != :parent_step_id"
+
+
+class SubtreeError(ValueError):
+    pass
+
+
+class StepNotFound(SubtreeError):
+    pass
+
+
+class ProtocolNotFound(SubtreeError):
+    pass
+
+
+def _subtree(conn, step_id):
+    rows = conn.execute(SUBTREE_SQL, {'root': step_id}).fetchall()
+    if not rows:
+        raise StepNotFound("Step %s not found" % step_id)
+    return rows
+
+
+def _invalidate(rows, *protocol_ids):
+    protocols = {row[1] for row in rows} | set(protocol_ids)
+    invalidate(*['step:%s' % row[0] for row in rows], *['steps_by_protocol:%s' % id for id in protocols])
+
+
+def _placement(conn, parent_step_id, protocol_id):
+    # Protocol the subtree lands in: the new parent's, else the one given
+    if parent_step_id is not None:
+        parent = conn.execute("SELECT protocol_id FROM steps WHERE id=?", (parent_step_id,)).fetchone()
+        if parent is None:
+            raise StepNotFound("Parent step %s not found" % parent_step_id)
+        return parent[0]
+    if conn.execute("SELECT 1 FROM protocols WHERE id=?", (protocol_id,)).fetchone() is None:
+        raise SubtreeError("Protocol %s not found" % protocol_id)
+    return protocol_id
+
+
+def _next_order(conn, parent_step_id, protocol_id):
+    # Append after the last sibling
+    if parent_step_id is not None:
+        where, params = CHILDREN_WHERE, {'parent_step_id': parent_step_id}
+    else:
+        where, params = ROOTS_WHERE, {'protocol_id': protocol_id}
+    return conn.execute("SELECT COALESCE(MAX(step_order), 0) + 1 FROM steps WHERE " + where, params).fetchone()[0]
+
+
+@pipelined
+def move_subtree(step_id, parent_step_id=None, protocol_id=None, step_order=None):
+    # Re-parent a step (None makes it a root of protocol_id, default its own protocol);
+    # its descendants follow it into the new protocol
+    with transaction() as conn:
+        rows = _subtree(conn, step_id)
+        old_protocol_id = rows[0][1]
+        if parent_step_id is not None and parent_step_id in {row[0] for row in rows}:
+            raise SubtreeError("Cannot move step %s under its own subtree" % step_id)
+        protocol_id = _placement(conn, parent_step_id, protocol_id if protocol_id is not None else old_protocol_id)
+        if step_order is None:
+            step_order = _next_order(conn, parent_step_id, protocol_id)
+
+        conn.execute("UPDATE steps SET parent_step_id=?, protocol_id=?, step_order=? WHERE id=?",
+                     (parent_step_id, protocol_id, step_order, step_id))
+        if protocol_id != old_protocol_id:
+            ids = [row[0] for row in rows[1:]]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                conn.execute("UPDATE steps SET protocol_id=? WHERE id IN (%s)" % ','.join('?' * len(chunk)), [protocol_id] + chunk)
+        _invalidate(rows, protocol_id)
+        return {'id': step_id, 'protocol_id': protocol_id, 'parent_step_id': parent_step_id,
+                'step_order': step_order, 'moved': len(rows)}
+
+
+@pipelined
+def copy_subtree(step_id, protocol_id=None, parent_step_id=None, step_order=None):
+    # Deep copy of a step, its descendants and all their parameters. Returns the new
+    # root id and the old id -> new id mapping.
+    with transaction(immediate=True) as conn:
+        rows = _subtree(conn, step_id)
+        protocol_id = _placement(conn, parent_step_id, protocol_id if protocol_id is not None else rows[0][1])
+        if step_order is None:
+            step_order = _next_order(conn, parent_step_id, protocol_id)
+
+        new_ids = dict(zip((row[0] for row in rows), allocate_ids(conn, 'steps', len(rows))))
+        step_rows = [(new_ids[step_id], protocol_id, parent_step_id, rows[0][3], step_order)]
+        step_rows += [(new_ids[id], protocol_id, new_ids[parent], description, order)
+                      for id, _, parent, description, order in rows[1:]]
+        conn.executemany("INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (?, ?, ?, ?, ?)", step_rows)
+
+        parameters = conn.execute("SELECT p.step_id, p.name, p.value_type, p.value FROM step_closure c JOIN parameters p ON p.step_id = c.descendant_id "
+                                  "WHERE c.ancestor_id = ? ORDER BY p.id", (step_id,)).fetchall()
+        parameter_ids = allocate_ids(conn, 'parameters', len(parameters))
+        conn.executemany("INSERT INTO parameters (id, step_id, name, value_type, value) VALUES (?, ?, ?, ?, ?)",
+                         [(parameter_id, new_ids[old_step_id], name, value_type, value)
+                          for parameter_id, (old_step_id, name, value_type, value) in zip(parameter_ids, parameters)])
+        invalidate('steps_by_protocol:%s' % protocol_id)
+        return {'id': new_ids[step_id], 'protocol_id': protocol_id, 'steps': new_ids, 'parameters': len(parameters)}
+
+
+@pipelined
+def renumber_children(parent_step_id=None, protocol_id=None, order=None):
+    # Rewrite step_order of a step's children (or of a protocol's roots) to 1..n.
+    # Ids listed in `order` come first, in that order; the rest keep their relative order.
+    if order is not None and (not isinstance(order, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in order)):
+        raise SubtreeError("'order' must be a list of step ids")
+    with transaction() as conn:
+        if parent_step_id is not None:
+            if conn.execute("SELECT 1 FROM steps WHERE id=?", (parent_step_id,)).fetchone() is None:
+                raise StepNotFound("Step %s not found" % parent_step_id)
+            where, params = CHILDREN_WHERE, {'parent_step_id': parent_step_id}
+        else:
+            if conn.execute("SELECT 1 FROM protocols WHERE id=?", (protocol_id,)).fetchone() is None:
+                raise ProtocolNotFound("Protocol %s not found" % protocol_id)
+            where, params = ROOTS_WHERE, {'protocol_id': protocol_id}
+        siblings = conn.execute("SELECT id, protocol_id FROM steps WHERE %s ORDER BY step_order, id" % where, params).fetchall()
+        ids = [id for id, _ in siblings]
+        order = list(order or [])
+        unknown = set(order) - set(ids)
+        if unknown:
+            raise SubtreeError("Steps %s are not siblings here" % sorted(unknown))
+        placed = list(dict.fromkeys(order))
+        ranked = placed + sorted(set(ids) - set(placed), key=ids.index)
+        conn.executemany("UPDATE steps SET step_order=? WHERE id=? AND step_order IS NOT ?",
+                         [(position, id, position) for position, id in enumerate(ranked, 1)])
+        _invalidate(siblings)
+        return ranked
+
+
+@pipelined
+def delete_subtree(step_id):
+    # Explicit rather than left to ON DELETE CASCADE, so the cache keys and count are exact
+    with transaction() as conn:
+        rows = _subtree(conn, step_id)
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            conn.execute("DELETE FROM steps WHERE id IN (%s)" % ','.join('?' * len(chunk)), chunk)
+        _invalidate(rows)
+        return len(ids)
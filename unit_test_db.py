@@ -1,5 +1,6 @@
 import unittest
 import sqlite3
+import cache
 from crud_db import app
 from flask import Flask
 
@@ -9,10 +10,20 @@ class TestDBOperations(unittest.TestCase):
         self.conn = sqlite3.connect('protocols_registry.db')
         self.cursor = self.conn.cursor()
         self.client = app.test_client()
+        cache.clear()  # tearDown empties the tables behind the cache's back
+
+    def create_parents(self, *tables):
+        # Foreign keys are enforced, so children need real parent rows
+        if 'workflows' in tables:
+            self.client.post('/workflows', json={"name": "Parent Workflow"})
+        if 'protocols' in tables:
+            self.client.post('/protocols', json={"workflow_id": 1, "name": "Parent Protocol", "description": ""})
+        if 'steps' in tables:
+            self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": None, "description": "Parent Step", "step_order": 1})
 
     def tearDown(self):
         # Clear the database after each test
-        for table in ['parameters', 'steps', 'protocols', 'workflows']:  # Note: order matters due to foreign key constraints
+        for table in ['protocol_versions', 'step_nodes', 'parameters', 'steps', 'protocols', 'workflows', 'changes']:  # Note: order matters due to foreign key constraints
             self.cursor.execute(f"DELETE FROM {table}")
         self.conn.commit()
         self.conn.close()
@@ -46,6 +57,7 @@ class TestDBOperations(unittest.TestCase):
 
     # Similarly, you can create tests for protocols, steps, and parameters using the structure above.
     def test_protocol(self):
+        self.create_parents('workflows')
         # CREATE
         response = self.client.post('/protocols', json={"workflow_id": 1, "name": "Test Protocol", "description": "This is a test protocol"})
         self.assertEqual(response.status_code, 201)
@@ -72,6 +84,7 @@ class TestDBOperations(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
     def test_step(self):
+        self.create_parents('workflows', 'protocols')
         # CREATE
         response = self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": 1, "description": "This is a test step", "step_order": 1})
         self.assertEqual(response.status_code, 201)
@@ -98,6 +111,7 @@ class TestDBOperations(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
 
     def test_parameter(self):
+        self.create_parents('workflows', 'protocols', 'steps')
         # CREATE
         response = self.client.post('/parameters', json={"step_id": 1, "name": "Test Parameter", "value_type": "string", "value": "test"})
         self.assertEqual(response.status_code, 201)
@@ -123,5 +137,1086 @@ class TestDBOperations(unittest.TestCase):
         response = self.client.get('/parameters/1')
         self.assertEqual(response.status_code, 404)
 
+    def test_connection_pool_reuse(self):
+        for _ in range(3):
+            self.client.post('/workflows', json={"name": "Pooled Workflow"})
+            self.client.get('/workflows')
+
+        response = self.client.get('/pool/stats')
+        self.assertEqual(response.status_code, 200)
+        stats = response.get_json()['protocols_registry.db']
+        self.assertLessEqual(stats['created'], stats['size'])
+        self.assertEqual(stats['in_use'], 0)  # every request handed its connection back
+        self.assertGreaterEqual(stats['acquired'], 6)
+
+    def test_connection_pool_reconnects_dead_connection(self):
+        import db_pool
+        pool = db_pool.ConnectionPool('protocols_registry.db', size=1)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.close()
+        conn.last_used = 0  # force a health check on the next acquire
+
+        healthy = pool.acquire()
+        self.assertIsNot(healthy, conn)
+        self.assertEqual(healthy.execute("SELECT 1").fetchone(), (1,))
+        pool.release(healthy)
+        self.assertEqual(pool.stats()['reconnects'], 1)
+        pool.close()
+
+    def test_migrations_upgrade_in_place(self):
+        import os
+        import tempfile
+        from migrations import migrate, LATEST_VERSION
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, 'legacy.db')
+            self.assertEqual([version for version, _ in migrate(db_name, target=1)], [1])
+            conn = sqlite3.connect(db_name)
+            conn.execute("INSERT INTO steps (protocol_id, description, step_order) VALUES (1, 'kept', 1)")
+            conn.commit()
+
+            migrate(db_name)
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], LATEST_VERSION)
+            self.assertEqual(conn.execute("SELECT description FROM steps").fetchall(), [('kept',)])
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM steps WHERE protocol_id=? ORDER BY step_order, id", (1,)).fetchall()
+            self.assertIn('idx_steps_protocol_order', ' '.join(row[-1] for row in plan))
+            self.assertEqual(migrate(db_name), [])
+            conn.close()
+
+    def test_migration_drops_numeric_values_without_mantissa_digits(self):
+        import os
+        import tempfile
+        from migrations import migrate
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, 'numeric.db')
+            migrate(db_name, target=10)
+            conn = sqlite3.connect(db_name)
+            conn.executemany("INSERT INTO parameters (step_id, name, value_type, value) VALUES (NULL, 'volume', 'numeric', ?)",
+                             [('e5',), ('.e1',), ('-e3',), ('.5e3',)])
+            conn.commit()
+            self.assertEqual(conn.execute("SELECT numeric_value FROM parameters ORDER BY id").fetchall(), [(0.0,), (0.0,), (0.0,), (500.0,)])
+
+            self.assertEqual([version for version, _ in migrate(db_name)], [11])
+            self.assertEqual(conn.execute("SELECT numeric_value FROM parameters ORDER BY id").fetchall(), [(None,), (None,), (None,), (500.0,)])
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM parameters WHERE name = 'volume' AND numeric_value > 1").fetchall()
+            self.assertIn('idx_parameters_name_numeric', ' '.join(row[-1] for row in plan))
+            conn.close()
+
+    def test_bulk_import_protocol(self):
+        document = {
+            "workflow": {"name": "PCR Workflow"},
+            "protocol": {"name": "PCR version 1", "description": "Amplify template"},
+            "steps": [
+                {"temp_id": "mix", "description": "In PCR tubes of 200 μl", "children": [
+                    {"description": "Add 38 μl sterile water",
+                     "parameters": [{"name": "Water Quantity", "value_type": "numeric", "value": 38}]},
+                ]},
+                {"temp_id": "cycle", "description": "Cycle through 30 rounds of", "step_order": 5},
+                {"description": "Annealing: 60°C for 30 seconds", "parent": "cycle",
+                 "parameters": [{"name": "temperature (°C)", "value_type": "numeric", "value": "60"}]},
+            ],
+        }
+        response = self.client.post('/protocols/bulk', json=document)
+        self.assertEqual(response.status_code, 201)
+        ids = response.get_json()
+        self.assertEqual(len(ids['step_ids']), 4)
+        self.assertEqual(len(ids['parameter_ids']), 2)
+
+        rows = self.cursor.execute("SELECT id, protocol_id, parent_step_id, description, step_order FROM steps ORDER BY id").fetchall()
+        mix, cycle = ids['steps']['mix'], ids['steps']['cycle']
+        self.assertEqual(rows, [
+            (mix, ids['protocol_id'], None, "In PCR tubes of 200 μl", 1),
+            (mix + 1, ids['protocol_id'], mix, "Add 38 μl sterile water", 1),
+            (cycle, ids['protocol_id'], None, "Cycle through 30 rounds of", 5),
+            (cycle + 1, ids['protocol_id'], cycle, "Annealing: 60°C for 30 seconds", 1),  # first child of cycle
+        ])
+        self.assertEqual(self.cursor.execute("SELECT step_id, value FROM parameters ORDER BY id").fetchall(),
+                         [(mix + 1, '38'), (cycle + 1, '60')])
+
+    def test_bulk_import_rejects_invalid_document(self):
+        response = self.client.post('/protocols/bulk', json={
+            "workflow": {"name": "Broken"},
+            "protocol": {"name": "Broken protocol"},
+            "steps": [{"description": "orphan", "parent": "missing"}],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.cursor.execute("SELECT COUNT(*) FROM workflows").fetchone(), (0,))
+
+    def test_bulk_import_orders_parents_before_children(self):
+        response = self.client.post('/protocols/bulk', json={
+            "workflow": {"name": "PCR Workflow"},
+            "protocol": {"name": "PCR version 2"},
+            "steps": [
+                {"description": "Denaturation: 95°C", "parent": "cycle"},
+                {"description": "Extension: 72°C", "parent": "cycle"},
+                {"temp_id": "cycle", "description": "Cycle through 30 rounds of", "children": [{"description": "Annealing: 60°C"}]},
+            ],
+        })
+        self.assertEqual(response.status_code, 201)
+        ids = response.get_json()
+        cycle = ids['steps']['cycle']
+        self.assertEqual(self.cursor.execute("SELECT description, parent_step_id, step_order FROM steps WHERE parent_step_id IS NOT NULL ORDER BY step_order").fetchall(), [
+            ("Annealing: 60°C", cycle, 1),
+            ("Denaturation: 95°C", cycle, 2),
+            ("Extension: 72°C", cycle, 3),
+        ])
+
+    def test_bulk_import_rejects_parent_cycles(self):
+        response = self.client.post('/protocols/bulk', json={
+            "workflow": {"name": "Broken"},
+            "protocol": {"name": "Broken protocol"},
+            "steps": [
+                {"temp_id": "a", "description": "a", "parent": "b"},
+                {"temp_id": "b", "description": "b", "parent": "a"},
+            ],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['message'], "steps form a parent cycle: 'a' -> 'b' -> 'a'")
+        response = self.client.post('/protocols/bulk', json={
+            "protocol": {"name": "Broken protocol"},
+            "steps": [{"temp_id": "self", "description": "loop", "parent": "self"}],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.cursor.execute("SELECT COUNT(*) FROM workflows").fetchone(), (0,))
+
+    def test_protocol_tree(self):
+        from crud_db import create_workflow, create_protocol, create_step, create_parameter
+        create_workflow("PCR Workflow")
+        create_protocol(1, "PCR version 1", "Amplify template")
+        create_step(1, 1, "In PCR tubes of 200 μl", 1)
+        create_step(1, 1, "Add 38 μl sterile water", 2)
+        create_step(1, 3, "Transfer to thermocycler", 3)
+        create_step(1, 3, "Cycle through 30 rounds of", 2)
+        create_step(1, 4, "Annealing: 60°C for 30 seconds", 1)
+        create_step(1, 3, "Final extension: 72°C for 10 min", 1)
+        create_parameter(5, "temperature (°C)", "numeric", "60")
+        create_parameter(5, "time (seconds)", "numeric", "30")
+
+        response = self.client.get('/protocols/1/tree')
+        self.assertEqual(response.status_code, 200)
+        tree = response.get_json()
+        self.assertEqual(tree['name'], "PCR version 1")
+
+        def shape(steps):
+            return [(step['id'], shape(step['children'])) for step in steps]
+        self.assertEqual(shape(tree['steps']), [(1, [(2, [])]), (3, [(6, []), (4, [(5, [])])])])
+        annealing = tree['steps'][1]['children'][1]['children'][0]
+        self.assertEqual([p['name'] for p in annealing['parameters']], ["temperature (°C)", "time (seconds)"])
+
+        from protocol_tree import get_protocol_tree
+        from crud_db import get_protocol_by_id
+        self.assertEqual(get_protocol_tree(get_protocol_by_id(1)), tree)
+        # Streamed through the configured encoder, byte for byte what it makes of the whole tree
+        import serialization
+        default = serialization.backend
+        try:
+            for backend in serialization.BACKENDS if serialization.orjson is not None else ('json',):
+                serialization.set_backend(backend)
+                self.assertEqual(self.client.get('/protocols/1/tree').get_data(as_text=True), serialization.dumps(tree))
+        finally:
+            serialization.set_backend(default)
+        self.assertEqual(self.client.get('/protocols/2/tree').status_code, 404)
+
+    def test_parameters_pagination_projection_and_filters(self):
+        from crud_db import create_parameter
+        self.create_parents('workflows', 'protocols', 'steps')
+        self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": 1, "description": "Second Step", "step_order": 2})
+        for i in range(5):
+            create_parameter(1, "temperature (°C)", "numeric", str(90 + i))
+        create_parameter(2, "temperature (°C)", "numeric", "60")
+        create_parameter(1, "buffer", "categorical", "MgCl2")
+
+        response = self.client.get('/parameters?step_id=1&name=temperature (°C)&fields=value&limit=2')
+        self.assertEqual(response.status_code, 200)
+        page = response.get_json()
+        self.assertEqual(page['data'], [{"id": 1, "value": "90"}, {"id": 2, "value": "91"}])
+
+        seen = [row['value'] for row in page['data']]
+        while page['next']:
+            page = self.client.get('/parameters?step_id=1&name=temperature (°C)&fields=value&limit=2&after=' + page['next']).get_json()
+            seen.extend(row['value'] for row in page['data'])
+        self.assertEqual(seen, ["90", "91", "92", "93", "94"])
+
+        response = self.client.get('/parameters?value_type=categorical')
+        self.assertEqual([row['value'] for row in response.get_json()], ["MgCl2"])
+        self.assertEqual(self.client.get('/parameters?fields=nope').status_code, 400)
+        self.assertEqual(self.client.get('/parameters?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/steps?protocol_id=99').status_code, 404)
+
+    def test_ndjson_export(self):
+        import json
+        import export
+        from crud_db import create_workflow, create_protocol, create_step, create_parameter
+        create_workflow("PCR Workflow")
+        create_protocol(1, "PCR version 1", "Amplify template")
+        for i in range(1, 8):
+            create_step(1, None, "Step %d" % i, i)
+        create_parameter(3, "temperature (°C)", "numeric", "98")
+
+        original_fetch_size = export.FETCH_SIZE
+        export.FETCH_SIZE = 3  # force several fetch batches
+        try:
+            response = self.client.get('/export/steps?fields=description')
+            lines = response.get_data(as_text=True).splitlines()
+        finally:
+            export.FETCH_SIZE = original_fetch_size
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['description'] for line in lines], ["Step %d" % i for i in range(1, 8)])
+
+        response = self.client.get('/steps', headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 7)
+
+        response = self.client.get('/export/protocols/1')
+        tables = [json.loads(line)['table'] for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(tables, ['protocols'] + ['steps'] * 7 + ['parameters'])
+        self.assertEqual(self.client.get('/export/secrets').status_code, 404)
+
+    def test_read_through_cache_invalidation(self):
+        from crud_db import create_protocol, create_step, get_protocol_by_id, get_step_by_id, get_steps_by_protocol_id
+        cache.configure_cache(cache.LRUCache(maxsize=2, ttl=60))
+        try:
+            create_protocol(None, "Cached Protocol", "")
+            create_step(1, None, "root", 1)
+            create_step(1, 1, "child", 1)
+            create_step(1, 2, "grandchild", 1)
+
+            self.assertEqual(get_protocol_by_id(1)[2], "Cached Protocol")
+            self.assertEqual(get_protocol_by_id(1)[2], "Cached Protocol")
+            self.assertEqual(cache.cache_stats()['hits'], 1)
+
+            self.client.put('/protocols/1', json={"workflow_id": None, "name": "Renamed", "description": ""})
+            self.assertEqual(get_protocol_by_id(1)[2], "Renamed")
+
+            self.assertEqual(len(get_steps_by_protocol_id(1)), 3)
+            get_step_by_id(3)
+            self.assertGreaterEqual(cache.cache_stats()['evictions'], 1)  # size bound of 2
+
+            self.client.delete('/steps/2')  # cascades to step 3
+            self.assertIsNone(get_step_by_id(2))
+            self.assertIsNone(get_step_by_id(3))
+            self.assertEqual([step['id'] for step in get_steps_by_protocol_id(1)], [1])
+        finally:
+            cache.configure_cache()
+
+    def test_cache_entries_expire(self):
+        now = [0.0]
+        lru = cache.LRUCache(maxsize=10, ttl=5, clock=lambda: now[0])
+        lru.set('step:1', ('row',))
+        self.assertEqual(lru.get('step:1'), ('row',))
+        now[0] = 5.0
+        self.assertIs(lru.get('step:1'), cache.MISS)
+        self.assertEqual(lru.stats()['expirations'], 1)
+
+    def test_conditional_get_with_etags(self):
+        self.client.post('/workflows', json={"name": "PCR Workflow"})
+        self.client.post('/protocols', json={"workflow_id": 1, "name": "PCR version 1", "description": ""})
+        self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": None, "description": "Mix", "step_order": 1})
+
+        response = self.client.get('/steps/protocol_id/1')
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.last_modified)
+        response = self.client.get('/steps/protocol_id/1', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # a parameter edit bumps the owning protocol's version
+        self.client.post('/parameters', json={"step_id": 1, "name": "volume", "value_type": "numeric", "value": "5"})
+        response = self.client.get('/steps/protocol_id/1', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # different representations of one version get different tags
+        self.assertNotEqual(self.client.get('/steps?limit=1').headers['ETag'], self.client.get('/steps').headers['ETag'])
+        self.assertNotIn('ETag', self.client.get('/protocols/99').headers)
+
+    def test_cached_rows_follow_writes_from_other_connections(self):
+        self.create_parents('workflows', 'protocols', 'steps')
+        first = self.client.get('/protocols/1')
+        self.assertEqual(self.client.get('/protocols/1').get_json()[2], "Parent Protocol")  # now cached
+        self.client.get('/steps/protocol_id/1')
+
+        # Another process writes: no invalidate() reaches this one, the version counter moves
+        self.cursor.execute("UPDATE protocols SET name = 'v2' WHERE id = 1")
+        self.cursor.execute("UPDATE steps SET description = 'Renamed Step' WHERE id = 1")
+        self.conn.commit()
+        response = self.client.get('/protocols/1')
+        self.assertNotEqual(response.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(response.get_json(), [1, 1, "v2", ""])
+        self.assertEqual(self.client.get('/protocols/1', headers={'If-None-Match': first.headers['ETag']}).get_json()[2], "v2")
+        self.assertEqual(b''.join(self.client.get('/protocols/1/tree').response).count(b'"v2"'), 1)
+        self.assertEqual(self.client.get('/steps/protocol_id/1').get_json()[0]['description'], "Renamed Step")
+        self.assertEqual(self.client.get('/steps/1').get_json()[3], "Renamed Step")
+
+    def test_foreign_keys_enforced_and_cascade(self):
+        response = self.client.post('/protocols', json={"workflow_id": 42, "name": "Orphan", "description": ""})
+        self.assertEqual(response.status_code, 409)
+
+        self.create_parents('workflows', 'protocols', 'steps')
+        self.client.post('/parameters', json={"step_id": 1, "name": "volume", "value_type": "numeric", "value": "5"})
+        self.client.delete('/workflows/1')
+        for table in ['protocols', 'steps', 'parameters']:
+            self.assertEqual(self.cursor.execute("SELECT COUNT(*) FROM %s" % table).fetchone(), (0,))
+
+    def test_purge_orphans(self):
+        from maintenance import find_orphans, purge_orphans
+        # rows written before foreign keys were enforced
+        self.cursor.execute("INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (1, 7, NULL, 'orphan', 1)")
+        self.cursor.execute("INSERT INTO steps (id, protocol_id, parent_step_id, description, step_order) VALUES (2, NULL, 1, 'child', 1)")
+        self.cursor.execute("INSERT INTO parameters (step_id, name, value_type, value) VALUES (2, 'volume', 'numeric', '5')")
+        self.conn.commit()
+
+        import db_pool
+        conn = db_pool.open_connection()
+        try:
+            self.assertEqual(list(find_orphans(conn)), ['steps'])
+            purge_orphans(conn)
+            self.assertEqual(find_orphans(conn), {})
+        finally:
+            conn.close()
+        for table in ['steps', 'parameters']:
+            self.assertEqual(self.cursor.execute("SELECT COUNT(*) FROM %s" % table).fetchone(), (0,))
+
+    def test_storage_profile_pragmas(self):
+        import db_pool
+        conn = db_pool.open_connection(profile='throughput')
+        try:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone(), ('wal',))
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone(), (1,))  # NORMAL
+            self.assertEqual(conn.execute("PRAGMA foreign_keys").fetchone(), (1,))
+        finally:
+            conn.close()
+        with self.assertRaises(ValueError):
+            db_pool.configure(profile='fastest')
+
+    def test_benchmark_suite_smoke(self):
+        from benchmarks import suite
+        client = suite.FlaskClient(app)
+        context = suite.populate(client, 'small', seed=1)
+        self.assertEqual(len(context['protocol_ids']), 10)
+        for name in suite.SCENARIOS:
+            result = suite.run_scenario(client, name, context, requests=12, concurrency=2, seed=1, measure_rss=True)
+            self.assertEqual(result['requests'], 12)
+            for endpoint in result['endpoints'].values():
+                self.assertEqual(endpoint['errors'], 0)
+                self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+
+    def test_asgi_adapter_serves_routes(self):
+        import asyncio
+        import json
+        from asgi import AsgiAdapter
+
+        adapter = AsgiAdapter(app, workers=2)
+
+        async def call(method, path, body=b'', query=b''):
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                     'headers': [(b'content-type', b'application/json')], 'http_version': '1.1'}
+            await adapter(scope, receive, send)
+            return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+        async def scenario():
+            status, _ = await call('POST', '/workflows', json.dumps({"name": "Async Workflow"}).encode())
+            self.assertEqual(status, 201)
+            results = await asyncio.gather(*[call('GET', '/workflows/1') for _ in range(10)])
+            self.assertEqual({status for status, _ in results}, {200})
+            self.assertEqual(json.loads(results[0][1])[1], "Async Workflow")
+            status, body = await call('GET', '/export/workflows')
+            self.assertEqual(json.loads(body.splitlines()[0])['name'], "Async Workflow")
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            adapter.shutdown()
+
+    def test_asgi_waits_for_changes_without_request_threads(self):
+        import asyncio
+        import json
+        import changes
+        import db_pool
+        from asgi import AsgiAdapter
+
+        adapter = AsgiAdapter(app)
+        self.assertEqual(adapter.workers, db_pool.POOL_SIZE)
+
+        async def call(method, path, body=b'', query=b'', headers=(), chunks=None, gone=None):
+            # The client stays connected until `gone` is set
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            sent = []
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await (gone or asyncio.Event()).wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if chunks is not None and message['type'] == 'http.response.start':
+                    chunks.put_nowait(dict(message['headers']))
+                if chunks is not None and message.get('body'):
+                    chunks.put_nowait(message['body'])
+
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                     'headers': [(b'content-type', b'application/json')] + list(headers), 'http_version': '1.1'}
+            await adapter(scope, receive, send)
+            return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+        async def scenario():
+            self.create_parents('workflows')
+            status, _, body = await call('GET', '/changes')
+            since = json.loads(body)['next']
+            # Waits are sent uncompressed even to clients accepting gzip
+            gzip = [(b'accept-encoding', b'gzip')]
+            query = b'since=%d&wait=10' % since
+            polls = [asyncio.create_task(call('GET', '/changes', query=query, headers=gzip)) for _ in range(db_pool.POOL_SIZE)]
+            events = asyncio.Queue()
+            stream = asyncio.create_task(call('GET', '/changes', query=b'since=%d' % since,
+                                              headers=[(b'accept', b'text/event-stream')] + gzip, chunks=events))
+            self.assertNotIn(b'content-encoding', await asyncio.wait_for(events.get(), 5))
+            self.assertEqual(await asyncio.wait_for(events.get(), 5), b'retry: 2000\n\n')
+
+            # Every long-poll is open, yet ordinary requests still get a thread
+            status, _, body = await asyncio.wait_for(call('GET', '/workflows/1'), 5)
+            self.assertEqual((status, json.loads(body)[1]), (200, "Parent Workflow"))
+            self.assertFalse(any(poll.done() for poll in polls))
+            status, _, _ = await asyncio.wait_for(call('POST', '/workflows', json.dumps({"name": "Late Workflow"}).encode()), 5)
+            self.assertEqual(status, 201)
+
+            for status, headers, body in await asyncio.wait_for(asyncio.gather(*polls), 5):
+                self.assertEqual(status, 200)
+                self.assertNotIn(b'content-encoding', headers)
+                self.assertEqual([(c['table_name'], c['op']) for c in json.loads(body)['data']], [('workflows', 'insert')])
+            self.assertTrue((await asyncio.wait_for(events.get(), 5)).startswith(b'id: %d\nevent: change\n' % (since + 1)))
+            stream.cancel()
+            await asyncio.gather(stream, return_exceptions=True)
+
+            # A client leaving mid-stream stops it, and with it the notifier's polling
+            notifier = changes.get_notifier()
+            gone = asyncio.Event()
+            events = asyncio.Queue()
+            stream = asyncio.create_task(call('GET', '/changes', query=b'since=%d' % (since + 1),
+                                              headers=[(b'accept', b'text/event-stream')], chunks=events, gone=gone))
+            await asyncio.wait_for(events.get(), 5)
+            self.assertEqual(await asyncio.wait_for(events.get(), 5), b'retry: 2000\n\n')
+            while not notifier._waiters:
+                await asyncio.sleep(0.01)
+            gone.set()
+            await asyncio.wait_for(stream, 5)
+            self.assertEqual(notifier._waiters, 0)
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            adapter.shutdown()
+
+    def test_asgi_slow_streams_do_not_starve_requests(self):
+        import asyncio
+        import json
+        import db_pool
+        from asgi import AsgiAdapter
+
+        adapter = AsgiAdapter(app)
+        resume = None
+
+        async def call(method, path, slow=False):
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if slow and message.get('body'):
+                    await resume.wait()  # a client slow to read: the stream keeps its connection
+
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': [], 'http_version': '1.1'}
+            await adapter(scope, receive, send)
+            return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+        async def scenario():
+            nonlocal resume
+            resume = asyncio.Event()
+            self.create_parents('workflows', 'protocols', 'steps')
+            streams = [asyncio.create_task(call('GET', '/export/steps', slow=True)) for _ in range(db_pool.POOL_SIZE)]
+            await asyncio.sleep(0.2)
+            # As many new requests as there are threads arrive while every stream is stalled
+            requests = [asyncio.create_task(call('GET', '/workflows/1')) for _ in range(db_pool.POOL_SIZE)]
+            await asyncio.sleep(0.2)
+            resume.set()
+            results = await asyncio.wait_for(asyncio.gather(*streams, *requests), 10)
+            self.assertEqual({status for status, _ in results}, {200})
+            self.assertEqual(json.loads(results[-1][1])[1], "Parent Workflow")
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            adapter.shutdown()
+
+    def test_write_pipeline_group_commit(self):
+        import crud_db
+        import write_pipeline
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.create_parents('workflows', 'protocols')
+        pipeline = write_pipeline.enable(batch_size=64, batch_delay=0.05)
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                ids = [row['id'] for row in executor.map(lambda n: crud_db.create_step(1, None, "Step %d" % n, n), range(40))]
+            self.assertEqual(len(set(ids)), 40)
+
+            # A failing write is rolled back on its own; its batch-mates still commit
+            failing = pipeline.submit(crud_db.create_step.direct, 99, None, "Orphan", 1)
+            passing = pipeline.submit(crud_db.create_parameter.direct, ids[0], "volume", "numeric", "50")
+            self.assertRaises(sqlite3.IntegrityError, failing.result)
+            self.assertIsNotNone(passing.result())
+
+            response = self.client.post('/workflows', json={"name": "Queued Workflow"})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(self.client.get('/workflows/%d' % response.get_json()['id']).get_json()[1], "Queued Workflow")
+
+            stats = self.client.get('/pipeline/stats').get_json()
+            self.assertEqual(stats['failed'], 1)
+            self.assertLess(stats['batches'], stats['committed'])
+        finally:
+            write_pipeline.disable()
+        self.assertEqual(self.client.get('/pipeline/stats').get_json(), {'enabled': False})
+        self.assertEqual(len(self.client.get('/steps?protocol_id=1').get_json()), 40)
+
+    def test_writes_return_rows(self):
+        response = self.client.post('/workflows', json={"name": "Returned Workflow"})
+        self.assertEqual(response.status_code, 201)
+        workflow = response.get_json()
+        self.assertEqual(workflow['name'], "Returned Workflow")
+        self.assertEqual(response.headers['Location'], '/workflows/%d' % workflow['id'])
+
+        response = self.client.post('/protocols', json={"workflow_id": workflow['id'], "name": "Returned Protocol", "description": "d"},
+                                    headers={'Prefer': 'return=minimal'})
+        self.assertEqual(response.get_json(), {"message": "Protocol created successfully!", "id": 1})
+        self.assertEqual(response.headers['Preference-Applied'], 'return=minimal')
+
+        response = self.client.put('/protocols/1', json={"workflow_id": workflow['id'], "name": "Renamed", "description": None})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"id": 1, "workflow_id": workflow['id'], "name": "Renamed", "description": None})
+        self.assertEqual(response.headers['Content-Location'], '/protocols/1')
+
+        response = self.client.put('/workflows/99', json={"name": "Missing"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_step_subtree_operations(self):
+        document = {
+            "workflow": {"name": "Subtree Workflow"},
+            "protocol": {"name": "Source"},
+            "steps": [
+                {"temp_id": "a", "description": "A", "parameters": [{"name": "volume", "value_type": "numeric", "value": "5"}],
+                 "children": [{"temp_id": "a1", "description": "A1", "children": [{"temp_id": "a1x", "description": "A1x"}]},
+                              {"temp_id": "a2", "description": "A2"}]},
+                {"temp_id": "b", "description": "B"},
+            ],
+        }
+        ids = self.client.post('/protocols/bulk', json=document).get_json()['steps']
+        target = self.client.post('/protocols', json={"workflow_id": 1, "name": "Target", "description": ""}).get_json()['id']
+
+        # Moving A under its own grandchild would create a cycle
+        response = self.client.post('/steps/%d/move' % ids['a'], json={"parent_step_id": ids['a1x']})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/steps/%d/move' % ids['a1'], json={"parent_step_id": ids['b']})
+        self.assertEqual(response.get_json()['moved'], 2)
+        self.assertEqual(self.client.get('/steps/%d' % ids['a1']).get_json()[2], ids['b'])
+
+        response = self.client.post('/steps/%d/copy' % ids['a'], json={"protocol_id": target})
+        self.assertEqual(response.status_code, 201)
+        copy = response.get_json()
+        tree = self.client.get('/protocols/%d/tree' % target).get_json()
+        self.assertEqual([step['description'] for step in tree['steps']], ["A"])
+        self.assertEqual([child['description'] for child in tree['steps'][0]['children']], ["A2"])
+        self.assertEqual(tree['steps'][0]['parameters'][0]['value'], "5")
+        self.assertEqual(copy['id'], tree['steps'][0]['id'])
+
+        response = self.client.post('/protocols/1/renumber', json={"order": [ids['b']]})
+        self.assertEqual(response.get_json()['order'], [ids['b'], ids['a']])
+        self.assertEqual([step['description'] for step in self.client.get('/protocols/1/tree').get_json()['steps']], ["B", "A"])
+        self.assertEqual(self.client.post('/protocols/999/renumber', json={"order": []}).status_code, 404)
+        for order in (["a"], [[ids['b']]], [True], ids['b']):
+            self.assertEqual(self.client.post('/protocols/1/renumber', json={"order": order}).status_code, 400)
+
+        response = self.client.delete('/steps/%d/subtree' % ids['b'])
+        self.assertEqual(response.get_json()['deleted'], 3)
+        self.assertEqual(self.client.get('/steps/%d' % ids['a1x']).status_code, 404)
+        self.assertEqual(self.client.delete('/steps/%d/subtree' % ids['b']).status_code, 404)
+
+    def test_step_hierarchy_closure(self):
+        from maintenance import rebuild_closure
+        self.create_parents('workflows', 'protocols')
+        for parent, order in [(None, 1), (1, 1), (2, 1), (2, 2), (4, 1)]:
+            self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": parent, "description": "Step", "step_order": order})
+
+        self.assertEqual([step['id'] for step in self.client.get('/steps/1/descendants').get_json()], [2, 3, 4, 5])
+        self.assertEqual([step['id'] for step in self.client.get('/steps/1/descendants?max_depth=1').get_json()], [2])
+        self.assertEqual([step['id'] for step in self.client.get('/steps/5/ancestors').get_json()], [1, 2, 4])
+        self.assertEqual(self.client.get('/steps/5/depth').get_json(), {"id": 5, "depth": 3})
+        self.assertEqual(self.client.get('/steps/9/depth').status_code, 404)
+
+        # Re-parenting moves the whole subtree; a cycle is refused by the schema itself
+        self.client.put('/steps/4', json={"protocol_id": 1, "parent_step_id": 1, "description": "Step", "step_order": 2})
+        self.assertEqual([step['id'] for step in self.client.get('/steps/5/ancestors').get_json()], [1, 4])
+        response = self.client.put('/steps/1', json={"protocol_id": 1, "parent_step_id": 5, "description": "Step", "step_order": 1})
+        self.assertEqual(response.status_code, 409)
+
+        self.client.delete('/steps/2')
+        self.assertEqual([step['id'] for step in self.client.get('/steps/1/descendants').get_json()], [4, 5])
+
+        expected = self.cursor.execute("SELECT * FROM step_closure ORDER BY 1, 2").fetchall()
+        self.assertEqual(rebuild_closure(self.conn), len(expected))
+        self.assertEqual(self.cursor.execute("SELECT * FROM step_closure ORDER BY 1, 2").fetchall(), expected)
+
+    def test_numeric_parameter_ranges_and_stats(self):
+        self.create_parents('workflows', 'protocols', 'steps')
+        for name, value_type, value in [("temperature (°C)", "numeric", "98"), ("temperature (°C)", "numeric", "60"),
+                                        ("temperature (°C)", "numeric", "67"), ("time (seconds)", "numeric", "30"),
+                                        ("dNTPs (50 μM)", "numeric", "1"), ("enzyme", "categorical", "Taq"),
+                                        ("time (seconds)", "numeric", "e5"), ("time (seconds)", "numeric", "-e3"),
+                                        ("time (seconds)", "numeric", ".e1"), ("time (seconds)", "numeric", "1e5e3")]:
+            self.client.post('/parameters', json={"step_id": 1, "name": name, "value_type": value_type, "value": value})
+
+        rows = self.client.get('/parameters/numeric?name=temperature (°C)&max=68').get_json()
+        self.assertEqual([(row['numeric_value'], row['unit'], row['protocol_id']) for row in rows], [(60.0, "°C", 1), (67.0, "°C", 1)])
+        self.assertEqual(len(self.client.get('/parameters/numeric?min=30').get_json()), 4)
+        self.assertEqual(self.client.get('/parameters/numeric?max=hot').status_code, 400)
+        self.assertEqual(len(self.client.get('/parameters/numeric?name=time (seconds)').get_json()), 1)  # no digit, no number
+
+        stats = self.client.get('/parameters/numeric/stats?unit=°C').get_json()
+        self.assertEqual(stats, [{"name": "temperature (°C)", "unit": "°C", "count": 3, "protocols": 1, "min": 60.0, "max": 98.0, "avg": 75.0}])
+        names = [(row['name'], row['unit']) for row in self.client.get('/parameters/numeric/stats').get_json()]
+        self.assertEqual(names, [("dNTPs (50 μM)", None), ("temperature (°C)", "°C"), ("time (seconds)", "seconds")])
+
+    def test_full_text_search(self):
+        self.create_parents('workflows')
+        self.client.post('/protocols', json={"workflow_id": 1, "name": "PCR annealing", "description": "Touchdown PCR"})
+        self.client.post('/protocols', json={"workflow_id": 1, "name": "Gel", "description": "Agarose gel"})
+        self.client.post('/steps', json={"protocol_id": 2, "parent_step_id": None, "description": "Add reaction buffer with MgCl2", "step_order": 1})
+        self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": None, "description": "Annealing at 60°C", "step_order": 1})
+
+        hits = self.client.get('/search?q=annealing').get_json()['data']
+        self.assertEqual([(hit['type'], hit['id']) for hit in hits], [('protocol', 1), ('step', 2)])
+        self.assertIn('<mark>Annealing</mark>', hits[1]['snippet'])
+
+        hits = self.client.get('/search?q=mgcl*').get_json()['data']
+        self.assertEqual([(hit['type'], hit['protocol_id'], hit['workflow_id']) for hit in hits], [('step', 2, 1)])
+
+        page = self.client.get('/search?q=anneal*&limit=1').get_json()
+        self.assertEqual(len(page['data']), 1)
+        page = self.client.get('/search?q=anneal*&limit=1&offset=' + page['next']).get_json()
+        self.assertEqual((page['data'][0]['type'], page['next']), ('step', None))
+
+        # Edits and deletes reach the index through the triggers
+        self.client.put('/steps/2', json={"protocol_id": 1, "parent_step_id": None, "description": "Extension at 72°C", "step_order": 1})
+        self.assertEqual(self.client.get('/search?q=annealing&type=step').get_json()['data'], [])
+        self.client.delete('/protocols/1')
+        self.assertEqual(self.client.get('/search?q=annealing').get_json()['data'], [])
+        self.assertEqual(self.client.get('/search?q="').status_code, 400)
+
+    def test_protocol_versions_share_unchanged_steps(self):
+        from maintenance import gc_versions
+        document = {
+            "workflow": {"name": "Versioned Workflow"},
+            "protocol": {"name": "PCR", "description": "v1"},
+            "steps": [
+                {"temp_id": "mix", "description": "Prepare the mix",
+                 "children": [{"temp_id": "water", "description": "Add water", "parameters": [{"name": "volume (μl)", "value_type": "numeric", "value": "38"}]},
+                              {"temp_id": "primer", "description": "Add primer"}]},
+                {"temp_id": "cycle", "description": "Cycle", "children": [{"temp_id": "anneal", "description": "Anneal at 60°C"}]},
+                {"temp_id": "store", "description": "Store at 4°C"},
+            ],
+        }
+        ids = self.client.post('/protocols/bulk', json=document).get_json()['steps']
+        response = self.client.post('/protocols/1/versions', json={"message": "first"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['Location'], '/protocols/1/versions/1')
+        self.assertEqual(response.get_json()['new_nodes'], 7)
+
+        # Edit one parameter, move one step, remove one: only the touched paths are stored again
+        self.client.put('/parameters/1', json={"step_id": ids['water'], "name": "volume (μl)", "value_type": "numeric", "value": "40"})
+        self.client.post('/steps/%d/move' % ids['primer'], json={"parent_step_id": ids['cycle']})
+        self.client.delete('/steps/%d' % ids['anneal'])
+        self.client.post('/steps', json={"protocol_id": 1, "parent_step_id": None, "description": "Freeze", "step_order": 9})
+        self.assertEqual(self.client.post('/protocols/1/versions').get_json()['new_nodes'], 5)
+
+        self.assertEqual([version['message'] for version in self.client.get('/protocols/1/versions').get_json()], ["first", None])
+        old = self.client.get('/protocols/1/versions/1')
+        self.assertEqual(old.headers['Cache-Control'], 'public, no-cache')
+        etag = old.headers['ETag']
+        self.assertEqual(self.client.get('/protocols/1/versions/1', headers={'If-None-Match': etag}).status_code, 304)
+        old = old.get_json()
+        self.assertEqual([step['description'] for step in old['steps']], ["Prepare the mix", "Cycle", "Store at 4°C"])
+        self.assertEqual(old['steps'][0]['children'][0]['parameters'][0]['value'], "38")
+
+        diff = self.client.get('/protocols/1/versions/1/diff/2').get_json()
+        self.assertEqual([step['description'] for step in diff['added']], ["Freeze"])
+        self.assertEqual([step['description'] for step in diff['removed']], ["Anneal at 60°C"])
+        self.assertEqual(diff['moved'], [{"id": ids['primer'], "from_parent_step_id": ids['mix'], "to_parent_step_id": ids['cycle']}])
+        self.assertEqual(diff['modified'], [{"id": ids['water'], "changes": {"parameters": [[["volume (μl)", "numeric", "38"]], [["volume (μl)", "numeric", "40"]]]}}])
+        self.assertEqual(self.client.get('/protocols/1/versions/3').status_code, 404)
+
+        self.client.delete('/protocols/1')
+        self.assertEqual(gc_versions(self.conn), 12)
+
+        # A re-created protocol 1 reuses the URL, so the old ETag must not validate
+        self.client.post('/protocols', json={"workflow_id": None, "name": "Another protocol", "description": ""})
+        self.client.post('/protocols/1/versions')
+        response = self.client.get('/protocols/1/versions/1', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.get_json()['name']), (200, "Another protocol"))
+
+    def test_request_metrics_and_slow_queries(self):
+        import metrics
+        import db_pool
+        self.create_parents('workflows')
+        self.assertEqual(self.client.get('/metrics/config').get_json()['enabled'], False)
+        metrics.reset()
+        self.client.put('/metrics/config', json={"enabled": True, "slow_query_ms": 0})
+        try:
+            self.assertIs(db_pool.cursor_factory, metrics.TimedCursor)
+            # Requests are recorded when the server closes the response
+            self.client.get('/workflows/1').close()
+            self.client.get('/export/workflows', headers={'Accept': 'application/x-ndjson'}).close()
+            text = self.client.get('/metrics').data.decode()
+            self.assertIn('protocol_registry_request_duration_seconds_count{endpoint="get_a_workflow",method="GET"} 1', text)
+            self.assertIn('protocol_registry_request_rows_sum{endpoint="get_a_workflow",method="GET"} 2', text)
+            self.assertIn('protocol_registry_requests_total{endpoint="get_a_workflow",method="GET",status="200"} 1', text)
+            self.assertIn('protocol_registry_response_bytes_count{endpoint="export_table",method="GET"} 1', text)
+            self.assertIn('protocol_registry_pool_in_use{db="protocols_registry.db"}', text)
+            plans = [entry['plan'] for entry in self.client.get('/metrics/slow_queries').get_json() if entry['sql'].startswith('SELECT id, name FROM workflows WHERE')]
+            self.assertIn('SEARCH workflows USING INTEGER PRIMARY KEY (rowid=?)', plans[0])
+        finally:
+            self.client.put('/metrics/config', json={"enabled": False, "slow_query_ms": 100})
+        self.assertIs(db_pool.cursor_factory, sqlite3.Cursor)
+        count = metrics.render().count('\n')
+        self.client.get('/workflows/1').close()
+        self.assertEqual(metrics.render().count('\n'), count)
+        for body in ({"enabled": "false"}, {"enabled": 0.0001}, {"enabled": None}, {"slow_query_ms": True}):
+            self.assertEqual(self.client.put('/metrics/config', json=body).status_code, 400)
+        self.assertEqual(self.client.get('/metrics/config').get_json()['enabled'], False)
+
+    def test_columnar_shape_and_compression(self):
+        import gzip
+        import serialization
+        from crud_db import create_step
+        self.create_parents('workflows', 'protocols')
+        for i in range(1, 41):
+            create_step(1, None, "Step %d" % i, i)
+        self.assertIsInstance(app.json, serialization.FastJSONProvider)
+
+        page = self.client.get('/steps?shape=columnar&fields=description&limit=2').get_json()
+        self.assertEqual(page, {"columns": ["id", "description"], "rows": [[1, "Step 1"], [2, "Step 2"]], "next": "2"})
+        page = self.client.get('/steps?shape=columnar&fields=step_order&after=38').get_json()
+        self.assertEqual(page, {"columns": ["id", "step_order"], "rows": [[39, 39], [40, 40]], "next": None})
+        self.assertEqual(self.client.get('/steps?shape=rows').status_code, 400)
+
+        plain = self.client.get('/steps')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        response = self.client.get('/steps', headers={'Accept-Encoding': 'br;q=1, gzip;q=0.5'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertNotEqual(response.headers['ETag'], plain.headers['ETag'])
+        response = self.client.get('/steps', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/export/steps', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(len(gzip.decompress(response.data).splitlines()), 40)
+        # Too small to be worth compressing
+        self.assertNotIn('Content-Encoding', self.client.get('/steps/1', headers={'Accept-Encoding': 'gzip'}).headers)
+
+    def test_change_feed_and_delta(self):
+        import threading
+        import maintenance
+        from crud_db import create_protocol, create_step, create_parameter, update_step, delete_step
+        head = self.client.get('/changes').get_json()
+        self.assertEqual(head['data'], [])
+        since = head['next']
+        self.create_parents('workflows', 'protocols')
+        create_protocol(1, "Other Protocol", "")
+        create_step(1, None, "denature", 1)
+        create_step(1, 1, "hold", 1)
+        create_parameter(2, "temperature (°C)", "numeric", "95")
+        create_step(2, None, "elsewhere", 1)
+
+        page = self.client.get('/changes?since=%d' % since).get_json()
+        self.assertEqual([(c['table_name'], c['row_id'], c['op']) for c in page['data']], [
+            ('workflows', 1, 'insert'), ('protocols', 1, 'insert'), ('protocols', 2, 'insert'),
+            ('steps', 1, 'insert'), ('steps', 2, 'insert'), ('parameters', 1, 'insert'), ('steps', 3, 'insert')])
+        page = self.client.get('/changes?since=%d&protocol_id=1' % since).get_json()
+        self.assertEqual(len(page['data']), 4)
+        mark = page['next']
+
+        update_step(1, 1, None, "denature template", 1)
+        delete_step(1)  # cascades to the child step and its parameter
+        page = self.client.get('/changes?since=%d&protocol_id=1' % mark).get_json()
+        self.assertEqual(sorted((c['table_name'], c['row_id'], c['op']) for c in page['data']), [
+            ('parameters', 1, 'delete'), ('steps', 1, 'delete'), ('steps', 1, 'update'), ('steps', 2, 'delete')])
+
+        delta = self.client.get('/changes/delta?since=%d&protocol_id=1' % since).get_json()
+        self.assertEqual(delta['upserts'], {'protocols': [{'id': 1, 'workflow_id': 1, 'name': "Parent Protocol", 'description': ""}]})
+        self.assertEqual(delta['deletes'], {'parameters': [1], 'steps': [1, 2]})
+        self.assertFalse(delta['more'])
+
+        # Long-poll: the request is answered as soon as the write commits
+        mark = self.client.get('/changes').get_json()['next']
+        timer = threading.Timer(0.2, create_step, (2, None, "late", 2))
+        timer.start()
+        page = self.client.get('/changes?since=%d&protocol_id=2&wait=5' % mark).get_json()
+        timer.join()
+        self.assertEqual([(c['row_id'], c['op']) for c in page['data']], [(4, 'insert')])
+        self.assertEqual(self.client.get('/changes?since=%d&wait=0' % page['next']).get_json()['data'], [])
+
+        response = self.client.get('/changes?protocol_id=2', headers={'Accept': 'text/event-stream', 'Last-Event-ID': str(mark)})
+        events = iter(response.response)
+        self.assertEqual(next(events), b'retry: 2000\n\n')
+        self.assertTrue(next(events).startswith(b'id: %d\nevent: change\ndata: {' % page['next']))
+        response.close()
+
+        maintenance.prune_changes(self.conn, float('inf'))
+        self.assertEqual(self.client.get('/changes?since=%d' % since).status_code, 410)
+        self.assertEqual(self.client.get('/changes?since=%d' % page['next']).get_json()['data'], [])
+        self.assertEqual(self.client.get('/changes?wait=99').status_code, 400)
+
+    def test_read_replicas_with_sequence_tokens(self):
+        import os
+        import db_pool
+        import replication
+        paths = replication.replica_paths(2)
+        replication.refresh_replicas(paths)
+        replication.enable(2)
+        try:
+            response = self.client.post('/workflows', json={"name": "Replicated Workflow"})
+            token = int(response.headers['X-Registry-Seq'])
+            # The replicas predate the write: without the token a read may miss it,
+            # with it the read falls back to the primary
+            response = self.client.get('/workflows')
+            self.assertEqual(response.status_code, 404)
+            self.assertLess(int(response.headers['X-Registry-Seq']), token)
+            response = self.client.get('/workflows', headers={'X-Registry-Seq': str(token)})
+            self.assertEqual(response.get_json()[0]['name'], "Replicated Workflow")
+            self.assertNotIn('X-Registry-Seq', response.headers)
+
+            self.assertEqual(replication.refresh_replicas(paths), token)
+            for _ in paths:
+                response = self.client.get('/workflows', headers={'X-Registry-Seq': str(token)})
+                self.assertEqual(response.get_json()[0]['name'], "Replicated Workflow")
+                self.assertEqual(response.headers['X-Registry-Seq'], str(token))
+            self.assertTrue(all(db_pool.pool_stats()[path]['profile'] == 'read-replica' for path in paths))
+            stats = self.client.get('/replication/stats').get_json()
+            self.assertEqual([replica['seq'] for replica in stats['replicas']], [token, token])
+            self.assertEqual(stats['stale_fallbacks'], 1)
+        finally:
+            replication.disable()
+            for path in paths:
+                os.remove(path)
+
+    def test_sharding_by_workflow(self):
+        import os
+        import shutil
+        import tempfile
+        import sharding
+        directory = tempfile.mkdtemp()
+        sharding.enable(os.path.join(directory, 'catalog.db'), os.path.join(directory, 'shards'))
+        try:
+            self.assertEqual(self.client.post('/protocols', json={"workflow_id": None, "name": "Unfiled PCR", "description": ""}).get_json()['id'], 1)
+            first = self.client.post('/workflows', json={"name": "PCR Workflow"}).get_json()['id']
+            second = self.client.post('/workflows', json={"name": "Cloning Workflow"}).get_json()['id']
+            pcr = self.client.post('/protocols', json={"workflow_id": first, "name": "PCR version 1", "description": ""}).get_json()['id']
+            cloning = self.client.post('/protocols', json={"workflow_id": second, "name": "Cloning PCR", "description": ""}).get_json()['id']
+            self.assertEqual((pcr, cloning), (1001, 2001))  # each shard draws ids from its own block
+            step = self.client.post('/steps', json={"protocol_id": pcr, "parent_step_id": None, "description": "denature", "step_order": 1}).get_json()['id']
+            self.client.post('/parameters', json={"step_id": step, "name": "temperature (°C)", "value_type": "numeric", "value": "95"})
+            other = self.client.post('/steps', json={"protocol_id": cloning, "parent_step_id": None, "description": "ligate", "step_order": 1}).get_json()['id']
+
+            # A workflow that is not created leaves no shard behind, and its shard id is not reused
+            shards = sharding.all_shards()
+            self.assertGreaterEqual(self.client.post('/workflows', json={"name": None}).status_code, 400)
+            self.assertGreaterEqual(self.client.post('/protocols/bulk', json={"workflow": {"name": None}, "protocol": {}}).status_code, 400)
+            self.assertEqual(sharding.all_shards(), shards)
+            files = [name for name in os.listdir(os.path.join(directory, 'shards')) if name.endswith('.db')]
+            self.assertEqual(sorted(files), ['workflow-%d.db' % first, 'workflow-%d.db' % second])
+            third = self.client.post('/workflows', json={"name": "Sequencing Workflow"}).get_json()['id']
+            self.assertEqual(sharding._catalog.shard_id(sharding._catalog.shard_of('workflows', third)), 5)
+
+            # The rows live in the workflow's own file
+            shard = sqlite3.connect(os.path.join(directory, 'shards', 'workflow-%d.db' % first))
+            self.assertEqual(shard.execute("SELECT name FROM protocols").fetchall(), [("PCR version 1",)])
+            shard.close()
+            self.assertEqual(self.client.get('/steps/%d' % step).get_json()[3], "denature")
+            self.assertEqual(len(self.client.get('/protocols/%d/tree' % pcr).get_json()['steps']), 1)
+            self.assertEqual(self.client.post('/steps', json={"protocol_id": pcr, "parent_step_id": other, "description": "x", "step_order": 2}).status_code, 409)
+
+            # Collections merge every shard in id order
+            self.assertEqual([row['id'] for row in self.client.get('/protocols').get_json()], [1, pcr, cloning])
+            page = self.client.get('/protocols?limit=2&fields=name').get_json()
+            self.assertEqual(([row['id'] for row in page['data']], page['next']), ([1, pcr], str(pcr)))
+            page = self.client.get('/protocols?limit=2&after=' + page['next']).get_json()
+            self.assertEqual(([row['id'] for row in page['data']], page['next']), ([cloning], None))
+            self.assertEqual([row['name'] for row in self.client.get('/protocols?workflow_id=%d' % second).get_json()], ["Cloning PCR"])
+            lines = self.client.get('/export/steps').get_data(as_text=True).splitlines()
+            self.assertEqual(len(lines), 2)
+            hits = self.client.get('/search?q=pcr&type=protocol').get_json()['data']
+            self.assertEqual(sorted(hit['id'] for hit in hits), [1, pcr, cloning])
+
+            etag = self.client.get('/steps').headers['ETag']
+            self.client.put('/steps/%d' % other, json={"protocol_id": cloning, "parent_step_id": None, "description": "ligate overnight", "step_order": 1})
+            self.assertEqual(self.client.get('/steps', headers={'If-None-Match': etag}).status_code, 200)
+
+            response = self.client.post('/batch', json=[
+                {"op": "create", "table": "steps", "ref": "extend", "data": {"protocol_id": pcr, "parent_step_id": None, "description": "extend", "step_order": 2}},
+                {"op": "create", "table": "parameters", "data": {"step_id": {"$ref": "extend"}, "name": "time (s)", "value_type": "numeric", "value": "60"}},
+            ])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.client.get('/steps?protocol_id=%d' % pcr).get_json()[1]['description'], "extend")
+            response = self.client.post('/batch', json=[{"op": "delete", "table": "steps", "id": step}, {"op": "delete", "table": "steps", "id": other}])
+            self.assertEqual(response.status_code, 400)  # two workflows, two files
+
+            # Explicit ids must come from the catalog's blocks for the shard written to
+            import repository
+            self.assertRaises(sharding.ShardingError, repository.PROTOCOLS.upsert_many, [(pcr, first, "Moved", ""), (5000000, None, "Unallocated", "")])
+            self.assertEqual(repository.PROTOCOLS.upsert_many([(1, None, "Unfiled PCR renamed", "")]), 1)
+
+            self.assertEqual(self.client.get('/changes').status_code, 501)
+            self.client.delete('/protocols')
+            self.assertEqual(self.client.get('/steps').status_code, 404)
+        finally:
+            sharding.disable()
+            shutil.rmtree(directory)
+
+    def test_sharded_writes_and_reads_use_the_pipeline_and_cache(self):
+        import os
+        import shutil
+        import tempfile
+        import sharding
+        import write_pipeline
+        directory = tempfile.mkdtemp()
+        sharding.enable(os.path.join(directory, 'catalog.db'), os.path.join(directory, 'shards'))
+        write_pipeline.enable(batch_size=16, batch_delay=0.01)
+        try:
+            workflow = self.client.post('/workflows', json={"name": "PCR Workflow"}).get_json()['id']
+            protocol = self.client.post('/protocols', json={"workflow_id": workflow, "name": "PCR", "description": ""}).get_json()['id']
+            step = self.client.post('/steps', json={"protocol_id": protocol, "parent_step_id": None, "description": "denature", "step_order": 1}).get_json()['id']
+
+            # Writes routed to the workflow's shard go through that shard's own writer
+            path = os.path.join(directory, 'shards', 'workflow-%d.db' % workflow)
+            shards = self.client.get('/pipeline/stats').get_json()['shards']
+            self.assertEqual(list(shards), [path])
+            self.assertEqual(shards[path]['committed'], 3)  # the workflow, its protocol and step
+
+            # and reads routed there are cached, then dropped by the next write
+            cache.reset_stats()
+            self.assertEqual(self.client.get('/steps/%d' % step).get_json()[3], "denature")
+            self.assertEqual(self.client.get('/steps/%d' % step).get_json()[3], "denature")
+            self.assertEqual(cache.cache_stats()['hits'], 1)
+            self.client.put('/steps/%d' % step, json={"protocol_id": protocol, "parent_step_id": None, "description": "denature 30s", "step_order": 1})
+            self.assertEqual(self.client.get('/steps/%d' % step).get_json()[3], "denature 30s")
+        finally:
+            write_pipeline.disable()
+            sharding.disable()
+            shutil.rmtree(directory)
+
+    def test_batch_applies_operations_atomically(self):
+        import write_pipeline
+        self.create_parents('workflows')
+        operations = [
+            {"op": "create", "table": "protocols", "ref": "pcr", "data": {"workflow_id": 1, "name": "PCR", "description": ""}},
+            {"op": "create", "table": "steps", "ref": "mix", "data": {"protocol_id": {"$ref": "pcr"}, "parent_step_id": None, "description": "Prepare the mix", "step_order": 1}},
+            {"op": "create", "table": "steps", "ref": "water", "data": {"protocol_id": {"$ref": "pcr"}, "parent_step_id": {"$ref": "mix"}, "description": "Add water", "step_order": 1}},
+            {"op": "create", "table": "parameters", "ref": "volume", "data": {"step_id": {"$ref": "water"}, "name": "volume (μl)", "value_type": "numeric", "value": "38"}},
+            {"op": "update", "table": "steps", "id": {"$ref": "mix"}, "data": {"protocol_id": {"$ref": "pcr"}, "parent_step_id": None, "description": "Prepare the master mix", "step_order": 1}},
+            {"op": "delete", "table": "parameters", "id": {"$ref": "volume"}},
+        ]
+        response = self.client.post('/batch', json=operations)
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([(result['op'], result['status']) for result in results],
+                         [('create', 201)] * 4 + [('update', 200), ('delete', 200)])
+        self.assertEqual(results[2]['row']['parent_step_id'], results[1]['id'])
+        self.assertEqual(self.client.get('/steps/%d' % results[1]['id']).get_json()[3], "Prepare the master mix")
+        self.assertEqual(self.client.get('/parameters').status_code, 404)
+
+        # Any failure rolls back the operations before it
+        response = self.client.post('/batch', json=[
+            {"op": "create", "table": "steps", "data": {"protocol_id": 1, "parent_step_id": None, "description": "Rolled back", "step_order": 2}},
+            {"op": "update", "table": "steps", "id": 99, "data": {"protocol_id": 1, "description": "Missing"}},
+        ])
+        self.assertEqual((response.status_code, response.get_json()['index']), (404, 1))
+        response = self.client.post('/batch', json=[
+            {"op": "create", "table": "steps", "data": {"protocol_id": 1, "parent_step_id": None, "description": "Rolled back", "step_order": 2}},
+            {"op": "create", "table": "parameters", "data": {"step_id": 99, "name": "orphan"}},
+        ], headers={'Prefer': 'return=minimal'})
+        self.assertEqual((response.status_code, response.get_json()['index']), (409, 1))
+        self.assertEqual(len(self.client.get('/steps').get_json()), 2)
+
+        response = self.client.post('/batch', json=[{"op": "delete", "table": "steps", "id": {"$ref": "later"}}])
+        self.assertEqual((response.status_code, response.get_json()['index']), (400, 0))
+        self.assertEqual(self.client.post('/batch', json={"op": "create"}).status_code, 400)
+
+        # The whole batch is one operation for the write pipeline
+        write_pipeline.enable()
+        try:
+            response = self.client.post('/batch', json=[
+                {"op": "create", "table": "steps", "ref": "cycle", "data": {"protocol_id": 1, "parent_step_id": None, "description": "Cycle", "step_order": 2}},
+                {"op": "create", "table": "steps", "data": {"protocol_id": 1, "parent_step_id": {"$ref": "cycle"}, "description": "Anneal", "step_order": 1}},
+            ], headers={'Prefer': 'return=minimal'})
+        finally:
+            write_pipeline.disable()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Preference-Applied'], 'return=minimal')
+        self.assertEqual([sorted(result) for result in response.get_json()['results']], [['id', 'op', 'ref', 'status', 'table'], ['id', 'op', 'status', 'table']])
+        self.assertEqual(len(self.client.get('/steps').get_json()), 4)
+
+    def test_repository_get_many_and_upsert_many(self):
+        import pickle
+        import repository
+        from crud_db import get_step_by_id, get_steps_by_protocol_id
+        self.create_parents('workflows', 'protocols')
+        self.create_parents('protocols')
+        steps = repository.STEPS
+        self.assertEqual(steps.upsert_many([(None, 1, None, "Step %d" % n, n) for n in range(1, 8)]), 7)
+        row = steps.get(3)
+        self.assertEqual((row.description, row[3], type(row).__name__), ("Step 3", "Step 3", 'Step'))
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)  # cacheable by the memcached/redis backends
+
+        chunk_size = repository.CHUNK_SIZE
+        repository.CHUNK_SIZE = 3
+        try:
+            self.assertEqual([row.id for row in steps.get_many([7, 1, 99, 4, 2, 2, 6])], [1, 2, 4, 6, 7])
+        finally:
+            repository.CHUNK_SIZE = chunk_size
+        self.assertEqual(steps.get_many([]), [])
+
+        # Upserts replace whole rows and drop the cache entries of both old and new protocol
+        self.assertEqual(get_step_by_id(2).description, "Step 2")
+        self.assertEqual(len(get_steps_by_protocol_id(2)), 0)
+        steps.upsert_many([{"id": 2, "protocol_id": 2, "parent_step_id": None, "description": "Moved", "step_order": 1},
+                           {"id": None, "protocol_id": 2, "parent_step_id": None, "description": "New", "step_order": 2}])
+        self.assertEqual(get_step_by_id(2).description, "Moved")
+        self.assertEqual([step['description'] for step in get_steps_by_protocol_id(2)], ["Moved", "New"])
+        self.assertEqual(len(get_steps_by_protocol_id(1)), 6)
+        self.assertEqual(self.client.get('/steps/2').get_json(), [2, 2, None, "Moved", 1])
+        self.assertRaises(sqlite3.IntegrityError, steps.upsert_many, [(2, 99, None, "Orphan", 1)])
+        self.assertEqual(steps.get(2).protocol_id, 2)
+
+    def test_parameter_rows_include_generated_columns(self):
+        self.create_parents('workflows', 'protocols', 'steps')
+        response = self.client.post('/parameters', json={"step_id": 1, "name": "temperature (°C)", "value_type": "numeric", "value": "60"})
+        self.assertEqual((response.get_json()['numeric_value'], response.get_json()['unit']), (60.0, "°C"))
+        self.assertEqual(self.client.get('/parameters/1').get_json(), [1, 1, "temperature (°C)", "numeric", "60", 60.0, "°C"])
+        response = self.client.put('/parameters/1', json={"step_id": 1, "name": "time (s)", "value_type": "numeric", "value": "30"})
+        self.assertEqual(response.get_json(), {"id": 1, "step_id": 1, "name": "time (s)", "value_type": "numeric", "value": "30", "numeric_value": 30.0, "unit": "s"})
+
 if __name__ == '__main__':
     unittest.main()
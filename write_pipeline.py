@@ -0,0 +1,225 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+
+import db_pool
+
+# Optional single-writer mode. Every write helper decorated with @pipelined is queued
+# to one writer thread instead of committing on its own. The writer groups whatever
+# is pending into one transaction (up to BATCH_SIZE operations, waiting at most
+# BATCH_DELAY for more to arrive) and pays one fsync per batch instead of per write.
+# Each operation runs inside its own SAVEPOINT, so a failing write is rolled back and
+# reported to its caller alone; the rest of the batch still commits.
+#
+# Callers block on a Future until the batch holding their operation has committed, so
+# a write is still visible to the caller's next read, exactly like the direct path.
+#
+# When the registry is sharded (see sharding.py), writes routed to a shard go to that
+# shard's own writer, started on first use with the same settings: each file has its
+# own write lock, so one writer per file keeps shards from waiting on each other.
+
+BATCH_SIZE = 256
+BATCH_DELAY = 0.002  # seconds the writer waits for more operations after the first
+
+
+class PipelineClosed(Exception):
+    pass
+
+
+class WritePipeline:
+    def __init__(self, db_name=None, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+        self.db_name = db_name or db_pool.DB_NAME
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._counters = {
+            'submitted': 0,
+            'committed': 0,
+            'failed': 0,
+            'batches': 0,
+            'largest_batch': 0,
+            'commit_seconds': 0.0,
+        }
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        if self._closed:
+            raise PipelineClosed("Write pipeline for %s is closed" % self.db_name)
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        self._counters['submitted'] += 1
+        return future
+
+    def close(self):
+        # Operations already queued are still written
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['db_name'] = self.db_name
+        stats['batch_size'] = self.batch_size
+        stats['batch_delay'] = self.batch_delay
+        stats['pending'] = self._queue.qsize()
+        stats['mean_batch'] = stats['committed'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # finish this batch, then stop
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = db_pool.open_connection(self.db_name, check_same_thread=False, factory=db_pool.PooledConnection)
+        # Register the writer's connection as this thread's own, so the helpers' nested
+        # transaction() blocks and on_commit() callbacks attach to the batch transaction
+        db_pool._local.conns = {self.db_name: conn}
+        if self.db_name != db_pool.DB_NAME:
+            db_pool.route_database(self.db_name)  # a shard's writer: the helpers' SQL goes to its file
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+                if batch:
+                    self._write(conn, batch)
+        finally:
+            db_pool._local.conns = {}
+            db_pool.route_database(None)
+            conn.close()
+
+    def _write(self, conn, batch):
+        started = time.monotonic()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.transaction_depth = 1
+            for future, fn, args, kwargs in batch:
+                callbacks = len(conn.commit_callbacks)
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    del conn.commit_callbacks[callbacks:]
+                    results.append((future, None, e))
+                else:
+                    conn.execute("RELEASE op")
+                    results.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            # BEGIN or COMMIT itself failed: nothing in the batch was written
+            if conn.in_transaction:
+                conn.rollback()
+            conn.transaction_depth = 0
+            conn.commit_callbacks = []
+            self._counters['failed'] += len(batch)
+            for future, _, _, _ in batch:
+                future.set_exception(e)
+            return
+
+        conn.transaction_depth = 0
+        callbacks, conn.commit_callbacks = conn.commit_callbacks, []
+        for callback in callbacks:
+            callback()
+        self._counters['batches'] += 1
+        self._counters['largest_batch'] = max(self._counters['largest_batch'], len(batch))
+        self._counters['commit_seconds'] += time.monotonic() - started
+        for future, result, error in results:
+            if error is None:
+                self._counters['committed'] += 1
+                future.set_result(result)
+            else:
+                self._counters['failed'] += 1
+                future.set_exception(error)
+
+
+_pipeline = None
+_shard_pipelines = {}  # shard path -> WritePipeline, started on first routed write
+_pipeline_lock = threading.Lock()
+
+
+def enable(db_name=None, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is not None:
+            _pipeline.close()
+        _pipeline = WritePipeline(db_name, batch_size, batch_delay)
+    return _pipeline
+
+
+def disable():
+    global _pipeline
+    with _pipeline_lock:
+        pipeline, _pipeline = _pipeline, None
+    if pipeline is not None:
+        pipeline.close()
+    close_shard_pipelines()
+
+
+def close_shard_pipelines(db_names=None):
+    # All shards' writers, or just those of db_names
+    with _pipeline_lock:
+        db_names = list(_shard_pipelines) if db_names is None else [db_name for db_name in db_names if db_name in _shard_pipelines]
+        pipelines = [_shard_pipelines.pop(db_name) for db_name in db_names]
+    for pipeline in pipelines:
+        pipeline.close()
+
+
+def _pipeline_for(db_name):
+    pipeline = _pipeline
+    if pipeline is None or db_name is None or db_name == pipeline.db_name:
+        return pipeline
+    with _pipeline_lock:
+        if db_name not in _shard_pipelines:
+            _shard_pipelines[db_name] = WritePipeline(db_name, pipeline.batch_size, pipeline.batch_delay)
+        return _shard_pipelines[db_name]
+
+
+def enabled():
+    return _pipeline is not None
+
+
+def pipeline_stats():
+    pipeline = _pipeline
+    if pipeline is None:
+        return {'enabled': False}
+    stats = pipeline.stats()
+    if _shard_pipelines:
+        stats['shards'] = {db_name: shard.stats() for db_name, shard in list(_shard_pipelines.items())}
+    return stats
+
+
+def pipelined(fn):
+    # Route a write helper through the writer thread of the database it writes to
+    # when the pipeline is on. A caller already inside a transaction (or the writer
+    # itself) runs it inline, so it stays part of that transaction.
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        pipeline = _pipeline_for(db_pool.routed_database())
+        if pipeline is None or db_pool.in_transaction(pipeline.db_name):
+            return fn(*args, **kwargs)
+        return pipeline.submit(fn, *args, **kwargs).result()
+    wrapper.direct = fn
+    return wrapper